@@ -0,0 +1,1099 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# ecs-worker-benchmark.py
+#
+
+#
+# Throughput and latency benchmark for the POV-Ray worker pattern. Runs offline, against local stand-ins for Amazon S3,
+# Amazon SQS, AWS Lambda and Amazon ECS, so no AWS account is needed.
+#
+# "pipeline" uploads synthetic scene archives of a given size and render time into the S3 stand-in. Every object
+# created in the bucket invokes the real launcher function, through "node ecs-worker-launcher-harness.js --serve",
+# which queues the scene and starts tasks. Each task runs the real worker loop, ecs_worker.main(), in a thread of this
+# process, with a stand-in for POV-Ray that waits for the scene's render time and writes a blank image. The report
+# shows jobs per second, percentiles of the time from upload to PNG and how that time splits into launching, waiting
+# in the queue and the worker's stages.
+#
+# "fab" runs the main fab tasks in a scratch copy of this directory, with stand-ins for the AWS APIs that answer after
+# a fixed latency and for local commands like docker and npm, which are recorded instead of run. The report shows the
+# time, the number of AWS calls and the number of local commands per task. fabfile.py needs Python 2.
+#
+# Run both with "fab benchmark" after "fab update_dependencies", or one at a time:
+#
+#     python ecs-worker-benchmark.py pipeline --scenes 50 --scene-mb 16 --render-seconds 0.5
+#     python ecs-worker-benchmark.py fab --aws-latency 0.05
+#
+
+# Imports
+from __future__ import print_function
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from botocore.exceptions import ClientError
+
+# Constants
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKER_PATH = os.path.join(BASE_DIR, 'ecs-worker')
+LAUNCHER_HARNESS = os.path.join(BASE_DIR, 'ecs-worker-launcher-harness.js')
+
+REGION = 'us-east-1'
+ACCOUNT = '123456789012'
+BUCKET = 'benchmark-bucket'
+QUEUE_URL = 'https://queue.amazonaws.com/' + ACCOUNT + '/BenchmarkQueue'
+TASK = 'BenchmarkTask'
+CLUSTER = 'benchmark'
+LAUNCHER_FUNCTION = 'ecs-worker-launcher:live'
+QUEUE_VISIBILITY_TIMEOUT = 30  # Seconds, like a queue created with the default attributes.
+SCENE_PREFIX = 'benchmark/'
+SCENE_SIZE = (64, 48)  # Frame size of the synthetic scenes. Keeps the stand-in's PNG small.
+PERCENTILES = [50, 95, 99]
+STAGES = ['upload-to-PNG', 'launch', 'queue', 'fetch', 'extract', 'render', 'stitch', 'upload']
+FINISH_TIMEOUT = 600  # Seconds to wait for all scenes to be rendered before giving up.
+
+FAB_FILES = ['fabfile.py', 'config.py', 'ecs-worker', 'ecs-worker-launcher', 'ECSLogo']
+FAB_SCENARIOS = [
+    # (title, fab task, file changed before the task runs)
+    ('setup, first time', 'setup', None),
+    ('setup, nothing changed', 'setup', None),
+    ('update_lambda, function changed', 'update_lambda', 'ecs-worker-launcher/ecs-worker-launcher.js'),
+    ('update_ecs, worker changed', 'update_ecs', 'ecs-worker/ecs_worker.py'),
+    ('create_pov_ray_zip', 'create_pov_ray_zip', None),
+    ('prepare_env', 'prepare_env', None)
+]
+FAB_CONTAINER_INSTANCES = 120  # More than one DescribeContainerInstances call takes.
+
+# Waits for the time the scene declares as BenchmarkSeconds in its .ini file, then writes a blank PNG image.
+POVRAY_STAND_IN = r'''#!%(python)s
+import re, struct, sys, time, zlib
+
+args = sys.argv[1:]
+if args == ['--version']:
+    sys.stdout.write('POV-Ray 3.7.0 (benchmark stand-in)\n')
+    sys.exit(0)
+
+name = [a for a in args if not a.startswith('+')][0]
+with open(name + '.ini') as f:
+    ini = f.read()
+width = int(re.search(r'\+W(\d+)', ini).group(1))
+height = int(re.search(r'\+H(\d+)', ini).group(1))
+seconds = re.search(r'BenchmarkSeconds=([0-9.]+)', ini)
+time.sleep(float(seconds.group(1)) if seconds else 0)
+
+
+def chunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+with open(name + '.png', 'wb') as f:
+    f.write(b'\x89PNG\r\n\x1a\n')
+    f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+    f.write(chunk(b'IDAT', zlib.compress(b'\0' * (height * (1 + width * 3)))))
+    f.write(chunk(b'IEND', b''))
+'''
+
+
+# Functions
+
+
+def make_client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def percentile(values, p):
+    """Return the nearest-rank percentile p of a non-empty list of values."""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+# Stand-ins for the pipeline
+
+
+class StandInEvents(object):
+    """Stand-in for a client's event system. The stand-ins take every parameter as is, so handlers are ignored."""
+
+    def register(self, event_name, handler):
+        pass
+
+
+class StandInS3(object):
+    """Stand-in for the Amazon S3 calls of the worker. Keeps objects in memory and calls on_put for every new object.
+
+    Remembers when each key was first written, which is when the benchmark counts an upload or an image as done.
+    """
+
+    def __init__(self, on_put):
+        self.lock = threading.Lock()
+        self.objects = {}  # (bucket, key) -> (data, ETag)
+        self.created = {}  # (bucket, key) -> time of the first write
+        self.on_put = on_put
+        self.meta = argparse.Namespace(events=StandInEvents())
+
+    def store(self, bucket, key, data, exclusive=False):
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        with self.lock:
+            if exclusive and (bucket, key) in self.objects:
+                raise make_client_error('PreconditionFailed', 'PutObject')
+            self.objects[(bucket, key)] = (data, etag)
+            self.created.setdefault((bucket, key), time.time())
+        self.on_put(bucket, key, len(data))
+
+    def load(self, bucket, key, operation, missing_code='NoSuchKey'):
+        with self.lock:
+            if (bucket, key) not in self.objects:
+                raise make_client_error(missing_code, operation)
+            return self.objects[(bucket, key)]
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data, etag = self.load(Bucket, Key, 'HeadObject', '404')
+        return {'ContentLength': len(data), 'ETag': etag}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        data, etag = self.load(Bucket, Key, 'GetObject')
+        if IfMatch is not None and IfMatch != etag:
+            raise make_client_error('PreconditionFailed', 'GetObject')
+        if Range:
+            start, end = Range[len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data), 'ETag': etag}
+
+    def put_object(self, Bucket, Key, Body, IfNoneMatch=None, **kwargs):
+        self.store(Bucket, Key, Body if isinstance(Body, bytes) else Body.read(), IfNoneMatch == '*')
+        return {}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        data, _ = self.load(CopySource['Bucket'], CopySource['Key'], 'CopyObject')
+        self.store(Bucket, Key, data)
+        return {}
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        data, _ = self.load(Bucket, Key, 'HeadObject', '404')
+        with open(Filename, 'wb') as f:
+            f.write(data)
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as f:
+            self.store(Bucket, Key, f.read())
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix=''):
+        with self.lock:
+            keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+        return [{'Contents': [{'Key': k} for k in keys]}]
+
+    def delete_objects(self, Bucket, Delete):
+        with self.lock:
+            for o in Delete['Objects']:
+                self.objects.pop((Bucket, o['Key']), None)
+        return {}
+
+
+class StandInSQS(object):
+    """Stand-in for the Amazon SQS calls of the worker, with long polling and visibility timeouts.
+
+    Every receive is logged as (body, sent, received), for the time messages spent waiting in the queue.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.messages = []
+        self.sent = 0
+        self.receives = []
+
+    def send(self, bodies):
+        with self.condition:
+            for body in bodies:
+                self.sent += 1
+                self.messages.append({
+                    'MessageId': 'message-' + str(self.sent),
+                    'Body': body,
+                    'sent': time.time(),
+                    'visible_at': 0,
+                    'receive_count': 0
+                })
+            self.condition.notify_all()
+
+    def get_depth(self):
+        """Return the number of visible and of in flight messages."""
+        now = time.time()
+        with self.condition:
+            visible = len([m for m in self.messages if m['visible_at'] <= now])
+            return visible, len(self.messages) - visible
+
+    def find(self, receipt_handle):
+        for m in self.messages:
+            if m.get('ReceiptHandle') == receipt_handle:
+                return m
+        return None
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        visible, in_flight = self.get_depth()
+        return {'Attributes': {
+            'VisibilityTimeout': str(QUEUE_VISIBILITY_TIMEOUT),
+            'ApproximateNumberOfMessages': str(visible),
+            'ApproximateNumberOfMessagesNotVisible': str(in_flight)
+        }}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        deadline = time.time() + WaitTimeSeconds
+        with self.condition:
+            while True:
+                now = time.time()
+                ready = [m for m in self.messages if m['visible_at'] <= now][:MaxNumberOfMessages]
+                if ready or now >= deadline:
+                    break
+                # Wake up now and then for messages whose visibility timeout ran out.
+                self.condition.wait(min(deadline - now, 0.1))
+
+            result = []
+            for m in ready:
+                m['visible_at'] = now + QUEUE_VISIBILITY_TIMEOUT
+                m['receive_count'] += 1
+                m['ReceiptHandle'] = m['MessageId'] + '-' + str(m['receive_count'])
+                self.receives.append((m['Body'], m['sent'], now))
+                result.append({
+                    'MessageId': m['MessageId'],
+                    'ReceiptHandle': m['ReceiptHandle'],
+                    'Body': m['Body'],
+                    'Attributes': {
+                        'SentTimestamp': str(int(m['sent'] * 1000)),
+                        'ApproximateReceiveCount': str(m['receive_count'])
+                    }
+                })
+        return {'Messages': result} if result else {}
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        with self.condition:
+            m = self.find(ReceiptHandle)
+            if m is None:
+                raise make_client_error('ReceiptHandleIsInvalid', 'ChangeMessageVisibility')
+            m['visible_at'] = time.time() + VisibilityTimeout
+            self.condition.notify_all()
+        return {}
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        result = {'Successful': [], 'Failed': []}
+        for e in Entries:
+            try:
+                self.change_message_visibility(QueueUrl, e['ReceiptHandle'], e['VisibilityTimeout'])
+                result['Successful'].append({'Id': e['Id']})
+            except ClientError:
+                result['Failed'].append({'Id': e['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True})
+        return result
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.send([e['MessageBody'] for e in Entries])
+        return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        result = {'Successful': [], 'Failed': []}
+        with self.condition:
+            for e in Entries:
+                m = self.find(e['ReceiptHandle'])
+                if m is None:
+                    result['Failed'].append({'Id': e['Id'], 'Code': 'ReceiptHandleIsInvalid', 'SenderFault': True})
+                else:
+                    self.messages.remove(m)
+                    result['Successful'].append({'Id': e['Id']})
+        return result
+
+
+class StandInECS(object):
+    """Stand-in for Amazon ECS. Places each task on the first container instance with room for it, like the launcher's
+    harness does, and runs it in a thread of its own after start_seconds.
+    """
+
+    def __init__(self, instances, task_cpu, task_memory, start_seconds, run_task):
+        self.lock = threading.Lock()
+        self.instances = [{'cpu': cpu, 'memory': memory} for cpu, memory in instances]  # Free capacity.
+        self.task_cpu = task_cpu
+        self.task_memory = task_memory
+        self.start_seconds = start_seconds
+        self.run_task = run_task
+        self.tasks = {}  # Task number -> index of its container instance.
+        self.started = 0
+        self.errors = []
+
+    def get_state(self):
+        with self.lock:
+            return len(self.tasks), [dict(i) for i in self.instances]
+
+    def run_tasks(self, count):
+        for _ in range(count):
+            with self.lock:
+                fits = [n for n, i in enumerate(self.instances)
+                        if i['cpu'] >= self.task_cpu and i['memory'] >= self.task_memory]
+                if not fits:
+                    return
+                self.instances[fits[0]]['cpu'] -= self.task_cpu
+                self.instances[fits[0]]['memory'] -= self.task_memory
+                self.started += 1
+                task = self.started
+                self.tasks[task] = fits[0]
+            t = threading.Thread(target=self.run, name='task-' + str(task), args=(task,))
+            t.daemon = True
+            t.start()
+
+    def run(self, task):
+        try:
+            time.sleep(self.start_seconds)
+            self.run_task(task)
+        except BaseException as e:
+            self.errors.append('Task ' + str(task) + ': ' + repr(e))
+        finally:
+            with self.lock:
+                instance = self.instances[self.tasks.pop(task)]
+                instance['cpu'] += self.task_cpu
+                instance['memory'] += self.task_memory
+
+
+class StandInLambda(object):
+    """Stand-in for AWS Lambda that runs the launcher function in a node process, one invocation at a time.
+
+    AWS Lambda runs invocations in parallel, so under load the launch times here are on the slow side.
+    """
+
+    def __init__(self, config, sqs, ecs, stderr):
+        self.config = config
+        self.sqs = sqs
+        self.ecs = ecs
+        self.process = subprocess.Popen(
+            ['node', LAUNCHER_HARNESS, '--serve'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=stderr
+        )
+        self.invocations = Queue()
+        self.sequencer = 0
+        self.seconds = []
+        self.errors = []
+        t = threading.Thread(target=self.run, name='lambda')
+        t.daemon = True
+        t.start()
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=b'{}', **kwargs):
+        self.invocations.put(json.loads(Payload.decode('utf-8')))
+        return {'StatusCode': 202}
+
+    def notify(self, bucket, key, size):
+        """Invoke the function with the event of a new object, like an S3 event notification for s3:ObjectCreated:*."""
+        self.sequencer += 1
+        self.invocations.put({'Records': [{
+            'eventSource': 'aws:s3',
+            'eventName': 'ObjectCreated:Put',
+            's3': {
+                'bucket': {'name': bucket, 'arn': 'arn:aws:s3:::' + bucket},
+                'object': {'key': key, 'size': size, 'sequencer': '%016X' % self.sequencer}
+            }
+        }]})
+
+    def run(self):
+        while True:
+            event = self.invocations.get()
+            if event is None:
+                return
+            started = time.time()
+            visible, in_flight = self.sqs.get_depth()
+            running, instances = self.ecs.get_state()
+            request = {
+                'config': self.config,
+                'event': event,
+                'state': {'visible': visible, 'inFlight': in_flight, 'running': running, 'instances': instances}
+            }
+            self.process.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+            if not line:
+                self.errors.append('The launcher process exited, see the log.')
+                return
+            reply = json.loads(line.decode('utf-8'))
+            if reply['error']:
+                self.errors.append(reply['error'])
+            self.sqs.send(reply['messages'])
+            self.ecs.run_tasks(reply['started'])
+            self.seconds.append(time.time() - started)
+
+    def stop(self):
+        self.invocations.put(None)
+        self.process.stdin.close()
+        self.process.wait()
+
+
+# Pipeline benchmark
+
+
+def make_scene(name, asset, render_seconds):
+    """Return a POV-Ray scene archive with the given asset file, that takes render_seconds with the stand-in."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr(name + '.ini', '\n'.join([
+            'Input_File_Name=' + name + '.pov',
+            'Output_File_Type=N',
+            '+W%d +H%d' % SCENE_SIZE,
+            'Declare=BenchmarkSeconds=%.3f' % render_seconds,
+            ''
+        ]))
+        z.writestr(name + '.pov', '// ' + name + '\nsphere { <0, 0, 0>, 1 pigment { color rgb 1 } }\n')
+        if asset:
+            z.writestr(zipfile.ZipInfo('assets.bin', (1980, 1, 1, 0, 0, 0)), asset, zipfile.ZIP_STORED)
+    return buf.getvalue()
+
+
+def get_scene_keys(message_body):
+    try:
+        return [job['key'] for job in json.loads(message_body)['Jobs']]
+    except (ValueError, KeyError, TypeError):
+        return []
+
+
+def run_pipeline(args):
+    scratch = tempfile.mkdtemp(prefix='ecs-worker-benchmark-')
+    bin_dir = os.path.join(scratch, 'bin')
+    os.makedirs(bin_dir)
+    with open(os.path.join(bin_dir, 'povray'), 'w') as f:
+        f.write(POVRAY_STAND_IN % {'python': sys.executable})
+    os.chmod(os.path.join(bin_dir, 'povray'), 0o755)
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+    # The worker reads its configuration from the environment when it is imported.
+    os.environ.update({
+        'AWS_REGION': REGION,
+        'SQS_QUEUE_URL': QUEUE_URL,
+        'CPU_SHARES': str(args.task_cpu),
+        'LAUNCHER_FUNCTION': LAUNCHER_FUNCTION
+    })
+    if args.asset_cache:
+        os.environ['ASSET_CACHE_DIR'] = os.path.join(scratch, 'asset-cache')
+    sys.path.insert(0, WORKER_PATH)
+    import ecs_worker
+    ecs_worker.RECEIVE_WAIT_TIME = args.poll_seconds
+
+    stages = {}  # Scene key -> the worker's StageCounters for it.
+    render_scene = ecs_worker.render_scene
+
+    def render_scene_with_counters(clients, job, work_dir, threads, counters):
+        if 'tile' not in job and 'frames' not in job:
+            stages[job['key']] = counters
+        render_scene(clients, job, work_dir, threads, counters)
+
+    ecs_worker.render_scene = render_scene_with_counters
+
+    log = open(args.log, 'a') if args.log else open(os.devnull, 'w')
+    sqs = StandInSQS()
+    launcher = []
+    s3 = StandInS3(lambda bucket, key, size: launcher[0].notify(bucket, key, size))
+    clients = {'s3': s3, 'sqs': sqs}
+
+    class Session(object):
+        def __init__(self, **kwargs):
+            pass
+
+        def client(self, service, **kwargs):
+            return launcher[0] if service == 'lambda' else clients[service]
+
+    ecs_worker.boto3.session.Session = Session
+
+    def run_task(task):
+        ecs_worker.main(work_dir=os.path.join(scratch, 'task-' + str(task)))
+
+    ecs = StandInECS(
+        [(args.instance_cpu, args.instance_memory)] * args.instances,
+        args.task_cpu, args.task_memory, args.task_start_seconds, run_task
+    )
+    config = {
+        's3_key_suffix_whitelist': ['.zip'],
+        'queue': QUEUE_URL,
+        'task': TASK,
+        'cluster': CLUSTER,
+        'scaling': {
+            'min_tasks': 0,
+            'max_tasks': args.max_tasks,
+            'messages_per_task': args.messages_per_task,
+            'task_cpu': args.task_cpu,
+            'task_memory': args.task_memory
+        }
+    }
+    launcher.append(StandInLambda(config, sqs, ecs, log))
+
+    rng = random.Random(args.seed)
+    asset = os.urandom(int(args.scene_mb * 1024 * 1024))
+    keys = []
+    scenes = []
+    for i in range(args.scenes):
+        name = 'scene-%05d' % i
+        seconds = max(0.0, rng.uniform(1 - args.render_jitter, 1 + args.render_jitter) * args.render_seconds)
+        keys.append(SCENE_PREFIX + name + '.zip')
+        # Without the asset cache, every scene gets assets of its own, like unrelated scenes would have.
+        scenes.append(make_scene(name, asset if args.asset_cache else os.urandom(len(asset)), seconds))
+
+    images = [(BUCKET, os.path.splitext(k)[0] + '.png') for k in keys]
+    stdout = sys.stdout
+    sys.stdout = log  # The worker logs to stdout.
+    started = time.time()
+    try:
+        for key, data in zip(keys, scenes):
+            s3.store(BUCKET, key, data)
+            if args.upload_rate:
+                time.sleep(1.0 / args.upload_rate)
+
+        while time.time() - started < FINISH_TIMEOUT and not all(i in s3.created for i in images):
+            time.sleep(0.05)
+        finished = time.time()
+
+        # Let the tasks see the empty queue and exit, like they would on the cluster.
+        while ecs.get_state()[0] and time.time() - finished < args.poll_seconds + 30:
+            time.sleep(0.05)
+    finally:
+        sys.stdout = stdout
+        launcher[0].stop()
+        log.close()
+        shutil.rmtree(scratch)
+
+    report_pipeline(args, keys, s3, sqs, ecs, launcher[0], stages, started)
+    done = [i for i in images if i in s3.created]
+    return 0 if len(done) == len(images) and not launcher[0].errors and not ecs.errors else 1
+
+
+def report_pipeline(args, keys, s3, sqs, ecs, launcher, stages, started):
+    sent = {}
+    received = {}
+    for body, message_sent, message_received in sqs.receives:
+        for key in get_scene_keys(body):
+            sent.setdefault(key, message_sent)
+            received.setdefault(key, message_received)
+
+    samples = dict((s, []) for s in STAGES)
+    last = started
+    for key in keys:
+        image = (BUCKET, os.path.splitext(key)[0] + '.png')
+        if image not in s3.created:
+            continue
+        uploaded = s3.created[(BUCKET, key)]
+        last = max(last, s3.created[image])
+        samples['upload-to-PNG'].append(s3.created[image] - uploaded)
+        if key in sent:
+            samples['launch'].append(sent[key] - uploaded)
+            samples['queue'].append(received[key] - sent[key])
+        if key in stages:
+            for stage, seconds in stages[key].seconds.items():
+                samples[stage].append(seconds)
+
+    done = len(samples['upload-to-PNG'])
+    elapsed = last - started
+    print('Scenes: %d of %.1f MB, %.2f s render time each%s. Tasks: up to %d of %d CPU shares, on %d instance(s).' % (
+        args.scenes, args.scene_mb, args.render_seconds,
+        ' (+/- %d%%)' % (args.render_jitter * 100) if args.render_jitter else '',
+        args.max_tasks, args.task_cpu, args.instances
+    ))
+    print('Rendered: %d of %d scene(s) in %.2f s, %.2f jobs/s. Tasks started: %d. Launcher invocations: %d.' % (
+        done, len(keys), elapsed, done / elapsed if elapsed > 0 else 0.0, ecs.started, len(launcher.seconds)
+    ))
+
+    print('')
+    print('%-16s %10s' % ('Stage', 'Mean (s)') + ''.join('%10s' % ('p%d (s)' % p) for p in PERCENTILES))
+    for stage in STAGES:
+        values = samples[stage]
+        if not values or (stage == 'stitch' and not any(values)):
+            continue
+        print('%-16s %10.3f' % (stage, sum(values) / len(values)) +
+              ''.join('%10.3f' % percentile(values, p) for p in PERCENTILES))
+    print('Fetching and extracting overlap, so their times do too. The rest of upload-to-PNG is spent in the worker,')
+    print('waiting for a free render slot.')
+
+    for error in launcher.errors + ecs.errors:
+        print('ERROR: ' + error)
+    if done < len(keys):
+        print('ERROR: %d scene(s) not rendered within %d s.' % (len(keys) - done, FINISH_TIMEOUT))
+
+
+# Stand-ins for fab tasks
+
+
+class LocalResult(str):
+    """What fabric's local() returns: the output, with succeeded and failed attributes."""
+
+    def __new__(cls, output, succeeded):
+        result = str.__new__(cls, output)
+        result.succeeded = succeeded
+        result.failed = not succeeded
+        return result
+
+
+class StandInClient(object):
+    """Base for stand-ins of the AWS clients the fabfile uses. Every call waits for the latency and is counted."""
+
+    SERVICE = None
+    ERRORS = []
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.exceptions = type('Exceptions', (object,), dict(
+            (name, type(name, (ClientError,), {})) for name in self.ERRORS
+        ))
+
+    def call(self, operation):
+        self.aws.count(self.SERVICE + ':' + operation)
+
+    def error(self, name, operation):
+        return getattr(self.exceptions, name)({'Error': {'Code': name, 'Message': 'Stand-in'}}, operation)
+
+
+class StandInFabS3(StandInClient):
+    SERVICE = 's3'
+
+    def __init__(self, aws):
+        StandInClient.__init__(self, aws)
+        self.buckets = {}  # Name -> notification configuration
+
+    def head_bucket(self, Bucket):
+        self.call('HeadBucket')
+        if Bucket not in self.buckets:
+            raise make_client_error('404', 'HeadBucket')
+        return {}
+
+    def create_bucket(self, Bucket, **kwargs):
+        self.call('CreateBucket')
+        self.buckets[Bucket] = {}
+        return {}
+
+    def get_bucket_notification_configuration(self, Bucket):
+        self.call('GetBucketNotificationConfiguration')
+        return dict(self.buckets[Bucket])
+
+    def put_bucket_notification_configuration(self, Bucket, NotificationConfiguration):
+        self.call('PutBucketNotificationConfiguration')
+        self.buckets[Bucket] = json.loads(json.dumps(NotificationConfiguration))
+        return {}
+
+
+class StandInFabSQS(StandInClient):
+    SERVICE = 'sqs'
+    ERRORS = ['QueueDoesNotExist']
+
+    def __init__(self, aws):
+        StandInClient.__init__(self, aws)
+        self.queues = {}  # Name -> attributes
+
+    def get_queue_url(self, QueueName):
+        self.call('GetQueueUrl')
+        if QueueName not in self.queues:
+            raise self.error('QueueDoesNotExist', 'GetQueueUrl')
+        return {'QueueUrl': 'https://queue.amazonaws.com/' + ACCOUNT + '/' + QueueName}
+
+    def create_queue(self, QueueName, Attributes=None):
+        self.call('CreateQueue')
+        self.queues.setdefault(QueueName, dict(Attributes or {}))
+        return {'QueueUrl': 'https://queue.amazonaws.com/' + ACCOUNT + '/' + QueueName}
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        self.call('GetQueueAttributes')
+        name = QueueUrl.split('/')[-1]
+        attributes = dict(self.queues[name], QueueArn='arn:aws:sqs:' + REGION + ':' + ACCOUNT + ':' + name)
+        return {'Attributes': dict((a, attributes[a]) for a in AttributeNames if a in attributes)}
+
+    def set_queue_attributes(self, QueueUrl, Attributes):
+        self.call('SetQueueAttributes')
+        self.queues[QueueUrl.split('/')[-1]].update(Attributes)
+        return {}
+
+
+class StandInFabIAM(StandInClient):
+    SERVICE = 'iam'
+    ERRORS = ['NoSuchEntityException']
+
+    def __init__(self, aws):
+        StandInClient.__init__(self, aws)
+        self.roles = {'ecsInstanceRole': {}}  # Name -> AssumeRolePolicyDocument
+        self.role_policies = {}  # (role, policy) -> PolicyDocument
+
+    def get_role(self, RoleName):
+        self.call('GetRole')
+        if RoleName not in self.roles:
+            raise self.error('NoSuchEntityException', 'GetRole')
+        return {'Role': {
+            'RoleName': RoleName,
+            'Arn': 'arn:aws:iam::' + ACCOUNT + ':role/' + RoleName,
+            'AssumeRolePolicyDocument': self.roles[RoleName]
+        }}
+
+    def create_role(self, RoleName, AssumeRolePolicyDocument):
+        self.call('CreateRole')
+        self.roles[RoleName] = json.loads(AssumeRolePolicyDocument)
+        return {'Role': {'RoleName': RoleName, 'Arn': 'arn:aws:iam::' + ACCOUNT + ':role/' + RoleName}}
+
+    def update_assume_role_policy(self, RoleName, PolicyDocument):
+        self.call('UpdateAssumeRolePolicy')
+        self.roles[RoleName] = json.loads(PolicyDocument)
+        return {}
+
+    def get_role_policy(self, RoleName, PolicyName):
+        self.call('GetRolePolicy')
+        if (RoleName, PolicyName) not in self.role_policies:
+            raise self.error('NoSuchEntityException', 'GetRolePolicy')
+        return {'PolicyDocument': self.role_policies[(RoleName, PolicyName)]}
+
+    def put_role_policy(self, RoleName, PolicyName, PolicyDocument):
+        self.call('PutRolePolicy')
+        self.role_policies[(RoleName, PolicyName)] = json.loads(PolicyDocument)
+        return {}
+
+    def get_instance_profile(self, InstanceProfileName):
+        self.call('GetInstanceProfile')
+        return {'InstanceProfile': {'Roles': [{'RoleName': 'ecsInstanceRole'}]}}
+
+
+class StandInFabLambda(StandInClient):
+    SERVICE = 'lambda'
+    ERRORS = ['ResourceNotFoundException', 'InvalidParameterValueException']
+
+    def __init__(self, aws):
+        StandInClient.__init__(self, aws)
+        self.functions = {}  # Name -> {'$LATEST': configuration, '1': configuration, ...}
+        self.aliases = {}  # (name, alias) -> version
+        self.statements = {}  # (name, alias) -> [statement, ...]
+
+    def get_versions(self, name, operation):
+        if name not in self.functions:
+            raise self.error('ResourceNotFoundException', operation)
+        return self.functions[name]
+
+    def get_function_configuration(self, FunctionName, Qualifier='$LATEST'):
+        self.call('GetFunctionConfiguration')
+        versions = self.get_versions(FunctionName, 'GetFunctionConfiguration')
+        version = self.aliases.get((FunctionName, Qualifier), Qualifier)
+        if version not in versions:
+            raise self.error('ResourceNotFoundException', 'GetFunctionConfiguration')
+        return dict(versions[version])
+
+    def publish(self, name, description=None):
+        versions = self.functions[name]
+        version = str(len(versions))
+        versions[version] = dict(versions['$LATEST'], Version=version)
+        if description is not None:
+            versions[version]['Description'] = description
+        return dict(versions[version])
+
+    def create_function(self, FunctionName, Code, Publish=False, **configuration):
+        self.call('CreateFunction')
+        self.functions[FunctionName] = {'$LATEST': dict(
+            configuration,
+            FunctionName=FunctionName,
+            FunctionArn='arn:aws:lambda:' + REGION + ':' + ACCOUNT + ':function:' + FunctionName,
+            CodeSha256=base64.b64encode(hashlib.sha256(Code['ZipFile']).digest()).decode('ascii'),
+            Version='$LATEST',
+            LastUpdateStatus='Successful'
+        )}
+        return self.publish(FunctionName) if Publish else dict(self.functions[FunctionName]['$LATEST'])
+
+    def update_function_code(self, FunctionName, ZipFile):
+        self.call('UpdateFunctionCode')
+        latest = self.get_versions(FunctionName, 'UpdateFunctionCode')['$LATEST']
+        latest['CodeSha256'] = base64.b64encode(hashlib.sha256(ZipFile).digest()).decode('ascii')
+        return dict(latest)
+
+    def update_function_configuration(self, FunctionName, **configuration):
+        self.call('UpdateFunctionConfiguration')
+        self.get_versions(FunctionName, 'UpdateFunctionConfiguration')['$LATEST'].update(configuration)
+        return {}
+
+    def publish_version(self, FunctionName, CodeSha256=None, Description=None):
+        self.call('PublishVersion')
+        self.get_versions(FunctionName, 'PublishVersion')
+        return self.publish(FunctionName, Description)
+
+    def create_alias(self, FunctionName, Name, FunctionVersion):
+        self.call('CreateAlias')
+        self.aliases[(FunctionName, Name)] = FunctionVersion
+        return {}
+
+    def update_alias(self, FunctionName, Name, FunctionVersion):
+        self.call('UpdateAlias')
+        self.aliases[(FunctionName, Name)] = FunctionVersion
+        return {}
+
+    def get_policy(self, FunctionName, Qualifier=None):
+        self.call('GetPolicy')
+        if (FunctionName, Qualifier) not in self.statements:
+            raise self.error('ResourceNotFoundException', 'GetPolicy')
+        return {'Policy': json.dumps({'Statement': self.statements[(FunctionName, Qualifier)]})}
+
+    def add_permission(self, FunctionName, StatementId, Qualifier=None, **kwargs):
+        self.call('AddPermission')
+        self.statements.setdefault((FunctionName, Qualifier), []).append({'Sid': StatementId})
+        return {}
+
+
+class StandInFabECS(StandInClient):
+    SERVICE = 'ecs'
+
+    def __init__(self, aws):
+        StandInClient.__init__(self, aws)
+        self.container_instances = [
+            'arn:aws:ecs:' + REGION + ':' + ACCOUNT + ':container-instance/' + str(i)
+            for i in range(FAB_CONTAINER_INSTANCES)
+        ]
+        self.task_definitions = 0
+
+    def get_paginator(self, operation):
+        assert operation == 'list_container_instances'
+        return self
+
+    def paginate(self, cluster):
+        self.call('ListContainerInstances')
+        return [{'containerInstanceArns': list(self.container_instances)}]
+
+    def describe_container_instances(self, cluster, containerInstances):
+        self.call('DescribeContainerInstances')
+        assert len(containerInstances) <= 100
+        result = []
+        for arn in containerInstances:
+            n = self.container_instances.index(arn)
+            tasks = (n * 7) % 4  # Some instances are busier than others.
+            result.append({
+                'containerInstanceArn': arn,
+                'ec2InstanceId': 'i-%08d' % n,
+                'status': 'ACTIVE',
+                'agentConnected': True,
+                'runningTasksCount': tasks,
+                'pendingTasksCount': 0,
+                'registeredResources': [
+                    {'name': 'CPU', 'integerValue': 2048},
+                    {'name': 'MEMORY', 'integerValue': 3768}
+                ],
+                'remainingResources': [
+                    {'name': 'CPU', 'integerValue': 2048 - tasks * 512},
+                    {'name': 'MEMORY', 'integerValue': 3768 - tasks * 512}
+                ]
+            })
+        return {'containerInstances': result}
+
+    def register_task_definition(self, **kwargs):
+        self.call('RegisterTaskDefinition')
+        self.task_definitions += 1
+        return {'taskDefinition': {'family': kwargs.get('family'), 'revision': self.task_definitions}}
+
+
+class StandInFabEC2(StandInClient):
+    SERVICE = 'ec2'
+
+    def describe_instances(self, InstanceIds):
+        self.call('DescribeInstances')
+        return {'Reservations': [{'Instances': [{
+            'InstanceId': i,
+            'PublicIpAddress': '192.0.2.%d' % (n % 254 + 1),
+            'PrivateIpAddress': '10.0.%d.%d' % (n // 254, n % 254 + 1),
+            'IamInstanceProfile': {'Arn': 'arn:aws:iam::' + ACCOUNT + ':instance-profile/ecsInstanceRole'}
+        } for n, i in enumerate(InstanceIds)]}]}
+
+
+class StandInFabECR(StandInClient):
+    SERVICE = 'ecr'
+    ERRORS = ['ImageNotFoundException']
+
+    def describe_images(self, repositoryName, imageIds):
+        self.call('DescribeImages')
+        if not any(t.endswith(':' + imageIds[0]['imageTag']) for t in self.aws.pushed_images):
+            raise self.error('ImageNotFoundException', 'DescribeImages')
+        return {'imageDetails': [{'imageTags': [imageIds[0]['imageTag']]}]}
+
+    def get_authorization_token(self):
+        self.call('GetAuthorizationToken')
+        return {'authorizationData': [{
+            'authorizationToken': base64.b64encode(b'AWS:stand-in').decode('ascii'),
+            'proxyEndpoint': 'https://' + ACCOUNT + '.dkr.ecr.' + REGION + '.amazonaws.com'
+        }]}
+
+
+class StandInFabLogs(StandInClient):
+    SERVICE = 'logs'
+    ERRORS = ['ResourceAlreadyExistsException', 'ResourceNotFoundException']
+
+    def __init__(self, aws):
+        StandInClient.__init__(self, aws)
+        self.log_groups = {}  # Name -> retention in days
+
+    def get_paginator(self, operation):
+        assert operation == 'describe_log_groups'
+        return self
+
+    def paginate(self, logGroupNamePrefix=''):
+        self.call('DescribeLogGroups')
+        names = sorted(n for n in self.log_groups if n.startswith(logGroupNamePrefix))
+        return [{'logGroups': [{'logGroupName': n} for n in names]}]
+
+    def create_log_group(self, logGroupName):
+        self.call('CreateLogGroup')
+        if logGroupName in self.log_groups:
+            raise self.error('ResourceAlreadyExistsException', 'CreateLogGroup')
+        self.log_groups[logGroupName] = None
+        return {}
+
+    def put_retention_policy(self, logGroupName, retentionInDays):
+        self.call('PutRetentionPolicy')
+        self.log_groups[logGroupName] = retentionInDays
+        return {}
+
+
+class StandInAWS(object):
+    """Stand-in AWS account for the fabfile: one client per service, and a recorder for fabric's local()."""
+
+    CLIENTS = [
+        StandInFabS3, StandInFabSQS, StandInFabIAM, StandInFabLambda, StandInFabECS, StandInFabEC2, StandInFabECR,
+        StandInFabLogs
+    ]
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.commands = []
+        self.pushed_images = set()
+        self.clients = dict((c.SERVICE, c(self)) for c in self.CLIENTS)
+
+    def count(self, operation):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def local(self, command, capture=False, shell=None):
+        with self.lock:
+            self.commands.append(command)
+        if command.startswith('docker push '):
+            self.pushed_images.add(command.split()[-1])
+        if command.startswith('docker manifest inspect '):
+            return LocalResult('', command.split()[-1] in self.pushed_images)
+        return LocalResult('', True)
+
+
+def run_fab(args):
+    if sys.version_info[0] != 2:
+        print('ERROR: fabfile.py needs Python 2.')
+        return 1
+
+    scratch = tempfile.mkdtemp(prefix='ecs-worker-benchmark-')
+    cwd = os.getcwd()
+    results = []
+    try:
+        for name in FAB_FILES:
+            source = os.path.join(BASE_DIR, name)
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(scratch, name))
+            else:
+                shutil.copy2(source, scratch)
+        os.chdir(scratch)
+        sys.path.insert(0, scratch)
+        import fabfile
+
+        aws = StandInAWS(args.aws_latency)
+        for service, client in aws.clients.items():
+            fabfile.aws_clients[(service, fabfile.AWS_REGION)] = client
+        fabfile.local = aws.local
+
+        stdout = sys.stdout
+        for title, task, changed in FAB_SCENARIOS:
+            if changed:
+                with open(changed, 'a') as f:
+                    f.write('\n')
+            fabfile.resolution_cache.clear()  # Every fab command starts with an empty one.
+            calls, commands = aws.calls, len(aws.commands)
+            error = None
+            sys.stdout = open(os.devnull, 'w')
+            started = time.time()
+            try:
+                getattr(fabfile, task)()
+            except BaseException as e:  # fabric's abort() raises SystemExit.
+                error = e
+            finally:
+                seconds = time.time() - started
+                sys.stdout.close()
+                sys.stdout = stdout
+            results.append((title, seconds, aws.calls - calls, len(aws.commands) - commands, error))
+        fabfile.resolution_cache_statistics.clear()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+
+    print('AWS API latency: %.3f s per call. Local commands like docker and npm are not run.' % args.aws_latency)
+    print('')
+    print('%-36s %10s %10s %10s' % ('Task', 'Time (s)', 'AWS calls', 'Commands'))
+    for title, seconds, calls, commands, error in results:
+        print('%-36s %10.2f %10d %10d' % (title, seconds, calls, commands))
+    for title, _, _, _, error in results:
+        if error is not None:
+            print('ERROR: ' + title + ' failed: ' + repr(error))
+    return 1 if any(error is not None for _, _, _, _, error in results) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the POV-Ray worker pattern against local stand-ins.')
+    commands = parser.add_subparsers(dest='command')
+
+    pipeline = commands.add_parser('pipeline', help='Upload synthetic scenes and measure how fast they are rendered.')
+    pipeline.add_argument('--scenes', type=int, default=20, help='Number of scene archives to upload.')
+    pipeline.add_argument('--scene-mb', type=float, default=1.0, help='Size of the asset file in each archive.')
+    pipeline.add_argument('--render-seconds', type=float, default=0.5, help='Render time of each scene.')
+    pipeline.add_argument('--render-jitter', type=float, default=0.0,
+                          help='Vary the render time by up to this fraction, e.g. 0.5 for +/- 50%%.')
+    pipeline.add_argument('--upload-rate', type=float, default=0.0, help='Scenes uploaded per second. 0: All at once.')
+    pipeline.add_argument('--asset-cache', action='store_true',
+                          help='Give all scenes the same asset file and turn on the worker\'s asset cache.')
+    pipeline.add_argument('--max-tasks', type=int, default=10, help='max_tasks of the launcher\'s scaling.')
+    pipeline.add_argument('--messages-per-task', type=int, default=1, help='messages_per_task of the scaling.')
+    pipeline.add_argument('--task-cpu', type=int, default=1024, help='CPU shares per task.')
+    pipeline.add_argument('--task-memory', type=int, default=512, help='MB of memory per task.')
+    pipeline.add_argument('--instances', type=int, default=2, help='Number of container instances.')
+    pipeline.add_argument('--instance-cpu', type=int, default=2048, help='CPU shares per container instance.')
+    pipeline.add_argument('--instance-memory', type=int, default=3768, help='MB of memory per container instance.')
+    pipeline.add_argument('--task-start-seconds', type=float, default=0.0, help='Time from RunTask to the worker.')
+    pipeline.add_argument('--poll-seconds', type=int, default=2,
+                          help='Long poll time of the workers, after which they exit if the queue is drained.')
+    pipeline.add_argument('--seed', type=int, default=1, help='Seed for the render time jitter.')
+    pipeline.add_argument('--log', help='File to append the worker and launcher logs to. '
+                          '"fab show_stage_percentiles:path=FILE" prints percentiles from its metrics.')
+
+    fab = commands.add_parser('fab', help='Time the main fab tasks.')
+    fab.add_argument('--aws-latency', type=float, default=0.05, help='Seconds each AWS API call takes.')
+
+    args = parser.parse_args()
+    if args.command == 'fab':
+        return run_fab(args)
+    return run_pipeline(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,583 @@
+// Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+//
+// Licensed under the Apache License, Version 2.0 (the "License").
+// You may not use this file except in compliance with the License.
+// A copy of the License is located at
+//
+//    http://aws.amazon.com/apache2.0/
+//
+// or in the "license" file accompanying this file.
+// This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+// See the License for the specific language governing permissions and limitations under the License.
+
+// Local test harness for the ecs-worker-launcher AWS Lambda function. Runs the handler against in-memory stand-ins for
+// Amazon SQS, Amazon ECS and Amazon S3, so no AWS account is needed. Run it with "fab test_lambda_function" or
+// "node ecs-worker-launcher-harness.js" after "fab update_dependencies".
+//
+// The stand-ins are exported as well, for other local tools that drive the function. With --serve, the harness runs the
+// function for such a tool instead of the tests, see serve().
+
+var assert = require('assert');
+var fs = require('fs');
+var os = require('os');
+var path = require('path');
+var Module = require('module');
+
+// Stand-in for the Amazon SQS calls the function makes. Messages without a QueueUrl, and the inFlight count, belong to
+// queueUrl.
+function StubSQS(queueUrl) {
+    this.queueUrl = queueUrl;
+    this.messages = [];
+    this.inFlight = 0;
+    this.calls = {sendMessageBatch: 0, getQueueAttributes: 0};
+    this.failNext = 0;  // Number of entries to report as failed in the next sendMessageBatch call.
+}
+
+StubSQS.prototype.sendMessageBatch = function (params, callback) {
+    this.calls.sendMessageBatch++;
+    assert.ok(params.Entries.length >= 1 && params.Entries.length <= 10, 'Batch size must be between 1 and 10.');
+    var bytes = params.Entries.reduce(function (sum, e) { return sum + Buffer.byteLength(e.MessageBody); }, 0);
+    assert.ok(bytes <= 256 * 1024, 'Batch payload must be at most 256 KB, is ' + bytes + ' bytes.');
+    var self = this;
+    var result = {Successful: [], Failed: []};
+    params.Entries.forEach(function (entry, i) {
+        if (i < self.failNext) {
+            result.Failed.push({Id: entry.Id, SenderFault: false, Code: 'InternalError', Message: 'Stub failure'});
+        } else {
+            var id = 'message-' + self.messages.length;
+            self.messages.push({MessageId: id, QueueUrl: params.QueueUrl, Body: entry.MessageBody});
+            result.Successful.push({Id: entry.Id, MessageId: id});
+        }
+    });
+    this.failNext = 0;
+    setImmediate(callback, null, result);
+};
+
+StubSQS.prototype.getQueueAttributes = function (params, callback) {
+    this.calls.getQueueAttributes++;
+    var self = this;
+    var visible = this.messages.filter(function (m) { return (m.QueueUrl || self.queueUrl) == params.QueueUrl; });
+    setImmediate(callback, null, {Attributes: {
+        ApproximateNumberOfMessages: String(visible.length),
+        ApproximateNumberOfMessagesNotVisible: String(params.QueueUrl == this.queueUrl ? this.inFlight : 0)
+    }});
+};
+
+// Stand-in for the Amazon ECS calls the function makes. Each instance is {cpu: ..., memory: ...} of free capacity.
+// Tasks take taskCpu and taskMemory, unless sizes has the {cpu: ..., memory: ...} of their task definition.
+function StubECS(instances, taskCpu, taskMemory) {
+    this.instances = instances;
+    this.taskCpu = taskCpu;
+    this.taskMemory = taskMemory;
+    this.sizes = {};
+    this.tasks = [];
+    this.runTaskCalls = [];
+}
+
+StubECS.prototype.listTasks = function (params, callback) {
+    var arns = this.tasks.filter(function (t) { return t.family == params.family; }).map(function (t) { return t.arn; });
+    setImmediate(callback, null, {taskArns: arns});
+};
+
+StubECS.prototype.listContainerInstances = function (params, callback) {
+    setImmediate(callback, null, {containerInstanceArns: this.instances.map(function (i, n) { return 'instance-' + n; })});
+};
+
+StubECS.prototype.describeContainerInstances = function (params, callback) {
+    var self = this;
+    setImmediate(callback, null, {containerInstances: params.containerInstances.map(function (arn) {
+        var i = self.instances[parseInt(arn.split('-')[1], 10)];
+        return {
+            containerInstanceArn: arn,
+            status: 'ACTIVE',
+            agentConnected: true,
+            remainingResources: [{name: 'CPU', integerValue: i.cpu}, {name: 'MEMORY', integerValue: i.memory}]
+        };
+    })});
+};
+
+StubECS.prototype.runTask = function (params, callback) {
+    this.runTaskCalls.push(params);
+    var size = this.sizes[params.taskDefinition] || {cpu: this.taskCpu, memory: this.taskMemory};
+    var started = [];
+    for (var n = 0; n < params.count; n++) {
+        var instance = null;
+        for (var i = 0; i < this.instances.length && !instance; i++) {
+            if (this.instances[i].cpu >= size.cpu && this.instances[i].memory >= size.memory) {
+                instance = this.instances[i];
+            }
+        }
+        if (!instance) { break; }
+        instance.cpu -= size.cpu;
+        instance.memory -= size.memory;
+        var task = {arn: 'task-' + this.tasks.length, family: params.taskDefinition, cluster: params.cluster};
+        this.tasks.push(task);
+        started.push({taskArn: task.arn});
+    }
+    setImmediate(callback, null, {tasks: started, failures: []});
+};
+
+// Stand-in for the Amazon S3 calls the function makes. objects maps 'bucket/key' to the body of each object, metadata
+// to the user metadata of each object.
+function StubS3(objects) {
+    this.objects = objects || {};
+    this.metadata = {};
+    this.calls = {getObject: 0, headObject: 0};
+}
+
+StubS3.prototype.headObject = function (params, callback) {
+    this.calls.headObject++;
+    setImmediate(callback, null, {Metadata: this.metadata[params.Bucket + '/' + params.Key] || {}});
+};
+
+StubS3.prototype.getObject = function (params, callback) {
+    this.calls.getObject++;
+    var body = this.objects[params.Bucket + '/' + params.Key];
+    if (body === undefined) {
+        var err = new Error('The specified key does not exist.');
+        err.code = 'NoSuchKey';
+        return setImmediate(callback, err);
+    }
+    setImmediate(callback, null, {Body: new Buffer(body)});
+};
+
+exports.StubSQS = StubSQS;
+exports.StubECS = StubECS;
+exports.StubS3 = StubS3;
+
+// Load the launcher with its aws-sdk replaced by the given stand-ins.
+exports.loadLauncher = function (stubs) {
+    var launcherPath = path.join(__dirname, 'ecs-worker-launcher', 'ecs-worker-launcher.js');
+    var load = Module._load;
+    Module._load = function (request) {
+        if (request == 'aws-sdk') {
+            return {
+                SQS: function () { return stubs.sqs; },
+                ECS: function () { return stubs.ecs; },
+                S3: function () { return stubs.s3; }
+            };
+        }
+        return load.apply(this, arguments);
+    };
+    try {
+        delete require.cache[require.resolve(launcherPath)];
+        return require(launcherPath);
+    } finally {
+        Module._load = load;
+    }
+};
+
+exports.makeS3Record = function (bucket, key) {
+    return {
+        eventSource: 'aws:s3',
+        eventName: 'ObjectCreated:Put',
+        s3: {bucket: {name: bucket, arn: 'arn:aws:s3:::' + bucket}, object: {key: key, size: 1024}}
+    };
+};
+
+// Invoke the handler like AWS Lambda does. Calls back with (error, result) from context.fail() or context.succeed().
+exports.invoke = function (launcher, event, callback) {
+    launcher.handler(event, {
+        succeed: function (result) { callback(null, result); },
+        fail: function (error) { callback(error); }
+    });
+};
+
+// Run the function for a local tool that keeps the state of SQS and ECS itself, like ecs-worker-benchmark.py. Reads one
+// JSON request per line from input: {config: ..., event: ..., state: {visible, inFlight, running, instances}}, with
+// the queue depth, the number of running tasks and the free {cpu, memory} of each container instance. Requests may also
+// have profiles: {'bucket/key': ...}, the render profiles in S3. Writes one JSON reply per line to output, in the same
+// order: {error: ..., result: ..., messages: [...], started: ..., tasks: {...}}, with the bodies of the messages the
+// function sent, the number of tasks it started and those per task definition.
+exports.serve = function (input, output) {
+    var stubs = {sqs: new StubSQS(''), ecs: new StubECS([], 0, 0), s3: new StubS3()};
+    var launcher = exports.loadLauncher(stubs);
+    var requests = [];
+    var busy = false;
+
+    function next() {
+        if (busy || !requests.length) { return; }
+        busy = true;
+        var request = requests.shift();
+        var state = request.state;
+        var scaling = request.config.scaling;
+        StubSQS.call(stubs.sqs, launcher.getDefaultLane(request.config).queue);
+        StubECS.call(stubs.ecs, state.instances, scaling.task_cpu, scaling.task_memory);
+        StubS3.call(stubs.s3, request.profiles);
+        launcher.getSizeClasses(request.config).forEach(function (sizeClass) {
+            stubs.ecs.sizes[sizeClass.task] = {cpu: sizeClass.cpu, memory: sizeClass.memory};
+        });
+        stubs.sqs.inFlight = state.inFlight;
+        for (var i = 0; i < state.visible; i++) { stubs.sqs.messages.push({MessageId: 'queued-' + i, Body: '{}'}); }
+        for (var j = 0; j < state.running; j++) {
+            stubs.ecs.tasks.push({arn: 'running-' + j, family: launcher.getDefaultSizeClass(request.config).task});
+        }
+        launcher.config = request.config;
+        exports.invoke(launcher, request.event, function (err, result) {
+            var tasks = {};
+            stubs.ecs.tasks.slice(state.running).forEach(function (task) {
+                tasks[task.family] = (tasks[task.family] || 0) + 1;
+            });
+            output.write(JSON.stringify({
+                error: err ? String(err) : null,
+                result: result,
+                messages: stubs.sqs.messages.slice(state.visible).map(function (m) { return m.Body; }),
+                started: stubs.ecs.tasks.length - state.running,
+                tasks: tasks
+            }) + '\n');
+            busy = false;
+            next();
+        });
+    }
+
+    require('readline').createInterface({input: input}).on('line', function (line) {
+        requests.push(JSON.parse(line));
+        next();
+    });
+};
+
+var CONFIG = {
+    queue: 'https://queue.amazonaws.com/123456789012/HarnessQueue',
+    task: 'HarnessTask',
+    cluster: 'harness-cluster',
+    s3_key_suffix_whitelist: ['.zip'],
+    scaling: {min_tasks: 0, max_tasks: 4, messages_per_task: 1, task_cpu: 512, task_memory: 512}
+};
+
+var SIZED_CONFIG = JSON.parse(JSON.stringify(CONFIG));
+SIZED_CONFIG.size_classes = [
+    {name: 'small', task: 'HarnessTask-small', cpu: 512, memory: 512},
+    {name: 'large', task: 'HarnessTask-large', cpu: 2048, memory: 2048}
+];
+SIZED_CONFIG.default_size_class = 'small';
+SIZED_CONFIG.profiles = {
+    prefix: '.ecs-worker/profiles/',
+    memory_headroom: 1.25,
+    memory_overhead: 128,
+    target_seconds: 300
+};
+
+var LANED_CONFIG = JSON.parse(JSON.stringify(CONFIG));
+LANED_CONFIG.lanes = [
+    {name: 'interactive', queue: CONFIG.queue + '-interactive', weight: 6, prefixes: ['previews/'], max_size: 1048576},
+    {name: 'standard', queue: CONFIG.queue, weight: 3, prefixes: [], max_size: 0},
+    {name: 'bulk', queue: CONFIG.queue + '-bulk', weight: 1, prefixes: ['bulk/'], max_size: 0}
+];
+LANED_CONFIG.default_lane = 'standard';
+LANED_CONFIG.lane_metadata = 'lane';
+
+function setUp() {
+    var stubs = {
+        sqs: new StubSQS(CONFIG.queue),
+        ecs: new StubECS([{cpu: 2048, memory: 2048}, {cpu: 1024, memory: 1024}], 512, 512),
+        s3: new StubS3()
+    };
+    stubs.ecs.sizes = {'HarnessTask-small': {cpu: 512, memory: 512}, 'HarnessTask-large': {cpu: 2048, memory: 2048}};
+    return {stubs: stubs, launcher: exports.loadLauncher(stubs)};
+}
+
+var TESTS = {
+    'forwards every whitelisted record in batches of 10': function (done) {
+        var t = setUp();
+        t.launcher.config = CONFIG;
+        var records = [];
+        for (var i = 0; i < 23; i++) { records.push(exports.makeS3Record('bucket', 'scene-' + i + '.zip')); }
+        records.push(exports.makeS3Record('bucket', 'scene.png'));
+        exports.invoke(t.launcher, {Records: records}, function (err) {
+            assert.ifError(err);
+            assert.equal(t.stubs.sqs.calls.sendMessageBatch, 3);
+            assert.equal(t.stubs.sqs.messages.length, 23);
+            t.stubs.sqs.messages.forEach(function (m, n) {
+                var body = JSON.parse(m.Body);
+                assert.equal(body.Version, 1);
+                assert.equal(body.Jobs.length, 1);
+                assert.equal(body.Jobs[0].key, 'scene-' + n + '.zip');
+            });
+            done();
+        });
+    },
+
+    'packs jobs into compact messages': function (done) {
+        var t = setUp();
+        t.launcher.config = JSON.parse(JSON.stringify(CONFIG));
+        t.launcher.config.jobs_per_message = 10;
+        var records = [];
+        for (var i = 0; i < 23; i++) {
+            var record = exports.makeS3Record('bucket', 'shots/scene+' + i + '%281%29.zip');
+            record.s3.object.eTag = 'etag-' + i;
+            record.s3.object.versionId = 'version-' + i;
+            record.s3.object.sequencer = '00000' + i;
+            records.push(record);
+        }
+        exports.invoke(t.launcher, {Records: records}, function (err) {
+            assert.ifError(err);
+            assert.equal(t.stubs.sqs.calls.sendMessageBatch, 1);
+            var bodies = t.stubs.sqs.messages.map(function (m) { return JSON.parse(m.Body); });
+            assert.deepEqual(bodies.map(function (b) { return b.Jobs.length; }), [10, 10, 3]);
+            assert.deepEqual(bodies[2].Jobs[2], {
+                bucket: 'bucket',
+                key: 'shots/scene 22(1).zip',
+                version_id: 'version-22',
+                etag: 'etag-22',
+                size: 1024,
+                sequencer: '0000022'
+            });
+            assert.equal(t.stubs.ecs.runTaskCalls[0].count, 3);  // One task per message.
+            done();
+        });
+    },
+
+    'keeps job messages and batches within the SQS size limit': function (done) {
+        var t = setUp();
+        t.launcher.config = JSON.parse(JSON.stringify(CONFIG));
+        t.launcher.config.jobs_per_message = 1000;
+        var long = new Array(1000).join('x');
+        var records = [];
+        for (var i = 0; i < 300; i++) { records.push(exports.makeS3Record('bucket', long + i + '.zip')); }
+        exports.invoke(t.launcher, {Records: records}, function (err) {
+            assert.ifError(err);
+            assert.equal(t.stubs.sqs.messages.length, 2);
+            assert.equal(t.stubs.sqs.calls.sendMessageBatch, 2);
+            var jobs = 0;
+            t.stubs.sqs.messages.forEach(function (m) {
+                assert.ok(Buffer.byteLength(m.Body) <= 256 * 1024);
+                jobs += JSON.parse(m.Body).Jobs.length;
+            });
+            assert.equal(jobs, 300);
+            done();
+        });
+    },
+
+    'skips events without whitelisted records': function (done) {
+        var t = setUp();
+        t.launcher.config = CONFIG;
+        exports.invoke(t.launcher, {Records: [exports.makeS3Record('bucket', 'scene.png')]}, function (err) {
+            assert.ifError(err);
+            assert.equal(t.stubs.sqs.calls.sendMessageBatch, 0);
+            assert.equal(t.stubs.ecs.runTaskCalls.length, 0);
+            done();
+        });
+    },
+
+    'starts only the missing tasks, in the configured cluster': function (done) {
+        var t = setUp();
+        t.launcher.config = CONFIG;
+        t.stubs.ecs.tasks.push({arn: 'task-running', family: CONFIG.task});
+        var records = [];
+        for (var i = 0; i < 10; i++) { records.push(exports.makeS3Record('bucket', 'scene-' + i + '.zip')); }
+        exports.invoke(t.launcher, {Records: records}, function (err) {
+            assert.ifError(err);
+            assert.equal(t.stubs.ecs.runTaskCalls.length, 1);
+            assert.equal(t.stubs.ecs.runTaskCalls[0].cluster, CONFIG.cluster);
+            assert.equal(t.stubs.ecs.runTaskCalls[0].count, 3);  // max_tasks 4, minus the one already running.
+            done();
+        });
+    },
+
+    'starts tasks for jobs queued by workers': function (done) {
+        var t = setUp();
+        t.launcher.config = CONFIG;
+        for (var i = 0; i < 3; i++) { t.stubs.sqs.messages.push({MessageId: 'tile-' + i, Body: '{}'}); }
+        exports.invoke(t.launcher, {ScaleWorkers: true}, function (err) {
+            assert.ifError(err);
+            assert.equal(t.stubs.sqs.calls.sendMessageBatch, 0);
+            assert.equal(t.stubs.ecs.runTaskCalls.length, 1);
+            assert.equal(t.stubs.ecs.runTaskCalls[0].count, 3);
+            done();
+        });
+    },
+
+    'picks the size class of each job from the render profile of its scene family': function (done) {
+        var t = setUp();
+        t.launcher.config = SIZED_CONFIG;
+        t.stubs.s3.objects['bucket/.ecs-worker/profiles/shots/heavy.json'] = JSON.stringify({samples: [
+            {peak_memory: 900, cpu_seconds: 120}, {peak_memory: 1200, cpu_seconds: 150}
+        ]});
+        var records = ['shots/heavy-010.zip', 'shots/heavy-020.zip', 'light.zip'].map(function (key) {
+            return exports.makeS3Record('bucket', key);
+        });
+        exports.invoke(t.launcher, {Records: records}, function (err) {
+            assert.ifError(err);
+            var classes = t.stubs.sqs.messages.map(function (m) {
+                return JSON.parse(m.Body).Jobs[0].options.size_class;
+            });
+            assert.deepEqual(classes.map(function (c) { return c.name; }), ['large', 'large', 'small']);
+            assert.equal(classes[0].memory, 2048);
+            assert.equal(t.stubs.s3.calls.getObject, 2);  // One per scene family.
+
+            // Only one large task fits. It goes first, on the first instance, and the small task on the second.
+            var started = {};
+            t.stubs.ecs.runTaskCalls.forEach(function (c) { started[c.taskDefinition] = c.count; });
+            assert.deepEqual(started, {'HarnessTask-small': 1, 'HarnessTask-large': 1});
+            assert.equal(t.stubs.ecs.tasks.length, 2);
+            done();
+        });
+    },
+
+    'starts tasks of the size class of jobs queued by workers': function (done) {
+        var t = setUp();
+        t.launcher.config = SIZED_CONFIG;
+        t.stubs.ecs.tasks.push({arn: 'task-running', family: 'HarnessTask-large'});
+        for (var i = 0; i < 3; i++) { t.stubs.sqs.messages.push({MessageId: 'tile-' + i, Body: '{}'}); }
+        exports.invoke(t.launcher, {ScaleWorkers: true, Jobs: {large: 3}}, function (err) {
+            assert.ifError(err);
+            assert.equal(t.stubs.ecs.runTaskCalls.length, 1);
+            assert.equal(t.stubs.ecs.runTaskCalls[0].taskDefinition, 'HarnessTask-large');
+            assert.equal(t.stubs.ecs.runTaskCalls[0].count, 1);  // Only one of the two missing tasks fits.
+            done();
+        });
+    },
+
+    'routes each record to a lane by metadata, key prefix or size': function (done) {
+        var t = setUp();
+        t.launcher.config = LANED_CONFIG;
+        t.stubs.s3.metadata['bucket/hinted.zip'] = {lane: 'bulk'};
+        var routes = {
+            'previews/large.zip': 'interactive',
+            'small.zip': 'interactive',
+            'large.zip': 'standard',
+            'bulk/small.zip': 'bulk',
+            'hinted.zip': 'bulk'
+        };
+        var records = Object.keys(routes).map(function (key) {
+            var record = exports.makeS3Record('bucket', key);
+            record.s3.object.size = key.indexOf('large') >= 0 ? 5 * 1048576 : 1024;
+            return record;
+        });
+        exports.invoke(t.launcher, {Records: records}, function (err) {
+            assert.ifError(err);
+            assert.equal(t.stubs.s3.calls.headObject, records.length);
+            assert.equal(t.stubs.sqs.messages.length, records.length);
+            t.stubs.sqs.messages.forEach(function (m) {
+                var key = JSON.parse(m.Body).Jobs[0].key;
+                assert.equal(m.QueueUrl, CONFIG.queue + (routes[key] == 'standard' ? '' : '-' + routes[key]), key);
+            });
+            done();
+        });
+    },
+
+    'scales workers by the messages in all lanes': function (done) {
+        var t = setUp();
+        t.launcher.config = LANED_CONFIG;
+        LANED_CONFIG.lanes.forEach(function (lane) {
+            t.stubs.sqs.messages.push({MessageId: lane.name, QueueUrl: lane.queue, Body: '{}'});
+        });
+        exports.invoke(t.launcher, {ScaleWorkers: true}, function (err) {
+            assert.ifError(err);
+            assert.equal(t.stubs.sqs.calls.getQueueAttributes, 3);
+            assert.equal(t.stubs.ecs.runTaskCalls.length, 1);
+            assert.equal(t.stubs.ecs.runTaskCalls[0].count, 3);
+            done();
+        });
+    },
+
+    'logs one line of metrics per invocation': function (done) {
+        var t = setUp();
+        t.launcher.config = CONFIG;
+        var lines = [];
+        var consoleLog = console.log;
+        console.log = function (line) { lines.push(line); };
+        var records = [exports.makeS3Record('bucket', 'scene.zip'), exports.makeS3Record('bucket', 'scene.png')];
+        exports.invoke(t.launcher, {Records: records}, function (err) {
+            console.log = consoleLog;
+            assert.ifError(err);
+            var metrics = lines.filter(function (l) { return l.charAt(0) == '{'; }).map(JSON.parse);
+            assert.equal(metrics.length, 1);
+            assert.equal(metrics[0].Event, 'launch');
+            assert.equal(metrics[0].Records, 1);
+            assert.equal(metrics[0].MessagesSent, 1);
+            assert.equal(metrics[0].TasksStarted, 1);
+            var names = metrics[0]._aws.CloudWatchMetrics[0].Metrics.map(function (m) { return m.Name; });
+            assert.deepEqual(names, ['LaunchSeconds', 'MessagesSent', 'Records', 'TasksStarted']);
+            done();
+        });
+    },
+
+    'counts messages, not records, as sent': function (done) {
+        var t = setUp();
+        t.launcher.config = JSON.parse(JSON.stringify(CONFIG));
+        t.launcher.config.jobs_per_message = 2;
+        var lines = [];
+        var consoleLog = console.log;
+        console.log = function (line) { lines.push(line); };
+        var records = ['a.zip', 'b.zip', 'c.zip'].map(function (key) { return exports.makeS3Record('bucket', key); });
+        exports.invoke(t.launcher, {Records: records}, function (err) {
+            console.log = consoleLog;
+            assert.ifError(err);
+            var metrics = lines.filter(function (l) { return l.charAt(0) == '{'; }).map(JSON.parse);
+            assert.equal(metrics[0].Records, 3);
+            assert.equal(metrics[0].MessagesSent, t.stubs.sqs.messages.length);
+            assert.equal(metrics[0].MessagesSent, 2);
+            done();
+        });
+    },
+
+    'fails when messages could not be sent': function (done) {
+        var t = setUp();
+        t.launcher.config = CONFIG;
+        t.stubs.sqs.failNext = 1;
+        exports.invoke(t.launcher, {Records: [exports.makeS3Record('bucket', 'scene.zip')]}, function (err) {
+            assert.ok(err);
+            assert.equal(t.stubs.ecs.runTaskCalls.length, 0);
+            done();
+        });
+    },
+
+    'reads config.json once per container': function (done) {
+        var t = setUp();
+        var dir = fs.mkdtempSync(path.join(os.tmpdir(), 'ecs-worker-launcher-'));
+        fs.writeFileSync(path.join(dir, 'config.json'), JSON.stringify(CONFIG));
+        var cwd = process.cwd();
+        var readFileSync = fs.readFileSync;
+        var reads = 0;
+        fs.readFileSync = function () { reads++; return readFileSync.apply(fs, arguments); };
+        process.chdir(dir);
+
+        function finish(err) {
+            fs.readFileSync = readFileSync;
+            process.chdir(cwd);
+            fs.unlinkSync(path.join(dir, 'config.json'));
+            fs.rmdirSync(dir);
+            done(err);
+        }
+
+        var event = {Records: [exports.makeS3Record('bucket', 'scene.zip')]};
+        exports.invoke(t.launcher, event, function (err) {
+            if (err) { return finish(err); }
+            exports.invoke(t.launcher, event, function (err) {
+                if (!err) {
+                    try { assert.equal(reads, 1); } catch (e) { err = e; }
+                }
+                finish(err);
+            });
+        });
+    }
+};
+
+if (require.main === module && process.argv[2] == '--serve') {
+    // Replies go to stdout, so the function's own logging goes to stderr.
+    console.log = console.info = console.warn = console.error;
+    exports.serve(process.stdin, process.stdout);
+} else if (require.main === module) {
+    var names = Object.keys(TESTS);
+    var failed = 0;
+    var log = console.log, info = console.info, warn = console.warn;
+    (function next(i) {
+        if (i == names.length) {
+            console.log((names.length - failed) + ' passed, ' + failed + ' failed.');
+            process.exit(failed ? 1 : 0);
+        }
+        // Keep the function's own logging out of the test report.
+        console.log = console.info = console.warn = function () {};
+        var finished = false;
+        function report(err) {
+            if (finished) { return; }
+            finished = true;
+            console.log = log; console.info = info; console.warn = warn;
+            if (err) { failed++; log('FAIL: ' + names[i] + ': ' + (err.stack || err)); }
+            else { log('ok: ' + names[i]); }
+            next(i + 1);
+        }
+        try { TESTS[names[i]](report); } catch (e) { report(e); }
+    })(0);
+}
@@ -10,14 +10,56 @@
 // This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 // See the License for the specific language governing permissions and limitations under the License.
 
-// This AWS Lambda function forwards the given event data into an Amazon SQS queue, then starts an Amazon ECS task to
-// process that event.
+// This AWS Lambda function forwards the records of the given event into an Amazon SQS queue, then starts as many Amazon
+// ECS tasks as are missing to work through the queue.
+//
+// With size classes in the configuration, each class is a task definition of its own, with more or less CPU and memory.
+// The function picks the class of each job from the render profile of its scene family, which the workers keep in the
+// job's bucket, and starts tasks of the classes of the jobs it sent.
+//
+// With lanes in the configuration, each lane is a queue of its own, like interactive, standard and bulk. Each record
+// goes to the lane named in its object's metadata, or else to a lane by key prefix or object size. Workers poll the
+// lanes by weight, and the function scales them by the messages in all lanes together.
+//
+// Messages are job messages, {"Version": 1, "Jobs": [...]}, with the bucket, key, version ID, ETag, size and S3 event
+// sequencer of each object, and options like its size class. Jobs of the same lane and size class are packed into one
+// message, up to jobs_per_message of them and the SQS limit of 256 KB per message.
 
 var fs = require('fs');
 var async = require('async');
 var aws = require('aws-sdk');
 var sqs = new aws.SQS({apiVersion: '2012-11-05'});
 var ecs = new aws.ECS({apiVersion: '2014-11-13'});
+var s3 = new aws.S3({apiVersion: '2006-03-01'});
+
+// Milliseconds a render profile read from Amazon S3 is reused by later invocations in the same container.
+var PROFILE_TTL = 60 * 1000;
+
+// Version of the job messages, see getJob(). The worker sends messages of versions it doesn't know to the dead-letter
+// queue, from where they can be replayed once it has been updated.
+var JOB_SCHEMA_VERSION = 1;
+
+// Largest message, and largest total of the messages of one SendMessageBatch call, that Amazon SQS accepts, in bytes.
+var MAX_MESSAGE_BYTES = 256 * 1024;
+
+// Read once per container, on the first invocation. See loadConfig().
+exports.config = null;
+
+// Render profiles by bucket and key: {profile: ..., read: time}. See getProfile().
+exports.profiles = {};
+
+// Return the function's configuration from config.json.
+exports.loadConfig = function() {
+    if (!exports.config) {
+        var config = JSON.parse(fs.readFileSync('config.json', 'utf8'));
+        if(!config.hasOwnProperty('s3_key_suffix_whitelist')) {
+            config.s3_key_suffix_whitelist = false;
+        }
+        console.log('Config: ' + JSON.stringify(config));
+        exports.config = config;
+    }
+    return exports.config;
+};
 
 // Check if the given key suffix matches a suffix in the whitelist. Return true if it matches, false otherwise.
 exports.checkS3SuffixWhitelist = function(key, whitelist) {
@@ -36,55 +78,511 @@ exports.checkS3SuffixWhitelist = function(key, whitelist) {
     return false;
 };
 
+// Return the item lists of all pages of a paginated Amazon ECS list call, concatenated.
+function listAll(client, method, params, resultKey, callback) {
+    var items = [];
+    (function nextPage(token) {
+        var p = {};
+        for (var k in params) {
+            if (params.hasOwnProperty(k)) { p[k] = params[k]; }
+        }
+        if (token) { p.nextToken = token; }
+        client[method](p, function (err, data) {
+            if (err) { return callback(err); }
+            items = items.concat(data[resultKey] || []);
+            if (data.nextToken) { nextPage(data.nextToken); }
+            else { callback(null, items); }
+        });
+    })();
+}
+
+function getResource(resources, name) {
+    for (var i = 0; i < (resources || []).length; i++) {
+        if (resources[i].name == name) { return resources[i].integerValue; }
+    }
+    return 0;
+}
+
+// Return the size classes of the worker tasks, smallest first. Without size classes in the configuration, there is one:
+// the configured task, with the CPU and memory of the scaling settings.
+exports.getSizeClasses = function(config) {
+    if (config.size_classes && config.size_classes.length) { return config.size_classes; }
+    return [{name: 'default', task: config.task, cpu: config.scaling.task_cpu, memory: config.scaling.task_memory}];
+};
+
+// Return the size class of jobs without a render profile.
+exports.getDefaultSizeClass = function(config) {
+    var classes = exports.getSizeClasses(config);
+    for (var i = 0; i < classes.length; i++) {
+        if (classes[i].name == config.default_size_class) { return classes[i]; }
+    }
+    return classes[0];
+};
+
+// Return an S3 key from an event record, which has it URL encoded, as it is.
+exports.decodeKey = function(key) {
+    key = key.replace(/\+/g, ' ');
+    try { key = decodeURIComponent(key); } catch (e) { console.warn('Could not decode key: ' + key); }
+    return key;
+};
+
+// Return the scene family of an S3 key, like the worker does: the key without its extension and trailing numbers.
+exports.getSceneFamily = function(key) {
+    var base = exports.decodeKey(key).replace(/\.[^.\/]*$/, '');
+    return base.replace(/[-_. ]*\d+$/, '') || base;
+};
+
+// Call back with the render profile of a scene family, or null if there is none yet. A profile that can't be read
+// counts as none, so that the job still goes out, with the default size class.
+exports.getProfile = function(clients, config, bucket, family, callback) {
+    var key = config.profiles.prefix + family + '.json';
+    var cached = exports.profiles[bucket + '/' + key];
+    if (cached && Date.now() - cached.read < PROFILE_TTL) { return callback(null, cached.profile); }
+    clients.s3.getObject({Bucket: bucket, Key: key}, function (err, data) {
+        var profile = null;
+        if (err) {
+            if (err.code != 'NoSuchKey') { console.warn('Could not read render profile ' + key + ': ' + err); }
+        } else {
+            try { profile = JSON.parse(data.Body.toString('utf8')); }
+            catch (e) { console.warn('Could not parse render profile ' + key + ': ' + e); }
+        }
+        exports.profiles[bucket + '/' + key] = {profile: profile, read: Date.now()};
+        callback(null, profile);
+    });
+};
+
+// Return the smallest size class with enough memory for the largest peak memory in a render profile, plus headroom and
+// the worker's own memory, and with enough CPUs to do the most CPU seconds in the profile within the target time.
+// Jobs without a profile get the default class, jobs that need more than the largest class get the largest.
+exports.pickSizeClass = function(config, profile) {
+    var classes = exports.getSizeClasses(config);
+    var samples = (profile && profile.samples) || [];
+    if (!samples.length) { return exports.getDefaultSizeClass(config); }
+
+    var memory = 0, cpuSeconds = 0;
+    samples.forEach(function (sample) {
+        memory = Math.max(memory, sample.peak_memory || 0);
+        cpuSeconds = Math.max(cpuSeconds, sample.cpu_seconds || 0);
+    });
+    memory = memory * config.profiles.memory_headroom + config.profiles.memory_overhead;
+    for (var i = 0; i < classes.length; i++) {
+        if (classes[i].memory >= memory && classes[i].cpu / 1024 * config.profiles.target_seconds >= cpuSeconds) {
+            return classes[i];
+        }
+    }
+    return classes[classes.length - 1];
+};
+
+// Call back with the size class of each record, in the same order. All null without size classes in the configuration.
+// The profile of each scene family is read once, however many of its records there are.
+exports.sizeRecords = function(clients, config, records, callback) {
+    if (!config.size_classes || !config.size_classes.length) {
+        return callback(null, records.map(function () { return null; }));
+    }
+    var families = {};  // 'bucket/family' -> [bucket, family]
+    var keys = records.map(function (record) {
+        var family = exports.getSceneFamily(record.s3.object.key);
+        var key = record.s3.bucket.name + '/' + family;
+        families[key] = [record.s3.bucket.name, family];
+        return key;
+    });
+    var unique = Object.keys(families);
+    async.mapLimit(unique, 10, function (key, next) {
+        exports.getProfile(clients, config, families[key][0], families[key][1], next);
+    }, function (err, profiles) {
+        if (err) { return callback(err); }
+        var sizeClasses = {};
+        unique.forEach(function (key, i) { sizeClasses[key] = exports.pickSizeClass(config, profiles[i]); });
+        callback(null, keys.map(function (key) { return sizeClasses[key]; }));
+    });
+};
+
+// Return the lanes, highest priority first. Without lanes in the configuration, there is one: the configured queue.
+exports.getLanes = function(config) {
+    if (config.lanes && config.lanes.length) { return config.lanes; }
+    return [{name: '', queue: config.queue, weight: 1, prefixes: [], max_size: 0}];
+};
+
+// Return the lane of records that no hint, key prefix or object size routes to another one.
+exports.getDefaultLane = function(config) {
+    var lanes = exports.getLanes(config);
+    for (var i = 0; i < lanes.length; i++) {
+        if (lanes[i].name == config.default_lane) { return lanes[i]; }
+    }
+    return lanes[0];
+};
+
+// Return the lane of a record: the lane named by hint, which comes from the object's metadata, or else the first lane
+// with a key prefix the key starts with, or else the first lane with a size limit the object is within, or else the
+// default lane.
+exports.routeRecord = function(config, record, hint) {
+    var lanes = exports.getLanes(config);
+    var key = exports.decodeKey(record.s3.object.key);
+    var size = record.s3.object.size || 0;
+    var i;
+    for (i = 0; i < lanes.length; i++) {
+        if (hint && lanes[i].name == hint) { return lanes[i]; }
+    }
+    if (hint) { console.warn('Unknown lane ' + hint + ' for key: ' + key + ', routing it by key and size.'); }
+    function hasPrefixOf(lane) {
+        return (lane.prefixes || []).some(function (prefix) { return key.indexOf(prefix) === 0; });
+    }
+    for (i = 0; i < lanes.length; i++) {
+        if (hasPrefixOf(lanes[i])) { return lanes[i]; }
+    }
+    for (i = 0; i < lanes.length; i++) {
+        if (lanes[i].max_size && size <= lanes[i].max_size) { return lanes[i]; }
+    }
+    return exports.getDefaultLane(config);
+};
+
+// Call back with the lane of each record, in the same order. The lane hints are read from the objects' metadata,
+// under lane_metadata, if it is configured and there is more than one lane. An object whose metadata can't be read is
+// routed without a hint.
+exports.routeRecords = function(clients, config, records, callback) {
+    if (exports.getLanes(config).length < 2 || !config.lane_metadata) {
+        return callback(null, records.map(function (record) { return exports.routeRecord(config, record, null); }));
+    }
+    async.mapLimit(records, 10, function (record, next) {
+        var key = exports.decodeKey(record.s3.object.key);
+        clients.s3.headObject({Bucket: record.s3.bucket.name, Key: key}, function (err, data) {
+            if (err) { console.warn('Could not read the metadata of ' + key + ': ' + err); }
+            var hint = (!err && data.Metadata && data.Metadata[config.lane_metadata]) || null;
+            next(null, exports.routeRecord(config, record, hint));
+        });
+    }, callback);
+};
+
+// Collect what the scaling decision is based on: the depth of all lanes, the number of running (or pending) worker
+// tasks of all size classes and the remaining CPU and memory of each active container instance in the cluster.
+exports.getScalingState = function(clients, config, callback) {
+    async.parallel({
+        queue: function (next) {
+            async.map(exports.getLanes(config), function (lane, done) {
+                clients.sqs.getQueueAttributes({
+                    QueueUrl: lane.queue,
+                    AttributeNames: ['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+                }, done);
+            }, function (err, results) {
+                if (err) { return next(err); }
+                var depth = {visible: 0, inFlight: 0};
+                results.forEach(function (data) {
+                    depth.visible += parseInt(data.Attributes.ApproximateNumberOfMessages, 10);
+                    depth.inFlight += parseInt(data.Attributes.ApproximateNumberOfMessagesNotVisible, 10);
+                });
+                next(null, depth);
+            });
+        },
+        running: function (next) {
+            async.map(exports.getSizeClasses(config), function (sizeClass, done) {
+                listAll(clients.ecs, 'listTasks', {cluster: config.cluster, family: sizeClass.task}, 'taskArns',
+                    function (err, tasks) { done(err, tasks && tasks.length); });
+            }, function (err, counts) {
+                next(err, counts && counts.reduce(function (sum, n) { return sum + n; }, 0));
+            });
+        },
+        instances: function (next) {
+            listAll(clients.ecs, 'listContainerInstances', {cluster: config.cluster}, 'containerInstanceArns',
+                function (err, arns) {
+                    if (err) { return next(err); }
+                    var batches = [];
+                    for (var i = 0; i < arns.length; i += 100) { batches.push(arns.slice(i, i + 100)); }
+                    var instances = [];
+                    async.eachSeries(batches, function (batch, done) {
+                        clients.ecs.describeContainerInstances(
+                            {cluster: config.cluster, containerInstances: batch},
+                            function (err, data) {
+                                if (err) { return done(err); }
+                                data.containerInstances.forEach(function (ci) {
+                                    if (ci.status == 'ACTIVE' && ci.agentConnected) {
+                                        instances.push({
+                                            cpu: getResource(ci.remainingResources, 'CPU'),
+                                            memory: getResource(ci.remainingResources, 'MEMORY')
+                                        });
+                                    }
+                                });
+                                done();
+                            }
+                        );
+                    }, function (err) { next(err, instances); });
+                }
+            );
+        }
+    }, function (err, state) {
+        if (err) { return callback(err); }
+        callback(null, {
+            visible: state.queue.visible,
+            inFlight: state.queue.inFlight,
+            running: state.running,
+            instances: state.instances
+        });
+    });
+};
+
+// Return the number of worker tasks to start per size class name: enough for one task per messages_per_task messages in
+// the queue, kept between min_tasks and max_tasks, minus the tasks already running, and no more than fit into the free
+// capacity of the container instances, first fit. sent maps size class names to the number of messages this
+// invocation sent, which the approximate queue depth may not show yet. Those get tasks of their class, largest first,
+// the rest of the backlog gets tasks of the default class.
+exports.computeTasksToStart = function(state, config, sent) {
+    var scaling = config.scaling;
+    var classes = exports.getSizeClasses(config);
+    var justSent = 0;
+    for (var name in sent) {
+        if (sent.hasOwnProperty(name)) { justSent += sent[name]; }
+    }
+    var backlog = Math.max(state.visible + state.inFlight, justSent);
+    var wanted = Math.ceil(backlog / scaling.messages_per_task);
+    wanted = Math.max(scaling.min_tasks, Math.min(scaling.max_tasks, wanted));
+    var missing = Math.max(0, wanted - state.running);
+
+    var tasks = [];
+    for (var i = classes.length - 1; i >= 0; i--) {
+        var n = Math.ceil((sent[classes[i].name] || 0) / scaling.messages_per_task);
+        for (var j = 0; j < n; j++) { tasks.push(classes[i]); }
+    }
+    var defaultClass = exports.getDefaultSizeClass(config);
+    while (tasks.length < missing) { tasks.push(defaultClass); }
+
+    var free = state.instances.map(function (instance) { return {cpu: instance.cpu, memory: instance.memory}; });
+    var counts = {};
+    tasks.slice(0, missing).forEach(function (sizeClass) {
+        for (var k = 0; k < free.length; k++) {
+            if (free[k].cpu >= sizeClass.cpu && free[k].memory >= sizeClass.memory) {
+                free[k].cpu -= sizeClass.cpu;
+                free[k].memory -= sizeClass.memory;
+                counts[sizeClass.name] = (counts[sizeClass.name] || 0) + 1;
+                return;
+            }
+        }
+    });
+    return counts;
+};
+
+// Start the given number of worker tasks per size class name, up to 10 per call. Larger tasks go first, like in
+// computeTasksToStart(), so that they find the room it counted on.
+exports.runTasks = function(clients, config, counts, callback) {
+    var calls = [];
+    exports.getSizeClasses(config).slice().reverse().forEach(function (sizeClass) {
+        for (var left = counts[sizeClass.name] || 0; left > 0; left -= 10) {
+            calls.push({task: sizeClass.task, count: Math.min(left, 10)});
+        }
+    });
+    async.eachSeries(calls, function (call, next) {
+        clients.ecs.runTask({
+            taskDefinition: call.task,
+            count: call.count,
+            cluster: config.cluster,
+            startedBy: 'ecs-worker-launcher'
+        }, function (err, data) {
+            if (err) { return next(err); }
+            (data.failures || []).forEach(function (f) {
+                console.warn('Could not start task on ' + f.arn + ': ' + f.reason);
+            });
+            console.info('Task ' + call.task + ' started ' + data.tasks.length + ' time(s).');
+            next();
+        });
+    }, callback);
+};
+
+// Bring the number of worker tasks in line with the queue depth. sent maps size class names to the number of messages
+// just sent. Calls back with the number of tasks started.
+exports.scaleWorkers = function(clients, config, sent, callback) {
+    exports.getScalingState(clients, config, function (err, state) {
+        if (err) { return callback(err); }
+        var counts = exports.computeTasksToStart(state, config, sent);
+        var count = 0;
+        var started = Object.keys(counts).map(function (name) {
+            count += counts[name];
+            return name + ': ' + counts[name];
+        });
+        console.info(
+            'Queue: ' + state.visible + ' waiting, ' + state.inFlight + ' in flight. Tasks running: ' + state.running +
+            '. Starting: ' + count + (started.length ? ' (' + started.join(', ') + ')' : '') + '.'
+        );
+        exports.runTasks(clients, config, counts, function (err) { callback(err, count); });
+    });
+};
+
+// Return the job of an S3 event record for a job message: the object's bucket and key, as it is, its version ID, ETag,
+// size and event sequencer where the record has them, and options for the worker, like the size class.
+exports.getJob = function(record, lane, sizeClass) {
+    var object = record.s3.object;
+    var job = {bucket: record.s3.bucket.name, key: exports.decodeKey(object.key)};
+    if (object.versionId) { job.version_id = object.versionId; }
+    if (object.eTag) { job.etag = object.eTag; }
+    if (object.size !== undefined) { job.size = object.size; }
+    if (object.sequencer) { job.sequencer = object.sequencer; }
+    var options = {};
+    if (sizeClass) { options.size_class = {name: sizeClass.name, cpu: sizeClass.cpu, memory: sizeClass.memory}; }
+    if (lane.name) { options.lane = lane.name; }
+    if (Object.keys(options).length) { job.options = options; }
+    return job;
+};
+
+// Return the bodies of the job messages for the given jobs, in order, with up to perMessage jobs and MAX_MESSAGE_BYTES
+// each. A job too large for a message of its own is logged and left out.
+exports.packJobs = function(jobs, perMessage) {
+    var empty = Buffer.byteLength(JSON.stringify({Version: JOB_SCHEMA_VERSION, Jobs: []}));
+    var bodies = [];
+    var packed = [];
+    var size = empty;
+    function flush() {
+        if (packed.length) { bodies.push(JSON.stringify({Version: JOB_SCHEMA_VERSION, Jobs: packed})); }
+        packed = [];
+        size = empty;
+    }
+    jobs.forEach(function (job) {
+        var bytes = Buffer.byteLength(JSON.stringify(job));
+        if (empty + bytes > MAX_MESSAGE_BYTES) {
+            console.warn('Job for key: ' + job.key + ' does not fit into a message, skipping it.');
+            return;
+        }
+        // Jobs after the first are separated by a comma.
+        if (packed.length >= perMessage || size + 1 + bytes > MAX_MESSAGE_BYTES) { flush(); }
+        size += (packed.length ? 1 : 0) + bytes;
+        packed.push(job);
+    });
+    flush();
+    return bodies;
+};
+
+// Send the jobs, {record: ..., sizeClass: ..., lane: ...}, as job messages into the queues of their lanes. Jobs of the
+// same lane and size class share messages, see packJobs(), and messages go out up to 10 and MAX_MESSAGE_BYTES per
+// SendMessageBatch call. Calls back with the number of messages sent per size class name.
+exports.forwardRecords = function(clients, config, jobs, callback) {
+    var groups = {};  // Queue URL and size class name -> {lane: ..., sizeClass: ..., jobs: [...]}
+    jobs.forEach(function (job) {
+        var sizeClass = job.sizeClass || exports.getDefaultSizeClass(config);
+        var id = JSON.stringify([job.lane.queue, sizeClass.name]);
+        groups[id] = groups[id] || {lane: job.lane, sizeClass: sizeClass, jobs: []};
+        groups[id].jobs.push(exports.getJob(job.record, job.lane, job.sizeClass));
+    });
+
+    var batches = [];
+    var sent = {};
+    Object.keys(groups).forEach(function (id) {
+        var group = groups[id];
+        var batch = null;
+        exports.packJobs(group.jobs, config.jobs_per_message || 1).forEach(function (body) {
+            var size = Buffer.byteLength(body);
+            if (!batch || batch.entries.length >= 10 || batch.size + size > MAX_MESSAGE_BYTES) {
+                batch = {lane: group.lane, entries: [], size: 0};
+                batches.push(batch);
+            }
+            batch.entries.push({Id: String(batch.entries.length), MessageBody: body});
+            batch.size += size;
+            sent[group.sizeClass.name] = (sent[group.sizeClass.name] || 0) + 1;
+        });
+    });
+
+    async.eachSeries(batches, function (batch, next) {
+        clients.sqs.sendMessageBatch({QueueUrl: batch.lane.queue, Entries: batch.entries}, function (err, data) {
+            if (err) { return next(err); }
+            if (data.Failed && data.Failed.length) {
+                return next(new Error(
+                    data.Failed.length + ' message(s) not sent, first error: ' + data.Failed[0].Message
+                ));
+            }
+            console.info(
+                'Messages sent' + (batch.lane.name ? ' to lane ' + batch.lane.name : '') + ', IDs: ' +
+                data.Successful.map(function (m) { return m.MessageId; }).join(', ')
+            );
+            next();
+        });
+    }, function (err) { callback(err, sent); });
+};
+
+// Log metrics as a JSON line in CloudWatch embedded metric format, which CloudWatch Logs turns into metrics of the
+// configured namespace. metrics maps metric names to [value, unit]. The properties are logged along.
+exports.logMetrics = function(config, metrics, properties) {
+    var record = {};
+    for (var p in properties) {
+        if (properties.hasOwnProperty(p)) { record[p] = properties[p]; }
+    }
+    record._aws = {
+        Timestamp: Date.now(),
+        CloudWatchMetrics: [{
+            Namespace: config.metrics_namespace || 'ECSWorker',
+            Dimensions: [[]],
+            Metrics: Object.keys(metrics).sort().map(function (name) { return {Name: name, Unit: metrics[name][1]}; })
+        }]
+    };
+    Object.keys(metrics).forEach(function (name) { record[name] = metrics[name][0]; });
+    console.log(JSON.stringify(record));
+};
+
 exports.handler = function(event, context) {
-    console.log('Received event:');
-    console.log(JSON.stringify(event, null, '  '));
+    var invoked = Date.now();
+    var config = exports.loadConfig();
+    var clients = {sqs: sqs, ecs: ecs, s3: s3};
+
+    // Log what the invocation did, then end it.
+    function finish(err, result, records, sent, started) {
+        exports.logMetrics(config, {
+            Records: [records, 'Count'],
+            MessagesSent: [sent, 'Count'],
+            TasksStarted: [started || 0, 'Count'],
+            LaunchSeconds: [(Date.now() - invoked) / 1000, 'Seconds']
+        }, {Event: 'launch', Status: err ? 'failed' : 'done'});
+        if (err) {
+            context.fail('An error has occurred: ' + err);
+        }
+        else {
+            context.succeed(result);
+        }
+    }
 
-    var config = JSON.parse(fs.readFileSync('config.json', 'utf8'));
-    if(!config.hasOwnProperty('s3_key_suffix_whitelist')) {
-        config.s3_key_suffix_whitelist = false;
+    // Workers that queue jobs of their own, like the tiles of a large frame, send this to get tasks started for them.
+    if (event.ScaleWorkers) {
+        exports.scaleWorkers(clients, config, event.Jobs || {}, function (err, count) {
+            finish(err, 'Started ' + count + ' task(s).', 0, 0, count);
+        });
+        return;
     }
-    console.log('Config: ' + JSON.stringify(config));
 
-    var key = event.Records[0].s3.object.key;
+    var records = (event.Records || []).filter(function (record) {
+        var key = record.s3 && record.s3.object && record.s3.object.key;
+        if (!key || !exports.checkS3SuffixWhitelist(key, config.s3_key_suffix_whitelist)) {
+            console.log('Suffix for key: ' + key + ' is not in the whitelist, skipping it.');
+            return false;
+        }
+        return true;
+    });
 
-    if(!exports.checkS3SuffixWhitelist(key, config.s3_key_suffix_whitelist)) {
-        context.fail('Suffix for key: ' + key + ' is not in the whitelist')
+    if (!records.length) {
+        finish(null, 'No Amazon S3 URLs to process.', (event.Records || []).length, 0, 0);
+        return;
     }
 
-    // We can now go on. Put the Amazon S3 URL into Amazon SQS and start an Amazon ECS task to process it.
+    // We can now go on. Put the Amazon S3 URLs into Amazon SQS and start the missing Amazon ECS tasks to process them.
+    var sent = 0;
     async.waterfall([
             function (next) {
-                var params = {
-                    MessageBody: JSON.stringify(event),
-                    QueueUrl: config.queue
-                };
-                sqs.sendMessage(params, function (err, data) {
-                    if (err) { console.warn('Error while sending message: ' + err); }
-                    else { console.info('Message sent, ID: ' + data.MessageId); }
-                    next(err);
+                async.parallel({
+                    sizeClasses: function (done) { exports.sizeRecords(clients, config, records, done); },
+                    lanes: function (done) { exports.routeRecords(clients, config, records, done); }
+                }, next);
+            },
+            function (routing, next) {
+                var jobs = records.map(function (record, i) {
+                    return {record: record, sizeClass: routing.sizeClasses[i], lane: routing.lanes[i]};
+                });
+                exports.forwardRecords(clients, config, jobs, function (err, counts) {
+                    if (err) { console.warn('Error while sending messages: ' + err); }
+                    else { Object.keys(counts).forEach(function (name) { sent += counts[name]; }); }
+                    next(err, counts);
                 });
             },
-            function (next) {
-                // Starts an ECS task to work through the feeds.
-                var params = {
-                    taskDefinition: config.task,
-                    count: 1,
-                    cluster: 'default'
-                };
-                ecs.runTask(params, function (err, data) {
-                    if (err) { console.warn('error: ', "Error while starting task: " + err); }
-                    else { console.info('Task ' + config.task + ' started: ' + JSON.stringify(data.tasks))}
-                    next(err);
+            function (counts, next) {
+                exports.scaleWorkers(clients, config, counts, function (err, started) {
+                    if (err) { console.warn('error: ', "Error while starting tasks: " + err); }
+                    next(err, started);
                 });
             }
-        ], function (err) {
-            if (err) {
-                context.fail('An error has occurred: ' + err);
-            }
-            else {
-                context.succeed('Successfully processed Amazon S3 URL.');
-            }
+        ], function (err, started) {
+            var result = 'Successfully processed ' + records.length + ' Amazon S3 URL(s).';
+            finish(err, result, records.length, sent, started);
         }
     );
 };
@@ -15,89 +15,159 @@
 #
 # Simple POV-Ray worker shell script.
 #
-# Uses the AWS CLI utility to fetch a message from SQS, fetch a ZIP file from S3 that was specified in the message,
-# render its contents with POV-Ray, then upload the resulting .png file to the same S3 bucket.
+# Uses the AWS CLI utility to fetch a message from SQS, fetch the ZIP files from S3 that were specified in the message,
+# render their contents with POV-Ray, then upload the resulting .png files to the same S3 bucket. The message is parsed
+# by the batch mode worker, ecs_worker.py.
+#
+# Messages that can't be rendered are made visible again right away instead of being deleted. Once they have been
+# received SQS_MAX_RECEIVE_COUNT times, SQS moves them to the queue's dead-letter queue, from where
+# "fab replay_dead_letters" puts them back. Without a dead-letter queue, they are deleted.
+#
+# With several lanes, each message comes from the lane of the highest priority that has one.
 #
 
 region=${AWS_REGION}
-queue=${SQS_QUEUE_URL}
 
-# Fetch messages and render them until the queue is drained.
-while [ /bin/true ]; do
-    # Fetch the next message and extract the S3 URL to fetch the POV-Ray source ZIP from.
-    echo "Fetching messages fom SQS queue: ${queue}..."
-    result=$( \
-        aws sqs receive-message \
+worker_module=$(cd $(dirname $0) && pwd)/ecs_worker.py
+
+# In batch mode, the Python worker takes over. It receives and deletes messages in batches of up to 10.
+if [ "${WORKER_MODE}" = "batch" ]; then
+    exec python ${worker_module}
+fi
+
+# The queue and dead-letter queue of each lane, highest priority first, separated by a tab.
+lanes=$(python ${worker_module} --print-lanes)
+lane_count=$(echo "${lanes}" | wc -l)
+lane_wait_time=$(( 20 / lane_count ))
+[ ${lane_wait_time} -lt 1 ] && lane_wait_time=1
+
+# Receives the next message from the first lane that has one, waiting up to $1 seconds on each. Sets queue,
+# dead_letter_queue and result: the message's receipt handle and its body, separated by a tab, or nothing.
+receive_message() {
+    result=""
+    while IFS=$'\t' read -r -u 4 queue dead_letter_queue; do
+        echo "Fetching messages fom SQS queue: ${queue}..."
+        result=$( \
+            aws sqs receive-message \
+                --queue-url ${queue} \
+                --region ${region} \
+                --wait-time-seconds $1 \
+                --output text \
+                --query Messages[0].[ReceiptHandle,Body] \
+        )
+        if [ -n "${result}" -a "${result}" != "None" ]; then
+            return 0
+        fi
+        result=""
+    done 4<<< "${lanes}"
+}
+
+# Gives up on a message, so that it reaches the dead-letter queue after a few quick deliveries.
+fail_message() {
+    if [ -z "${dead_letter_queue}" ]; then
+        echo "No dead-letter queue, deleting message..."
+        aws sqs delete-message \
+            --queue-url ${queue} \
+            --region ${region} \
+            --receipt-handle "$1"
+    else
+        echo "Releasing message for the dead-letter queue..."
+        aws sqs change-message-visibility \
             --queue-url ${queue} \
             --region ${region} \
-            --wait-time-seconds 20 \
-            --query Messages[0].[Body,ReceiptHandle] \
-        | sed -e 's/^"\(.*\)"$/\1/'\
-    )
+            --receipt-handle "$1" \
+            --visibility-timeout 0
+    fi
+}
+
+# Renders the scene ZIP file with the given bucket and key. Returns 1 if it can't be rendered.
+render_scene() {
+    local bucket="$1"
+    local key="$2"
+    local base=${key%.*}
+    local ext=${key##*.}
+    local name=$(basename "${base}")
+    local failed=""
+
+    if [ -z "${name}" -o "${ext}" != "zip" ]; then
+        echo "ERROR: Not a POV-Ray source archive: ${key}."
+        return 1
+    fi
+
+    mkdir -p work
+    pushd work
+
+    echo "Copying ${key} from S3 bucket ${bucket}..."
+    aws s3 cp "s3://${bucket}/${key}" "${name}.zip" --region ${region}
+
+    echo "Unzipping ${key}..."
+    unzip "${name}.zip"
+
+    if [ -f "${name}.ini" ]; then
+        echo "Rendering POV-Ray scene ${name}..."
+        if povray "${name}"; then
+            if [ -f "${name}.png" ]; then
+                echo "Copying result image ${name}.png to s3://${bucket}/${base}.png..."
+                aws s3 cp "${name}.png" "s3://${bucket}/${base}.png"
+            else
+                echo "ERROR: POV-Ray source did not generate ${name}.png image."
+                failed=1
+            fi
+        else
+            echo "ERROR: POV-Ray source did not render successfully."
+            failed=1
+        fi
+    else
+        echo "ERROR: No ${name}.ini file found in POV-Ray source archive."
+        failed=1
+    fi
+
+    echo "Cleaning up..."
+    popd
+    /bin/rm -rf work
+
+    [ -z "${failed}" ]
+}
+
+# Fetch messages and render them until the queues are drained.
+while [ /bin/true ]; do
+    # Fetch the next message. Only long poll, about 20 seconds in all, if no lane has one right away.
+    receive_message 0
+    if [ -z "${result}" ]; then
+        receive_message ${lane_wait_time}
+    fi
 
     if [ -z "${result}" ]; then
         echo "No messages left in queue. Exiting."
         exit 0
     else
-        echo "Message: ${result}."
-
-        receipt_handle=$(echo ${result} | sed -e 's/^.*"\([^"]*\)"\s*\]$/\1/')
+        receipt_handle=${result%%$'\t'*}
+        body=${result#*$'\t'}
+        echo "Message: ${body}."
         echo "Receipt handle: ${receipt_handle}."
 
-        bucket=$(echo ${result} | sed -e 's/^.*arn:aws:s3:::\([^\\]*\)\\".*$/\1/')
-        echo "Bucket: ${bucket}."
-
-        key=$(echo ${result} | sed -e 's/^.*\\"key\\":\s*\\"\([^\\]*\)\\".*$/\1/')
-        echo "Key: ${key}."
-
-        base=${key%.*}
-        ext=${key##*.}
-
-        if [ \
-            -n "${result}" -a \
-            -n "${receipt_handle}" -a \
-            -n "${key}" -a \
-            -n "${base}" -a \
-            -n "${ext}" -a \
-            "${ext}" = "zip" \
-        ]; then
-            mkdir -p work
-            pushd work
-
-            echo "Copying ${key} from S3 bucket ${bucket}..."
-            aws s3 cp s3://${bucket}/${key} . --region ${region}
-
-            echo "Unzipping ${key}..."
-            unzip ${key}
-
-            if [ -f ${base}.ini ]; then
-                echo "Rendering POV-Ray scene ${base}..."
-                if povray ${base}; then
-                    if [ -f ${base}.png ]; then
-                        echo "Copying result image ${base}.png to s3://${bucket}/${base}.png..."
-                        aws s3 cp ${base}.png s3://${bucket}/${base}.png
-                    else
-                        echo "ERROR: POV-Ray source did not generate ${base}.png image."
-                    fi
-                else
-                    echo "ERROR: POV-Ray source did not render successfully."
-                fi
+        # The batch mode worker's parser reads all message formats, and hands out keys as they are, not URL encoded.
+        if jobs=$(echo "${body}" | python ${worker_module} --print-jobs); then
+            failed=""
+            while IFS=$'\t' read -r -u 3 bucket key; do
+                echo "Bucket: ${bucket}."
+                echo "Key: ${key}."
+                render_scene "${bucket}" "${key}" || failed=1
+            done 3<<< "${jobs}"
+
+            if [ -n "${failed}" ]; then
+                fail_message "${receipt_handle}"
             else
-                echo "ERROR: No ${base}.ini file found in POV-Ray source archive."
+                echo "Deleting message..."
+                aws sqs delete-message \
+                    --queue-url ${queue} \
+                    --region ${region} \
+                    --receipt-handle "${receipt_handle}"
             fi
 
-            echo "Cleaning up..."
-            popd
-            /bin/rm -rf work
-
-            echo "Deleting message..."
-            aws sqs delete-message \
-                --queue-url ${queue} \
-                --region ${region} \
-                --receipt-handle "${receipt_handle}"
-
         else
             echo "ERROR: Could not extract S3 bucket and key from SQS message."
+            fail_message "${receipt_handle}"
         fi
     fi
 done
@@ -0,0 +1,1994 @@
+#!/usr/bin/python
+# coding: utf-8
+
+# Copyright 2015 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file.
+# This file is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+#
+# ecs_worker.py
+#
+
+#
+# POV-Ray worker, batch mode. Started by ecs-worker.sh when WORKER_MODE is "batch".
+#
+# Works like the shell script, but receives as many messages per long poll as it has free render slots, up to 10, and
+# deletes the messages of finished jobs with one DeleteMessageBatch call. Messages it has no slot for yet stay in the
+# queue for other tasks.
+#
+# Jobs are rendered in one or more render slots. Each slot is a thread with its own scratch directory that works on
+# one message at a time. The number of slots and POV-Ray threads per slot follow the task's CPU reservation.
+#
+# From the moment a message is received until it is deleted, a heartbeat keeps extending its visibility timeout, so
+# that no other worker renders the same scene in the meantime. Finished jobs leave a marker object in the bucket, and a
+# message that is delivered again for a job with a marker is deleted without rendering.
+#
+# Scene archives are unzipped while they download: large archives are fetched with several ranged GETs in parallel,
+# and each ZIP entry is written to the scratch directory as soon as its bytes arrive. Result images are uploaded with
+# parallel multipart PUTs.
+#
+# The time each job waited in the queue and for a render slot, and the bytes and seconds it spent per stage (fetch,
+# extract, render, stitch, upload) are logged as JSON lines in CloudWatch embedded metric format, and so are the
+# seconds spent polling the queue and deleting messages. CloudWatch Logs turns them into metrics in the
+# METRICS_NAMESPACE namespace, and "fab show_stage_percentiles" prints percentiles per stage from them.
+#
+# Large files from scene archives are kept in an asset cache on the container instance, shared by all worker tasks on
+# it. For large archives, the worker first reads the ZIP central directory from the end of the archive, copies the
+# files it already has from the cache and downloads only the byte ranges of the others.
+#
+# Rendered images are also kept in the bucket, keyed by a hash of the scene's files and the POV-Ray version. A scene
+# that was rendered before, even under another name, is copied from there without running POV-Ray.
+#
+# Frames with more than TILE_MIN_PIXELS pixels are split into tiles of rows and columns. The worker that receives the
+# scene queues one message per tile and asks the launcher function to start tasks for them. Each tile is rendered
+# with POV-Ray's start and end row and column options, and the worker that finishes the last tile stitches them
+# together into the frame's image.
+#
+# Animations are split into chunks of ANIMATION_CHUNK_FRAMES frames the same way, rendered with POV-Ray's subset frame
+# options. Every frame is uploaded next to the scene, and the worker that finishes the last chunk writes a manifest,
+# ${base}.manifest.json, that lists all frames.
+#
+# The peak memory and CPU seconds of every POV-Ray run are kept in a render profile per scene family (the scene's key
+# without trailing numbers), in the job's bucket. The launcher function picks a size class of the task for each job
+# from the profile of its family. A task that receives a job of a class with more memory than it has leaves the job to
+# a task of that class for a few receives, then renders it anyway.
+#
+# Jobs can come through several queues, or lanes, like interactive, standard and bulk. The worker polls the lanes with
+# weighted-fair selection: a lane with weight w is polled w times as often as a lane with weight 1 while both have
+# messages, and every lane gets its turn. Received messages wait for a render slot in order of their lane's priority,
+# and the tiles and frames of a scene are queued in the scene's lane.
+#
+# Jobs that can't succeed, like messages without a job, archives that are gone or scenes that POV-Ray can't render,
+# are moved to the dead-letter queue of their lane right away. Jobs that fail for other reasons, like errors talking to
+# AWS, are delivered again after a delay that doubles every time, until SQS moves them to the dead-letter queue.
+# "fab replay_dead_letters" puts them back into their lanes.
+#
+
+# Imports
+from __future__ import print_function
+
+import errno
+import fcntl
+import hashlib
+import itertools
+import json
+import math
+import os
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+import zlib
+
+try:
+    from Queue import Queue, PriorityQueue, Empty
+except ImportError:
+    from queue import Queue, PriorityQueue, Empty
+
+try:
+    from urllib import unquote_plus
+except ImportError:
+    from urllib.parse import unquote_plus
+
+import boto3
+import numpy
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Constants (set by the task definition)
+REGION = os.environ.get('AWS_REGION')
+QUEUE_URL = os.environ.get('SQS_QUEUE_URL')
+QUEUE_LANES = json.loads(os.environ.get('QUEUE_LANES') or '[]')  # [{name, url, dead_letter_url, weight}], by priority.
+DEAD_LETTER_QUEUE_URL = os.environ.get('SQS_DEAD_LETTER_QUEUE_URL')  # Empty: Jobs that can't succeed are deleted.
+CPU_SHARES = int(os.environ.get('CPU_SHARES') or 1024)  # The task's CPU reservation. 1024 shares are one CPU.
+WORKER_SLOTS = int(os.environ.get('WORKER_SLOTS') or 0)  # 0: One slot per reserved CPU.
+POVRAY_THREADS = int(os.environ.get('POVRAY_THREADS') or 0)  # 0: Share the reserved CPUs between the slots.
+ASSET_CACHE_DIR = os.environ.get('ASSET_CACHE_DIR')  # Host volume shared by the tasks on an instance. Empty: No cache.
+ASSET_CACHE_SIZE = int(os.environ.get('ASSET_CACHE_SIZE') or 2048)  # MB the cache may use.
+TILE_MIN_PIXELS = int(os.environ.get('TILE_MIN_PIXELS') or 0)  # Larger frames are rendered as tiles. 0: Never.
+TILE_PIXELS = int(os.environ.get('TILE_PIXELS') or 1920 * 1080)  # Pixels per tile.
+ANIMATION_CHUNK_FRAMES = int(os.environ.get('ANIMATION_CHUNK_FRAMES') or 10)  # Frames per animation job.
+LAUNCHER_FUNCTION = os.environ.get('LAUNCHER_FUNCTION')  # Lambda function that starts tasks for queued jobs.
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE') or 'ECSWorker'  # CloudWatch namespace of the logged metrics.
+MEMORY = int(os.environ.get('MEMORY') or 0)  # The task's memory limit in MB. 0: Unknown.
+SIZE_CLASS = os.environ.get('SIZE_CLASS') or ''  # The task's size class. Empty: One task definition for all jobs.
+PROFILE_PREFIX = os.environ.get('PROFILE_PREFIX') or '.ecs-worker/profiles/'  # Key prefix of the render profiles.
+
+# Constants
+WORK_DIR = 'work'
+RECEIVE_WAIT_TIME = 20  # Seconds to long poll for messages before deciding that the queue is drained.
+RECEIVE_MAX_MESSAGES = 10  # Largest number of messages SQS hands out per receive or delete call.
+DELETE_MAX_DELAY = 10  # Seconds the message of a finished job may wait for a batch delete.
+LEASE_TIMEOUT = 120  # Seconds each heartbeat keeps a received message invisible to other workers.
+LEASE_HEARTBEAT = 40  # Seconds between heartbeats. Shortened if the queue's own visibility timeout is shorter.
+DONE_MARKER_PREFIX = '.ecs-worker/done/'  # Key prefix for the markers of finished jobs, in the job's bucket.
+RESULT_CACHE_PREFIX = '.ecs-worker/results/'  # Key prefix for rendered images by scene hash, in the job's bucket.
+SCENE_TEXT_EXTENSIONS = ['.ini', '.pov', '.inc', '.mcr']  # Hashed without line ending and trailing blank differences.
+SCENE_IGNORED_NAMES = ['.DS_Store', 'Thumbs.db']  # Files archivers add that don't affect the image.
+SCENE_IGNORED_DIRECTORIES = ['__MACOSX']
+TILE_PREFIX = '.ecs-worker/tiles/'  # Key prefix for the plans and images of tiles, in the job's bucket.
+TILE_ALIGNMENT = 32  # Tile edges fall on POV-Ray's default render block grid, like in a render in one piece.
+FRAMES_PREFIX = '.ecs-worker/frames/'  # Key prefix for the records of finished animation chunks, in the job's bucket.
+POVRAY_DEFAULT_SIZE = (320, 240)  # Frame size of scenes that don't set Width and Height.
+TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024  # Bytes per ranged GET and per multipart upload part.
+TRANSFER_CONCURRENCY = 4  # Parallel ranged GETs, or parallel upload parts, per transfer.
+TRANSFER_READ_AHEAD = 8  # Chunks a download may fetch ahead of the unzipping.
+EXTRACT_BLOCK_SIZE = 64 * 1024  # Bytes handed to the decompressor at a time.
+ASSET_CACHE_MIN_ENTRY_SIZE = 256 * 1024  # Smaller files are cheaper to download again than to cache.
+ASSET_CACHE_MIN_ARCHIVE_SIZE = TRANSFER_CHUNK_SIZE  # Smaller archives are downloaded in one go, without the cache.
+ASSET_CACHE_EVICT_TO = 0.9  # Eviction frees the cache down to this fraction of its size.
+ASSET_CACHE_TMP_MAX_AGE = 3600  # Seconds after which a partly written cache file is considered abandoned.
+ZIP_TAIL_SIZE = 128 * 1024  # Bytes from the end of an archive to read for its central directory.
+STAGES = ['fetch', 'extract', 'render', 'stitch', 'upload']
+PROFILE_SAMPLES = 20  # Most recent POV-Ray runs kept in the render profile of a scene family.
+PROFILE_FAMILY = re.compile(r'[-_. ]*\d+$')  # Trailing frame, shot or version numbers, removed for the family name.
+PROFILE_POLL_INTERVAL = 0.1  # Seconds between reads of POV-Ray's peak memory while it renders.
+SIZE_CLASS_DEFER_SECONDS = 10  # Time a job of a larger size class is left to a task of that class...
+SIZE_CLASS_MAX_DEFERRALS = 2  # ...up to this many times, before a smaller task renders it anyway.
+JOB_SCHEMA_VERSION = 1  # Newest version of the launcher's job messages this worker reads. See parse_message().
+RETRY_DELAY = 10  # Seconds before a job that failed for a transient reason is delivered again, doubled every time...
+RETRY_MAX_DELAY = 300  # ...up to this many seconds.
+PERMANENT_ERROR_CODES = ['404', 'NoSuchKey', 'NoSuchBucket', 'InvalidObjectState']  # S3 errors that won't go away.
+DEAD_LETTER_ERROR_LENGTH = 1024  # Characters of the error kept with a message in the dead-letter queue.
+
+ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+ZIP_DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+ZIP_FLAG_ENCRYPTED = 0x01
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_FLAG_UTF8 = 0x800
+ZIP_EXTRA_ZIP64 = 0x0001
+ZIP_DEFLATED = 8
+ZIP_MAX_32 = 0xFFFFFFFF
+
+INI_NUMBER_SWITCH = re.compile(r'^\+(W|H|SR|ER|SC|EC|KFI|KFF|SF|EF)(-?\d+(?:\.\d*)?)$', re.I)
+INI_NUMBER_SWITCH_OPTIONS = {
+    'w': 'width', 'h': 'height', 'sr': 'start_row', 'er': 'end_row', 'sc': 'start_column', 'ec': 'end_column',
+    'kfi': 'initial_frame', 'kff': 'final_frame', 'sf': 'subset_start_frame', 'ef': 'subset_end_frame'
+}
+INI_ALPHA_SWITCH = re.compile(r'^([+-])UA$', re.I)
+INI_FILE_TYPE_SWITCH = re.compile(r'^\+F([A-Z])(\d*)$', re.I)
+PPM_HEADER = re.compile(br'^P6(?:\s+|#[^\n]*\n)+(\d+)(?:\s+|#[^\n]*\n)+(\d+)(?:\s+|#[^\n]*\n)+(\d+)\s')
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_FILTER_UP = 2
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=TRANSFER_CHUNK_SIZE,
+    multipart_chunksize=TRANSFER_CHUNK_SIZE,
+    max_concurrency=TRANSFER_CONCURRENCY
+)
+
+
+# Functions
+
+
+def log(message):
+    thread = threading.current_thread()
+    if thread.name != 'MainThread':
+        message = '[' + thread.name + '] ' + message
+    print(message)
+    sys.stdout.flush()
+
+
+def log_metrics(metrics, properties):
+    """Log metrics as a JSON line in CloudWatch embedded metric format, which CloudWatch Logs turns into metrics.
+
+    metrics maps metric names to (value, unit). The properties are logged along, to search and group the lines by.
+    """
+    record = dict(properties)
+    record['Thread'] = threading.current_thread().name
+    record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{
+            'Namespace': METRICS_NAMESPACE,
+            'Dimensions': [[]],
+            'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in sorted(metrics.items())]
+        }]
+    }
+    for name, (value, _) in metrics.items():
+        record[name] = round(value, 3) if isinstance(value, float) else value
+    sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')  # One write, so that lines of threads don't mix.
+    sys.stdout.flush()
+
+
+def get_slot_configuration():
+    """Return the number of render slots and the number of POV-Ray work threads per slot."""
+    cpus = max(1, CPU_SHARES // 1024)
+    slots = WORKER_SLOTS or cpus
+    threads = POVRAY_THREADS or max(1, cpus // slots)
+    return slots, threads
+
+
+def get_visibility_timeout(sqs):
+    result = sqs.get_queue_attributes(QueueUrl=QUEUE_URL, AttributeNames=['VisibilityTimeout'])
+    return int(result['Attributes']['VisibilityTimeout'])
+
+
+def get_job_id(bucket, key, sequencer):
+    return hashlib.sha1(json.dumps([bucket, key, sequencer]).encode('utf-8')).hexdigest()
+
+
+def parse_message(message):
+    """Return the jobs of a job message from the launcher, of an S3 event notification message, or of a tile or
+    frames message. Return [] if the message has none, or is of a job schema version newer than JOB_SCHEMA_VERSION.
+
+    Job messages are {"Version": 1, "Jobs": [...]}. Each job has the bucket and the key, as it is, and may have the
+    version_id, etag, size and sequencer from the object's S3 event and options, like the size_class the launcher
+    picked. S3 event messages, optionally with a SizeClass, are what the launcher used to send.
+
+    Jobs are dicts with the bucket, the key and an ID that stays the same when the message, or the S3 event, is
+    delivered more than once, and the URL of the queue the message came from. Jobs for a whole scene have the
+    object's 'version_id', 'etag' and 'size', or None. Jobs for part of a scene have the part, under 'tile' or
+    'frames'. If the launcher picked a size class for the jobs, they have its name, CPU shares and memory under
+    'size_class'.
+    """
+    try:
+        event = json.loads(message['Body'])
+        size_class = event.get('SizeClass')
+        queue = message.get('queue', QUEUE_URL)
+        if 'Version' in event:
+            if event['Version'] > JOB_SCHEMA_VERSION:
+                return []
+            jobs = []
+            for i, j in enumerate(event['Jobs']):
+                options = j.get('options', {})
+                sequencer = j.get('sequencer') or message['MessageId'] + '-' + str(i)
+                jobs.append({
+                    'bucket': j['bucket'],
+                    'key': j['key'],
+                    'id': get_job_id(j['bucket'], j['key'], sequencer),
+                    'queue': queue,
+                    'size_class': options.get('size_class'),
+                    'version_id': j.get('version_id'),
+                    'etag': j.get('etag'),
+                    'size': j.get('size')
+                })
+            return jobs
+
+        for kind in ('Tile', 'Frames'):
+            if kind in event:
+                part = event[kind]
+                return [{
+                    'bucket': part['bucket'],
+                    'key': part['key'],
+                    'id': hashlib.sha1(json.dumps([part['job'], part['index']]).encode('utf-8')).hexdigest(),
+                    'queue': queue,
+                    'size_class': size_class,
+                    kind.lower(): part
+                }]
+
+        jobs = []
+        for i, r in enumerate(event['Records']):
+            bucket = r['s3']['bucket']['name']
+            key = unquote_plus(str(r['s3']['object']['key']))
+            sequencer = r['s3']['object'].get('sequencer') or message['MessageId'] + '-' + str(i)
+            jobs.append({
+                'bucket': bucket,
+                'key': key,
+                'id': get_job_id(bucket, key, sequencer),
+                'queue': queue,
+                'size_class': size_class,
+                'version_id': r['s3']['object'].get('versionId'),
+                'etag': r['s3']['object'].get('eTag'),
+                'size': r['s3']['object'].get('size')
+            })
+        return jobs
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return []
+
+
+def print_jobs(body):
+    """Print the bucket and key of each job for a whole scene in a message body, one job per line, separated by a tab,
+    for ecs-worker.sh. Return 1 if there are none.
+    """
+    jobs = [j for j in parse_message({'Body': body, 'MessageId': ''}) if 'tile' not in j and 'frames' not in j]
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    for job in jobs:
+        out.write((job['bucket'] + '\t' + job['key'] + '\n').encode('utf-8'))
+    return 0 if jobs else 1
+
+
+def print_lanes():
+    """Print the queue URL and dead-letter queue URL of each lane, highest priority first, one lane per line,
+    separated by a tab, for ecs-worker.sh. Without QUEUE_LANES, there is one lane, SQS_QUEUE_URL.
+    """
+    lanes = QUEUE_LANES or [{'url': QUEUE_URL, 'dead_letter_url': DEAD_LETTER_QUEUE_URL}]
+    for lane in lanes:
+        sys.stdout.write(lane['url'] + '\t' + (lane.get('dead_letter_url') or '') + '\n')
+    return 0
+
+
+def is_job_done(s3, job):
+    try:
+        s3.head_object(Bucket=job['bucket'], Key=DONE_MARKER_PREFIX + job['id'])
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return False
+        raise
+
+
+def mark_job_done(s3, job):
+    s3.put_object(
+        Bucket=job['bucket'],
+        Key=DONE_MARKER_PREFIX + job['id'],
+        Body=json.dumps({'key': job['key'], 'finished': time.time()}).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+
+# Transfers
+
+
+class StageCounters(object):
+    """Bytes and seconds per stage of one or all jobs. Fetching and extracting overlap, so their seconds do too.
+
+    Also counts the CPU seconds of the POV-Ray runs and the most memory one of them used.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes = dict((s, 0) for s in STAGES)
+        self.seconds = dict((s, 0.0) for s in STAGES)
+        self.cpu_seconds = 0.0
+        self.peak_memory = 0  # MB
+
+    def add(self, stage, size, seconds):
+        with self.lock:
+            self.bytes[stage] += size
+            self.seconds[stage] += seconds
+
+    def add_usage(self, cpu_seconds, peak_memory):
+        with self.lock:
+            self.cpu_seconds += cpu_seconds
+            self.peak_memory = max(self.peak_memory, peak_memory)
+
+    def merge(self, other):
+        for stage in STAGES:
+            self.add(stage, other.bytes[stage], other.seconds[stage])
+        self.add_usage(other.cpu_seconds, other.peak_memory)
+
+    def summary(self):
+        with self.lock:
+            return ', '.join(
+                '%s: %.1f MB in %.2f s' % (s, self.bytes[s] / 1e6, self.seconds[s]) for s in STAGES
+            )
+
+    def get_metrics(self):
+        """Return the seconds and bytes of the stages that did something, as metrics for log_metrics()."""
+        metrics = {}
+        with self.lock:
+            for s in STAGES:
+                if self.seconds[s] or self.bytes[s]:
+                    metrics[s.capitalize() + 'Seconds'] = (self.seconds[s], 'Seconds')
+                    metrics[s.capitalize() + 'Bytes'] = (self.bytes[s], 'Bytes')
+            if self.cpu_seconds or self.peak_memory:
+                metrics['RenderCPUSeconds'] = (self.cpu_seconds, 'Seconds')
+                metrics['RenderPeakMemory'] = (self.peak_memory, 'Megabytes')
+        return metrics
+
+
+stage_totals = StageCounters()
+
+
+class StreamingNotSupported(Exception):
+    pass
+
+
+class SceneChanged(Exception):
+    pass
+
+
+class PermanentFailure(Exception):
+    """A job that fails every time it is tried, like a scene that POV-Ray can't render."""
+    pass
+
+
+class S3Stream(object):
+    """Reads part of an S3 object front to back, while it is being downloaded.
+
+    The bytes from start up to end are fetched in chunks of TRANSFER_CHUNK_SIZE bytes, with up to TRANSFER_CONCURRENCY
+    ranged GETs in parallel and at most TRANSFER_READ_AHEAD chunks ahead of the reader. Every range is requested with
+    the object's ETag, so that an object that is replaced during the download fails the download instead of mixing
+    two versions.
+    """
+
+    def __init__(self, s3, bucket, key, etag, start, end):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        self.ranges = [
+            (offset, min(offset + TRANSFER_CHUNK_SIZE, end) - 1) for offset in range(start, end, TRANSFER_CHUNK_SIZE)
+        ]
+        self.chunks = {}  # Chunk index -> blocks that arrived but weren't read yet.
+        self.complete = set()  # Indexes of fully downloaded chunks.
+        self.condition = threading.Condition()
+        self.next_fetch = 0
+        self.next_read = 0
+        self.error = None
+        self.closed = False
+        self.buffer = b''  # Part of a block that was read, or given back with unread().
+        self.bytes = 0
+        self.started = time.time()
+        self.finished = None
+
+        name = threading.current_thread().name
+        for i in range(min(TRANSFER_CONCURRENCY, len(self.ranges))):
+            t = threading.Thread(target=self.fetch, name=name + '-fetch-' + str(i))
+            t.daemon = True
+            t.start()
+
+    def fetch(self):
+        while True:
+            with self.condition:
+                while (not self.closed and self.next_fetch < len(self.ranges) and
+                       self.next_fetch - self.next_read >= TRANSFER_READ_AHEAD):
+                    self.condition.wait()
+                if self.closed or self.next_fetch >= len(self.ranges):
+                    return
+                i = self.next_fetch
+                self.next_fetch += 1
+                self.chunks[i] = []
+
+            start, end = self.ranges[i]
+            try:
+                body = self.s3.get_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Range='bytes=%d-%d' % (start, end),
+                    IfMatch=self.etag
+                )['Body']
+                received = 0
+                while True:
+                    block = body.read(EXTRACT_BLOCK_SIZE)
+                    with self.condition:
+                        if self.closed:
+                            return
+                        if block:
+                            received += len(block)
+                            self.bytes += len(block)
+                            self.chunks[i].append(block)
+                        elif received != end - start + 1:
+                            raise IOError('Incomplete download of bytes %d-%d of %s.' % (start, end, self.key))
+                        else:
+                            self.complete.add(i)
+                            if len(self.complete) + self.next_read == len(self.ranges):
+                                self.finished = time.time()
+                        self.condition.notify_all()
+                    if not block:
+                        break
+            except Exception as e:
+                with self.condition:
+                    self.error = self.error or e
+                    self.condition.notify_all()
+                return
+
+    def next_block(self):
+        """Return the next block of the object, or b'' at its end."""
+        with self.condition:
+            while True:
+                if self.error:
+                    raise self.error
+                if self.next_read >= len(self.ranges):
+                    return b''
+                blocks = self.chunks.get(self.next_read)
+                if blocks:
+                    return blocks.pop(0)
+                if self.next_read in self.complete:
+                    del self.chunks[self.next_read]
+                    self.complete.discard(self.next_read)
+                    self.next_read += 1
+                    self.condition.notify_all()
+                    continue
+                self.condition.wait()
+
+    def read(self, size):
+        """Return the next size bytes, or fewer at the end of the object."""
+        parts = []
+        while size > 0:
+            if not self.buffer:
+                self.buffer = self.next_block()
+                if not self.buffer:
+                    break
+            part, self.buffer = self.buffer[:size], self.buffer[size:]
+            parts.append(part)
+            size -= len(part)
+        return b''.join(parts)
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def get_extract_path(directory, name):
+    parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.')]
+    if not parts or '..' in parts:
+        raise zipfile.BadZipfile('Unsafe path in ZIP file: ' + name)
+    return os.path.join(directory, *parts)
+
+
+def get_zip64_sizes(extra, compressed_size, size):
+    """Return the sizes of a ZIP entry, taking them from its ZIP64 extra field if the header doesn't have them."""
+    while len(extra) >= 4:
+        block_id, length = struct.unpack('<HH', extra[:4])
+        data = extra[4:4 + length]
+        extra = extra[4 + length:]
+        if block_id != ZIP_EXTRA_ZIP64:
+            continue
+        if size == ZIP_MAX_32:
+            size, = struct.unpack('<Q', data[:8])
+            data = data[8:]
+        if compressed_size == ZIP_MAX_32:
+            compressed_size, = struct.unpack('<Q', data[:8])
+        return compressed_size, size, True
+    return compressed_size, size, False
+
+
+def extract_zip_entry(stream, out, method, compressed_size):
+    """Copy the data of one ZIP entry from stream to out. Return the number of bytes written and their CRC-32.
+
+    If compressed_size is None, the entry ends where its deflate stream ends, and whatever was read past it is given
+    back to the stream.
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if method == ZIP_DEFLATED else None
+    written = 0
+    crc = 0
+    remaining = compressed_size
+    while remaining is None or remaining > 0:
+        block = stream.read(EXTRACT_BLOCK_SIZE if remaining is None else min(EXTRACT_BLOCK_SIZE, remaining))
+        if not block:
+            raise zipfile.BadZipfile('Truncated ZIP file.')
+        if remaining is not None:
+            remaining -= len(block)
+        data = decompressor.decompress(block) if decompressor else block
+        out.write(data)
+        written += len(data)
+        crc = zlib.crc32(data, crc)
+        if decompressor and decompressor.unused_data:
+            stream.unread(decompressor.unused_data)
+            break
+
+    if decompressor:
+        data = decompressor.flush()
+        out.write(data)
+        written += len(data)
+        crc = zlib.crc32(data, crc)
+    return written, crc & ZIP_MAX_32
+
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise zipfile.BadZipfile('Truncated ZIP file.')
+    return data
+
+
+def extract_zip_stream(stream, directory):
+    """Extract the entries of a ZIP file from a stream, in the order of their local headers.
+
+    Return the number of bytes extracted. Raise StreamingNotSupported for archives that need their central directory,
+    like encrypted entries or stored entries of unknown size.
+    """
+    extracted = 0
+    entries = 0
+    while True:
+        header = stream.read(ZIP_LOCAL_HEADER.size)
+        if header[:4] != ZIP_LOCAL_HEADER_SIGNATURE:
+            # The central directory, or the end of the file.
+            if not entries:
+                raise StreamingNotSupported('the archive does not start with a local file header')
+            return extracted
+        if len(header) != ZIP_LOCAL_HEADER.size:
+            raise zipfile.BadZipfile('Truncated ZIP file.')
+
+        (_, _, flags, method, _, _, crc, compressed_size, size, name_length,
+         extra_length) = ZIP_LOCAL_HEADER.unpack(header)
+        name = read_exactly(stream, name_length).decode('utf-8' if flags & ZIP_FLAG_UTF8 else 'cp437')
+        compressed_size, size, zip64 = get_zip64_sizes(read_exactly(stream, extra_length), compressed_size, size)
+        entries += 1
+
+        has_descriptor = flags & ZIP_FLAG_DATA_DESCRIPTOR
+        is_directory = name.endswith('/')
+        if flags & ZIP_FLAG_ENCRYPTED:
+            raise StreamingNotSupported(name + ' is encrypted')
+        if method not in (0, ZIP_DEFLATED):
+            raise StreamingNotSupported(name + ' uses compression method ' + str(method))
+
+        if has_descriptor:
+            # Deflated entries end with their deflate stream. Stored ones can only be read if they are empty, like the
+            # directories and empty files written by zip when it streams to a pipe.
+            compressed_size = None if method == ZIP_DEFLATED else 0
+
+        path = get_extract_path(directory, name)
+        if not os.path.isdir(path if is_directory else os.path.dirname(path)):
+            os.makedirs(path if is_directory else os.path.dirname(path))
+        with open(os.devnull if is_directory else path, 'wb') as out:
+            written, actual_crc = extract_zip_entry(stream, out, method, compressed_size)
+
+        if has_descriptor:
+            descriptor = read_exactly(stream, 4)
+            if descriptor == ZIP_DATA_DESCRIPTOR_SIGNATURE:
+                descriptor = b''
+            elif method != ZIP_DEFLATED:
+                raise StreamingNotSupported(name + ' is stored with an unknown size')
+            descriptor += read_exactly(stream, (20 if zip64 else 12) - len(descriptor))
+            crc, compressed_size, size = struct.unpack('<IQQ' if zip64 else '<III', descriptor)
+            if method != ZIP_DEFLATED and compressed_size:
+                raise StreamingNotSupported(name + ' is stored with an unknown size')
+
+        if written != size or actual_crc != crc:
+            raise zipfile.BadZipfile('Corrupt ZIP file entry: ' + name)
+        extracted += written
+
+
+def extract_range(s3, bucket, key, etag, start, end, directory, counters):
+    """Extract the ZIP entries stored between the offsets start and end of an S3 object, while downloading them."""
+    stream = S3Stream(s3, bucket, key, etag, start, end)
+    started = time.time()
+    try:
+        counters.add('extract', extract_zip_stream(stream, directory), time.time() - started)
+    finally:
+        stream.close()
+        counters.add('fetch', stream.bytes, (stream.finished or time.time()) - stream.started)
+
+
+class TailTooShort(Exception):
+    def __init__(self, offset):
+        Exception.__init__(self, offset)
+        self.offset = offset
+
+
+class TailFile(object):
+    """Just enough of a file object for zipfile to read a central directory from the last bytes of an archive."""
+
+    def __init__(self, data, size):
+        self.data = data
+        self.start = size - len(data)
+        self.size = size
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        self.position = {0: 0, 1: self.position, 2: self.size}[whence] + offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if self.position < self.start:
+            raise TailTooShort(self.position)
+        if size is None or size < 0:
+            size = self.size - self.position
+        data = self.data[self.position - self.start:self.position - self.start + size]
+        self.position += len(data)
+        return data
+
+
+def read_central_directory(s3, bucket, key, etag, size, counters):
+    """Return the entries of a ZIP file in S3, in the order they are stored, and the offset of its central directory.
+
+    Only the end of the file is downloaded.
+    """
+    tail_size = min(size, ZIP_TAIL_SIZE)
+    while True:
+        started = time.time()
+        tail = s3.get_object(
+            Bucket=bucket,
+            Key=key,
+            Range='bytes=%d-%d' % (size - tail_size, size - 1),
+            IfMatch=etag
+        )['Body'].read()
+        counters.add('fetch', len(tail), time.time() - started)
+
+        try:
+            z = zipfile.ZipFile(TailFile(tail, size))
+        except TailTooShort as e:
+            if e.offset < 0 or size - e.offset <= tail_size:
+                raise StreamingNotSupported('the central directory is out of bounds')
+            tail_size = size - e.offset
+            continue
+        except zipfile.BadZipfile as e:
+            raise StreamingNotSupported(str(e))
+        return sorted(z.infolist(), key=lambda i: i.header_offset), z.start_dir
+
+
+# Asset cache
+
+
+class AssetCache(object):
+    """Files from scene archives, shared by all worker tasks on a container instance through a host volume.
+
+    Files are keyed by their path in the archive and the CRC-32 and size its central directory lists for them, so they
+    can be found before anything else of the archive is downloaded. CRC-32 alone doesn't tell files apart well enough,
+    so scenes share a file if they keep it under the same path. Copies are checked against the CRC-32, and damaged
+    ones are downloaded instead. New files are written to a
+    temporary name and renamed into place, readers open a file before copying it, and eviction of the least recently
+    used files holds an exclusive flock, so tasks and render slots can share the cache without further locking.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        for d in ('files', 'tmp'):
+            make_dirs(os.path.join(directory, d))
+
+    def get_key(self, info):
+        if (info.file_size < ASSET_CACHE_MIN_ENTRY_SIZE or info.file_size > self.max_bytes or
+                info.filename.endswith('/') or info.flag_bits & ZIP_FLAG_ENCRYPTED):
+            return None
+        name = info.filename.encode('utf-8') if not isinstance(info.filename, bytes) else info.filename
+        return '%08x-%d-%s' % (info.CRC, info.file_size, hashlib.sha256(name).hexdigest()[:32])
+
+    def get_path(self, key):
+        return os.path.join(self.directory, 'files', key[:2], key)
+
+    def get(self, key, path, crc):
+        """Copy a cached file to path. Return False if it isn't cached, or its copy doesn't have the given CRC-32."""
+        try:
+            source = open(self.get_path(key), 'rb')
+        except (IOError, OSError):
+            return False
+        actual = 0
+        with source:
+            try:
+                os.utime(self.get_path(key), None)  # Most recently used.
+            except OSError:
+                pass  # Evicted in the meantime. The open file can still be read.
+            make_dirs(os.path.dirname(path))
+            with open(path, 'wb') as out:
+                for chunk in iter(lambda: source.read(TRANSFER_CHUNK_SIZE), b''):
+                    actual = zlib.crc32(chunk, actual)
+                    out.write(chunk)
+        if actual & 0xffffffff != crc:
+            log('ERROR: Asset cache file ' + key + ' is damaged, removing it.')
+            remove_file(self.get_path(key))
+            remove_file(path)
+            return False
+        return True
+
+    def put(self, key, path):
+        target = self.get_path(key)
+        if os.path.exists(target):
+            return
+        make_dirs(os.path.dirname(target))
+        temporary = os.path.join(
+            self.directory, 'tmp', '%d-%d-%s' % (os.getpid(), threading.current_thread().ident, key)
+        )
+        try:
+            shutil.copyfile(path, temporary)
+            os.rename(temporary, target)
+        except (IOError, OSError) as e:
+            log('ERROR: Could not add ' + path + ' to the asset cache: ' + repr(e))
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def count(self, hits, misses, hit_bytes):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.hit_bytes += hit_bytes
+
+    def summary(self):
+        with self.lock:
+            return '%d hit(s), %d miss(es), %.1f MB from cache' % (self.hits, self.misses, self.hit_bytes / 1e6)
+
+    def evict(self):
+        """Delete the least recently used files until the cache fits into its size. One task evicts at a time."""
+        with open(os.path.join(self.directory, 'lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return  # Somebody else is evicting right now.
+
+            now = time.time()
+            files = []
+            for root, _, names in os.walk(self.directory):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if root == os.path.join(self.directory, 'tmp'):
+                        if now - stat.st_mtime > ASSET_CACHE_TMP_MAX_AGE:
+                            remove_file(path)
+                    elif root != self.directory:
+                        files.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in files)
+            if total <= self.max_bytes:
+                return
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes * ASSET_CACHE_EVICT_TO:
+                    break
+                remove_file(path)
+                total -= size
+
+
+asset_cache = None  # The AssetCache, if the task has one.
+
+
+def make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def extract_with_asset_cache(s3, bucket, key, size, etag, directory, counters):
+    """Extract a ZIP file from S3, copying the files the asset cache has and downloading only the others."""
+    entries, end = read_central_directory(s3, bucket, key, etag, size, counters)
+    downloaded = []
+    run_start = None  # Offset of the first entry of the current run of entries to download.
+    hits = 0
+    hit_bytes = 0
+    started = time.time()
+    for i, info in enumerate(entries + [None]):
+        offset = info.header_offset if info else end
+        cache_key = asset_cache.get_key(info) if info else None
+        path = get_extract_path(directory, info.filename) if info else None
+        if info and not (cache_key and asset_cache.get(cache_key, path, info.CRC)):
+            if cache_key:
+                downloaded.append((cache_key, info))
+            if run_start is None:
+                run_start = offset
+            continue
+
+        if info:
+            hits += 1
+            hit_bytes += info.file_size
+        if run_start is not None:
+            counters.add('extract', 0, time.time() - started)
+            extract_range(s3, bucket, key, etag, run_start, offset, directory, counters)
+            started = time.time()
+            run_start = None
+    counters.add('extract', hit_bytes, time.time() - started)
+
+    for cache_key, info in downloaded:
+        asset_cache.put(cache_key, get_extract_path(directory, info.filename))
+    asset_cache.count(hits, len(downloaded), hit_bytes)
+    asset_cache.evict()
+    log('Asset cache: %d of %d file(s) from cache (%.1f MB).' % (hits, hits + len(downloaded), hit_bytes / 1e6))
+
+
+def fetch_and_extract(s3, bucket, key, directory, counters, etag=None):
+    """Download a ZIP file from S3 and extract it into directory, both at the same time where possible.
+
+    Return the ETag of the file. If an ETag is given, raise SceneChanged if the file has a different one. S3 event
+    records have ETags without the quotes the S3 API puts around them, so those don't count.
+    """
+    head = s3.head_object(Bucket=bucket, Key=key)
+    if etag and head['ETag'].strip('"') != etag.strip('"'):
+        raise SceneChanged(key)
+    size = head['ContentLength']
+    try:
+        if asset_cache and size >= ASSET_CACHE_MIN_ARCHIVE_SIZE:
+            extract_with_asset_cache(s3, bucket, key, size, head['ETag'], directory, counters)
+        else:
+            extract_range(s3, bucket, key, head['ETag'], 0, size, directory, counters)
+        return head['ETag']
+    except StreamingNotSupported as e:
+        log('Can\'t unzip ' + key + ' while downloading it (' + str(e) + '), downloading it first...')
+
+    shutil.rmtree(directory)
+    os.makedirs(directory)
+    archive = directory + '.zip'
+    try:
+        started = time.time()
+        s3.download_file(bucket, key, archive, Config=TRANSFER_CONFIG)
+        counters.add('fetch', os.path.getsize(archive), time.time() - started)
+
+        started = time.time()
+        with zipfile.ZipFile(archive) as z:
+            z.extractall(directory)
+            counters.add('extract', sum(i.file_size for i in z.infolist()), time.time() - started)
+    finally:
+        if os.path.exists(archive):
+            os.remove(archive)
+    return head['ETag']
+
+
+def upload_file(s3, path, bucket, key, counters):
+    started = time.time()
+    s3.upload_file(path, bucket, key, Config=TRANSFER_CONFIG)
+    counters.add('upload', os.path.getsize(path), time.time() - started)
+
+
+# Result cache
+
+
+povray_version = None  # Output of "povray --version", or None if the result cache is off.
+result_cache_statistics = {'hit': 0, 'miss': 0}
+result_cache_lock = threading.Lock()
+
+
+def get_povray_version():
+    try:
+        process = subprocess.Popen(['povray', '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0].decode('utf-8', 'replace')
+    except OSError:
+        return None
+    lines = [l.strip() for l in output.splitlines() if l.strip()]
+    return lines[0] if process.returncode == 0 and lines else None
+
+
+def count_result(outcome):
+    with result_cache_lock:
+        result_cache_statistics[outcome] += 1
+
+
+def get_scene_hash(directory, options):
+    """Return a hash of everything in a scene directory that affects the rendered image.
+
+    Text files are hashed with normalized line endings and without trailing blanks, and files archivers add on their
+    own are left out, so that the same scene zipped on another system has the same hash.
+    """
+    scene = hashlib.sha256()
+    scene.update(json.dumps([povray_version, options]).encode('utf-8'))
+    for root, directories, names in os.walk(directory):
+        directories[:] = sorted(d for d in directories if d not in SCENE_IGNORED_DIRECTORIES)
+        for name in sorted(names):
+            if name in SCENE_IGNORED_NAMES:
+                continue
+            path = os.path.join(root, name)
+            content = hashlib.sha256()
+            with open(path, 'rb') as f:
+                if os.path.splitext(name)[1].lower() in SCENE_TEXT_EXTENSIONS:
+                    content.update(b'\n'.join(l.rstrip() for l in f.read().splitlines()))
+                else:
+                    for block in iter(lambda: f.read(TRANSFER_CHUNK_SIZE), b''):
+                        content.update(block)
+            relative = os.path.relpath(path, directory).replace(os.sep, '/')
+            if not isinstance(relative, bytes):
+                relative = relative.encode('utf-8')
+            scene.update(relative + b'\0' + content.hexdigest().encode('ascii') + b'\0')
+    return scene.hexdigest()
+
+
+def copy_cached_result(s3, bucket, scene_hash, key):
+    """Copy the image of an earlier rendering of the same scene to key, inside S3. Return False if there is none."""
+    try:
+        s3.copy_object(Bucket=bucket, Key=key, CopySource={'Bucket': bucket, 'Key': RESULT_CACHE_PREFIX + scene_hash})
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return False
+        raise
+
+
+def store_result(s3, bucket, key, scene_hash):
+    try:
+        s3.copy_object(Bucket=bucket, Key=RESULT_CACHE_PREFIX + scene_hash, CopySource={'Bucket': bucket, 'Key': key})
+    except ClientError as e:
+        log('ERROR: Could not add ' + key + ' to the result cache: ' + repr(e))
+
+
+# Render profiles
+
+
+def read_peak_memory(pid):
+    """Return the most memory, in MB, a running process has used so far, or 0 if unknown."""
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+def run_povray(args, work_dir, counters):
+    """Run POV-Ray with the given arguments and return its exit status, negative if a signal ended it.
+
+    Adds the run time to the render stage of counters, and the CPU seconds and peak memory of the process to their
+    usage. The peak memory is read from /proc while POV-Ray runs, as the resource usage of a child process also counts
+    the memory of the worker it was forked from.
+    """
+    started = time.time()
+    process = subprocess.Popen(['povray'] + args, cwd=work_dir)
+    peak_memory = [0]
+    exited = threading.Event()
+
+    def watch():
+        while not exited.wait(PROFILE_POLL_INTERVAL):
+            peak_memory[0] = max(peak_memory[0], read_peak_memory(process.pid))
+
+    watcher = threading.Thread(target=watch, name=threading.current_thread().name + '-povray')
+    watcher.daemon = True
+    watcher.start()
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    finally:
+        exited.set()
+        watcher.join()
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    counters.add('render', 0, time.time() - started)
+    counters.add_usage(usage.ru_utime + usage.ru_stime, peak_memory[0] or usage.ru_maxrss // 1024)
+    return process.returncode
+
+
+def get_scene_family(key):
+    """Return the scene family of a key: the key without its extension and trailing numbers.
+
+    The frames, shots or versions of a scene, like shot-010.zip and shot-020.zip, share the render profile of shot.
+    """
+    base = os.path.splitext(key)[0]
+    return PROFILE_FAMILY.sub('', base) or base
+
+
+def record_profile(s3, job, counters, threads):
+    """Add the POV-Ray usage of a job to the render profile of its scene family, keeping PROFILE_SAMPLES samples.
+
+    Two workers that update the same profile at the same moment may overwrite each other's sample, which leaves the
+    profile one sample short. A profile that can't be updated is logged, the job still counts as done.
+    """
+    key = PROFILE_PREFIX + get_scene_family(job['key']) + '.json'
+    sample = {
+        'peak_memory': counters.peak_memory,
+        'cpu_seconds': round(counters.cpu_seconds, 3),
+        'seconds': round(counters.seconds['render'], 3),
+        'threads': threads,
+        'size_class': SIZE_CLASS,
+        'part': 'tile' if 'tile' in job else 'frames' if 'frames' in job else 'scene',
+        'time': int(time.time())
+    }
+    try:
+        try:
+            profile = json.loads(s3.get_object(Bucket=job['bucket'], Key=key)['Body'].read().decode('utf-8'))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey'):
+                raise
+            profile = {}
+        profile['family'] = get_scene_family(job['key'])
+        profile['samples'] = (profile.get('samples', []) + [sample])[-PROFILE_SAMPLES:]
+        s3.put_object(
+            Bucket=job['bucket'],
+            Key=key,
+            Body=json.dumps(profile, sort_keys=True).encode('utf-8'),
+            ContentType='application/json'
+        )
+    except (ClientError, ValueError) as e:
+        log('ERROR: Could not update render profile ' + key + ': ' + repr(e))
+
+
+# Tiles
+
+
+def is_on(value):
+    return value is not None and value.strip('"').lower() in ('on', 'true', 'yes', '1')
+
+
+def read_ini_options(path):
+    """Return the options of a POV-Ray INI file as a dict with lowercase keys.
+
+    Switches like +W800 are stored under the name of the option they stand for, as far as the worker needs them.
+    """
+    options = {}
+    with open(path, 'rb') as f:
+        for line in f.read().decode('latin-1').splitlines():
+            line = line.split(';')[0].strip()
+            if not line:
+                continue
+            if '=' in line and line[0] not in '+-':
+                key, value = line.split('=', 1)
+                options[key.strip().lower()] = value.strip().strip('"')
+                continue
+            for switch in line.split():
+                match = INI_NUMBER_SWITCH.match(switch)
+                if match:
+                    options[INI_NUMBER_SWITCH_OPTIONS[match.group(1).lower()]] = match.group(2)
+                match = INI_ALPHA_SWITCH.match(switch)
+                if match:
+                    options['output_alpha'] = 'on' if match.group(1) == '+' else 'off'
+                match = INI_FILE_TYPE_SWITCH.match(switch)
+                if match:
+                    options['output_file_type'] = match.group(1)
+                    if match.group(2):
+                        options['bits_per_color'] = match.group(2)
+    return options
+
+
+def get_aligned_edges(size, parts):
+    edges = [int(round(float(size) * i / parts / TILE_ALIGNMENT)) * TILE_ALIGNMENT for i in range(1, parts)]
+    return sorted(set([0, size] + [e for e in edges if 0 < e < size]))
+
+
+def get_tile_regions(width, height):
+    """Split a frame into about TILE_PIXELS sized tiles: rows first, columns too if the rows get too thin.
+
+    Regions are (first row, end row, first column, end column), counted from 0 and without their end.
+    """
+    count = int(math.ceil(float(width * height) / TILE_PIXELS))
+    rows = max(1, min(count, height // TILE_ALIGNMENT))
+    columns = max(1, min(int(math.ceil(float(count) / rows)), width // TILE_ALIGNMENT))
+    row_edges = get_aligned_edges(height, rows)
+    column_edges = get_aligned_edges(width, columns)
+    return [
+        (r0, r1, c0, c1) for r0, r1 in zip(row_edges, row_edges[1:]) for c0, c1 in zip(column_edges, column_edges[1:])
+    ]
+
+
+def plan_tiles(options, name):
+    """Return the frame size and tile regions of a scene with these INI options, or None to render it whole."""
+    if not TILE_MIN_PIXELS:
+        return None
+
+    try:
+        width = int(options.get('width', POVRAY_DEFAULT_SIZE[0]))
+        height = int(options.get('height', POVRAY_DEFAULT_SIZE[1]))
+    except ValueError:
+        return None
+    if width * height < TILE_MIN_PIXELS:
+        return None
+
+    # Tiles are rendered as 8 bit PPM files, so only 8 bit PNG output without alpha can be put together from them.
+    if (is_on(options.get('output_alpha')) or options.get('output_file_type', 'N').upper() != 'N' or
+            options.get('bits_per_color', '8') != '8'):
+        log('Scene ' + name + ' is not written as an 8 bit PNG file without alpha, rendering it in one piece.')
+        return None
+    if set(options) & set(['start_row', 'end_row', 'start_column', 'end_column']):
+        log('Scene ' + name + ' renders only part of its frame, rendering it in one piece.')
+        return None
+
+    regions = get_tile_regions(width, height)
+    return (width, height, regions) if len(regions) > 1 else None
+
+
+def get_tile_prefix(job_id):
+    return TILE_PREFIX + job_id + '/'
+
+
+def get_tile_key(job_id, index):
+    return get_tile_prefix(job_id) + '%05d.ppm' % index
+
+
+def send_messages(sqs, queue_url, bodies):
+    for i in range(0, len(bodies), RECEIVE_MAX_MESSAGES):
+        batch = bodies[i:i + RECEIVE_MAX_MESSAGES]
+        result = sqs.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': str(j), 'MessageBody': b} for j, b in enumerate(batch)]
+        )
+        failed = result.get('Failed', [])
+        if failed:
+            raise RuntimeError(
+                str(len(failed)) + ' message(s) not sent, first error: ' + failed[0].get('Message', '')
+            )
+
+
+def get_part_body(kind, job, part):
+    """Return the message body for a tile or a chunk of frames of a job. Parts keep the size class of their job."""
+    body = {kind: part}
+    if job.get('size_class'):
+        body['SizeClass'] = job['size_class']
+    return json.dumps(body)
+
+
+def request_workers(clients, job, count):
+    """Ask the launcher function to start tasks for the count messages this worker queued for parts of a job."""
+    if not LAUNCHER_FUNCTION:
+        return
+    event = {'ScaleWorkers': True}
+    if job.get('size_class'):
+        event['Jobs'] = {job['size_class']['name']: count}
+    try:
+        clients['lambda'].invoke(
+            FunctionName=LAUNCHER_FUNCTION,
+            InvocationType='Event',
+            Payload=json.dumps(event).encode('utf-8')
+        )
+    except ClientError as e:
+        log('ERROR: Could not invoke ' + LAUNCHER_FUNCTION + ': ' + repr(e))
+
+
+def queue_tiles(clients, job, etag, scene_hash, width, height, regions):
+    clients['s3'].put_object(
+        Bucket=job['bucket'],
+        Key=get_tile_prefix(job['id']) + 'plan.json',
+        Body=json.dumps({'size': [width, height], 'regions': regions, 'scene': scene_hash}).encode('utf-8'),
+        ContentType='application/json'
+    )
+    send_messages(clients['sqs'], job['queue'], [
+        get_part_body('Tile', job, {
+            'bucket': job['bucket'],
+            'key': job['key'],
+            'etag': etag,
+            'job': job['id'],
+            'index': i,
+            'count': len(regions),
+            'region': list(r)
+        })
+        for i, r in enumerate(regions)
+    ])
+    request_workers(clients, job, len(regions))
+
+
+def read_ppm(path):
+    """Return the pixels of a binary PPM file as an array of rows of RGB values."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    match = PPM_HEADER.match(data)
+    if not match:
+        raise PermanentFailure('Not a binary PPM file: ' + path)
+    width, height, maximum = [int(g) for g in match.groups()]
+    dtype = numpy.dtype(numpy.uint8) if maximum < 256 else numpy.dtype('>u2')
+    return numpy.frombuffer(data, dtype, width * height * 3, match.end()).reshape(height, width, 3)
+
+
+def write_png_chunk(f, chunk_type, data):
+    f.write(struct.pack('>I', len(data)))
+    f.write(chunk_type + data)
+    f.write(struct.pack('>I', zlib.crc32(chunk_type + data) & ZIP_MAX_32))
+
+
+def write_png(path, pixels):
+    """Write an array of rows of RGB values as a PNG file. All rows use the Up filter, computed in one go."""
+    height, width, _ = pixels.shape
+    depth = pixels.dtype.itemsize * 8
+    rows = numpy.ascontiguousarray(pixels, pixels.dtype.newbyteorder('>')).view(numpy.uint8).reshape(height, -1)
+    filtered = rows.copy()
+    filtered[1:] -= rows[:-1]
+    filtered = numpy.hstack([numpy.empty((height, 1), numpy.uint8), filtered])
+    filtered[:, 0] = PNG_FILTER_UP
+
+    with open(path, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        write_png_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, depth, 2, 0, 0, 0))
+        write_png_chunk(f, b'IDAT', zlib.compress(filtered.data, 6))
+        write_png_chunk(f, b'IEND', b'')
+
+
+def count_objects(s3, bucket, prefix, suffix):
+    count = 0
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        count += len([o for o in page.get('Contents', []) if o['Key'].endswith(suffix)])
+    return count
+
+
+def object_exists(s3, bucket, key):
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return False
+        raise
+
+
+def claim_object(s3, bucket, key, owner):
+    """Create key with owner as its body, unless it exists. Return whether owner holds the claim now.
+
+    Of the workers that finish the last parts of a job at the same time, only the one whose conditional PUT
+    succeeds puts the parts together. A redelivered message of that part claims it again, in case it was interrupted.
+    """
+    try:
+        s3.put_object(Bucket=bucket, Key=key, Body=owner.encode('utf-8'), IfNoneMatch='*')
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+    try:
+        return s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8') == owner
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            return False
+        raise
+
+
+def add_conditional_put(s3):
+    """Let s3.put_object() take IfNoneMatch, also with botocore releases that predate S3 conditional writes."""
+    def take_parameter(params, context, **kwargs):
+        if 'IfNoneMatch' in params:
+            context['if_none_match'] = params.pop('IfNoneMatch')
+
+    def add_header(params, context, **kwargs):
+        if 'if_none_match' in context:
+            params['headers']['If-None-Match'] = context['if_none_match']
+
+    s3.meta.events.register('provide-client-params.s3.PutObject', take_parameter)
+    s3.meta.events.register('before-call.s3.PutObject', add_header)
+
+
+def stitch_tiles(clients, tile, name, base, work_dir, counters):
+    """Put the images of all tiles of a frame together and upload the frame's image next to the scene."""
+    s3 = clients['s3']
+    bucket = tile['bucket']
+    prefix = get_tile_prefix(tile['job'])
+    log('All ' + str(tile['count']) + ' tiles of ' + tile['key'] + ' are rendered, stitching them...')
+    started = time.time()
+    try:
+        plan = json.loads(s3.get_object(Bucket=bucket, Key=prefix + 'plan.json')['Body'].read().decode('utf-8'))
+        width, height = plan['size']
+        frame = None
+        path = os.path.join(work_dir, name + '-tile.ppm')
+        for i, (r0, r1, c0, c1) in enumerate(plan['regions']):
+            s3.download_file(bucket, get_tile_key(tile['job'], i), path, Config=TRANSFER_CONFIG)
+            pixels = read_ppm(path)
+            if frame is None:
+                frame = numpy.zeros((height, width, 3), pixels.dtype)
+            # POV-Ray writes either the whole frame, with only the tile rendered, or just the tile.
+            if pixels.shape[:2] == (height, width):
+                frame[r0:r1, c0:c1] = pixels[r0:r1, c0:c1]
+            elif pixels.shape[:2] == (r1 - r0, c1 - c0):
+                frame[r0:r1, c0:c1] = pixels
+            else:
+                raise PermanentFailure('Tile %d of %s has an unexpected size: %dx%d.' % (
+                    i, tile['key'], pixels.shape[1], pixels.shape[0]
+                ))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            log('Tiles of ' + tile['key'] + ' were already stitched.')
+            return
+        raise
+
+    image = os.path.join(work_dir, name + '.png')
+    write_png(image, frame)
+    counters.add('stitch', os.path.getsize(image), time.time() - started)
+
+    log('Copying result image ' + name + '.png to s3://' + bucket + '/' + base + '.png...')
+    upload_file(s3, image, bucket, base + '.png', counters)
+    if plan['scene']:
+        store_result(s3, bucket, base + '.png', plan['scene'])
+    # Before the tiles go, so that a late copy of a tile (see render_tile()) finds it and removes itself.
+    s3.put_object(Bucket=bucket, Key=prefix + 'stitched', Body=b'')
+    s3.delete_objects(Bucket=bucket, Delete={'Objects': [
+        {'Key': k} for k in [prefix + 'plan.json'] + [get_tile_key(tile['job'], i) for i in range(tile['count'])]
+    ]})
+
+
+def render_tile(clients, tile, name, base, work_dir, threads, counters):
+    s3 = clients['s3']
+    r0, r1, c0, c1 = tile['region']
+    log('Rendering tile %d of %d of POV-Ray scene %s (rows %d-%d, columns %d-%d)...' % (
+        tile['index'] + 1, tile['count'], name, r0 + 1, r1, c0 + 1, c1
+    ))
+    output = name + '-tile.ppm'
+    returncode = run_povray([
+        '+WT' + str(threads), name,
+        '+SR%d' % (r0 + 1), '+ER%d' % r1, '+SC%d' % (c0 + 1), '+EC%d' % c1,
+        '+FP', '+O' + output
+    ], work_dir, counters)
+    if returncode != 0 or not os.path.isfile(os.path.join(work_dir, output)):
+        raise PermanentFailure('POV-Ray source did not render tile ' + str(tile['index'] + 1) + ' successfully.')
+
+    bucket = tile['bucket']
+    prefix = get_tile_prefix(tile['job'])
+    upload_file(s3, os.path.join(work_dir, output), bucket, get_tile_key(tile['job'], tile['index']), counters)
+    os.remove(os.path.join(work_dir, output))
+    if object_exists(s3, bucket, prefix + 'stitched'):
+        # A message that was delivered twice, after the frame was stitched without this copy.
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': get_tile_key(tile['job'], tile['index'])}]})
+        return
+    if count_objects(s3, bucket, prefix, '.ppm') != tile['count']:
+        return
+    if claim_object(s3, bucket, prefix + 'stitch', str(tile['index'])):
+        stitch_tiles(clients, tile, name, base, work_dir, counters)
+
+
+# Animations
+
+
+def get_frame_range(options):
+    """Return the first and last frame an animation scene renders, or None for a still."""
+    try:
+        first = int(float(options.get('initial_frame', 1)))
+        last = int(float(options.get('final_frame', first)))
+        subset_first = int(float(options.get('subset_start_frame', first)))
+        subset_last = int(float(options.get('subset_end_frame', last)))
+    except ValueError:
+        return None
+    if last <= first:
+        return None
+    return max(first, subset_first), min(last, subset_last)
+
+
+def get_frames_prefix(job_id):
+    return FRAMES_PREFIX + job_id + '/'
+
+
+def queue_frames(clients, job, etag, first, last):
+    chunks = [(f, min(f + ANIMATION_CHUNK_FRAMES - 1, last)) for f in range(first, last + 1, ANIMATION_CHUNK_FRAMES)]
+    send_messages(clients['sqs'], job['queue'], [
+        get_part_body('Frames', job, {
+            'bucket': job['bucket'],
+            'key': job['key'],
+            'etag': etag,
+            'job': job['id'],
+            'index': i,
+            'count': len(chunks),
+            'frames': list(c)
+        })
+        for i, c in enumerate(chunks)
+    ])
+    request_workers(clients, job, len(chunks))
+
+
+def write_animation_manifest(s3, frames, base):
+    """Write ${base}.manifest.json with all frames of an animation, once all of its chunks are done."""
+    bucket = frames['bucket']
+    prefix = get_frames_prefix(frames['job'])
+    chunks = []
+    try:
+        for i in range(frames['count']):
+            chunks.append(json.loads(
+                s3.get_object(Bucket=bucket, Key=prefix + '%05d.json' % i)['Body'].read().decode('utf-8')
+            ))
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+            log('Manifest of ' + frames['key'] + ' was already written.')
+            return
+        raise
+    log('All ' + str(frames['count']) + ' chunks of ' + frames['key'] + ' are rendered, writing its manifest...')
+    s3.put_object(
+        Bucket=bucket,
+        Key=base + '.manifest.json',
+        Body=json.dumps({
+            'scene': frames['key'],
+            'etag': frames['etag'],
+            'first_frame': chunks[0]['frames'][0],
+            'last_frame': chunks[-1]['frames'][1],
+            'frames': [k for c in chunks for k in c['keys']],
+            'completed': time.time()
+        }, indent=4).encode('utf-8'),
+        ContentType='application/json'
+    )
+    # Before the records go, so that the record of a late chunk (see render_frames()) finds it and removes itself.
+    s3.put_object(Bucket=bucket, Key=prefix + 'manifested', Body=b'')
+    s3.delete_objects(Bucket=bucket, Delete={'Objects': [
+        {'Key': prefix + '%05d.json' % i} for i in range(frames['count'])
+    ]})
+
+
+def render_frames(clients, frames, name, base, work_dir, threads, counters):
+    s3 = clients['s3']
+    bucket = frames['bucket']
+    first, last = frames['frames']
+    log('Rendering frames %d-%d (chunk %d of %d) of POV-Ray scene %s...' % (
+        first, last, frames['index'] + 1, frames['count'], name
+    ))
+    scene_files = set(os.listdir(work_dir))
+    returncode = run_povray(['+WT' + str(threads), name, '+SF%d' % first, '+EF%d' % last], work_dir, counters)
+    images = sorted(f for f in set(os.listdir(work_dir)) - scene_files if os.path.isfile(os.path.join(work_dir, f)))
+    if returncode != 0 or not images:
+        raise PermanentFailure('POV-Ray source did not render frames %d-%d successfully.' % (first, last))
+
+    # Frames go next to the scene, named like POV-Ray names them.
+    keys = [base[:len(base) - len(name)] + f for f in images]
+    log('Copying ' + str(len(images)) + ' frame(s) to s3://' + bucket + '/' + keys[0] + ' and following...')
+    for f, k in zip(images, keys):
+        upload_file(s3, os.path.join(work_dir, f), bucket, k, counters)
+
+    prefix = get_frames_prefix(frames['job'])
+    s3.put_object(
+        Bucket=bucket,
+        Key=prefix + '%05d.json' % frames['index'],
+        Body=json.dumps({'frames': [first, last], 'keys': keys}).encode('utf-8'),
+        ContentType='application/json'
+    )
+    if object_exists(s3, bucket, prefix + 'manifested'):
+        # A message that was delivered twice, after the manifest was written without this record.
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': prefix + '%05d.json' % frames['index']}]})
+        return
+    if count_objects(s3, bucket, prefix, '.json') != frames['count']:
+        return
+    if claim_object(s3, bucket, prefix + 'manifest', str(frames['index'])):
+        write_animation_manifest(s3, frames, base)
+
+
+# Jobs
+
+
+def render_scene(clients, job, work_dir, threads, counters):
+    """Render a POV-Ray scene ZIP file from S3 and upload the resulting image next to it.
+
+    Large frames are split into tiles and animations into chunks of frames instead, and the jobs for those parts
+    render their part. Scenes that don't render raise PermanentFailure. Errors while talking to AWS raise other
+    exceptions, see is_permanent_failure().
+    """
+    s3 = clients['s3']
+    bucket = job['bucket']
+    key = job['key']
+    tile = job.get('tile')
+    frames = job.get('frames')
+    base, ext = os.path.splitext(key)
+    name = os.path.basename(base)
+    if ext != '.zip' or not name:
+        raise PermanentFailure('Not a POV-Ray source archive: ' + key + '.')
+
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+
+    try:
+        log('Copying and unzipping ' + key + ' from S3 bucket ' + bucket + '...')
+        try:
+            etag = fetch_and_extract(s3, bucket, key, work_dir, counters, (tile or frames or job).get('etag'))
+        except SceneChanged:
+            # The new file has a job of its own.
+            log('ERROR: ' + key + ' was replaced after this job was queued, skipping it.')
+            return
+
+        if not os.path.isfile(os.path.join(work_dir, name + '.ini')):
+            raise PermanentFailure('No ' + name + '.ini file found in POV-Ray source archive.')
+
+        if tile:
+            render_tile(clients, tile, name, base, work_dir, threads, counters)
+            return
+        if frames:
+            render_frames(clients, frames, name, base, work_dir, threads, counters)
+            return
+
+        options = read_ini_options(os.path.join(work_dir, name + '.ini'))
+        frame_range = get_frame_range(options)
+        if frame_range:
+            log('Splitting frames %d-%d of POV-Ray scene %s into chunks of %d...' % (
+                frame_range[0], frame_range[1], name, ANIMATION_CHUNK_FRAMES
+            ))
+            queue_frames(clients, job, etag, frame_range[0], frame_range[1])
+            return
+
+        scene_hash = get_scene_hash(work_dir, []) if povray_version else None
+        if scene_hash and copy_cached_result(s3, bucket, scene_hash, base + '.png'):
+            count_result('hit')
+            log('Scene ' + name + ' was rendered before, copied its image to s3://' + bucket + '/' + base + '.png.')
+            return
+        if scene_hash:
+            count_result('miss')
+
+        tiles = plan_tiles(options, name)
+        if tiles:
+            width, height, regions = tiles
+            log('Splitting the %dx%d frame of POV-Ray scene %s into %d tiles...' % (width, height, name, len(regions)))
+            queue_tiles(clients, job, etag, scene_hash, width, height, regions)
+            return
+
+        log('Rendering POV-Ray scene ' + name + '...')
+        returncode = run_povray(['+WT' + str(threads), name], work_dir, counters)
+        if returncode != 0:
+            raise PermanentFailure('POV-Ray source did not render successfully.')
+
+        image = os.path.join(work_dir, name + '.png')
+        if not os.path.isfile(image):
+            raise PermanentFailure('POV-Ray source did not generate ' + name + '.png image.')
+
+        log('Copying result image ' + name + '.png to s3://' + bucket + '/' + base + '.png...')
+        upload_file(s3, image, bucket, base + '.png', counters)
+        if scene_hash:
+            store_result(s3, bucket, base + '.png', scene_hash)
+    finally:
+        log('Cleaning up...')
+        shutil.rmtree(work_dir)
+
+
+def get_queue_wait(message):
+    """Return the seconds between sending a message and receiving it, from its SentTimestamp, or None if unknown."""
+    sent = message.get('Attributes', {}).get('SentTimestamp')
+    if not sent or 'received' not in message:
+        return None
+    return max(0.0, message['received'] - int(sent) / 1000.0)
+
+
+def log_job_metrics(job, status, counters, queue_wait, slot_wait, seconds):
+    metrics = counters.get_metrics()
+    metrics['JobSeconds'] = (seconds, 'Seconds')
+    metrics['SlotWaitSeconds'] = (slot_wait, 'Seconds')
+    if queue_wait is not None:
+        metrics['QueueWaitSeconds'] = (queue_wait, 'Seconds')
+
+    properties = {'Event': 'job', 'Status': status, 'Bucket': job['bucket'], 'Key': job['key']}
+    if SIZE_CLASS:
+        properties['SizeClass'] = SIZE_CLASS
+    for kind in ('tile', 'frames'):
+        if kind in job:
+            properties['Part'] = kind + ' ' + str(job[kind]['index'])
+    log_metrics(metrics, properties)
+
+
+def is_for_larger_task(job, message):
+    """Return True if a job needs more memory than this task has, and should be left to a task of its size class.
+
+    A job is only left to other tasks SIZE_CLASS_MAX_DEFERRALS times, in case no task of its class gets to start.
+    """
+    size_class = job.get('size_class')
+    if not size_class or not MEMORY or size_class.get('memory', 0) <= MEMORY:
+        return False
+    return int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1)) <= SIZE_CLASS_MAX_DEFERRALS
+
+
+def is_permanent_failure(e):
+    """Return True if a job that raised e would fail again when tried again: it can't be rendered, its ZIP file is
+    broken, or its bucket or file is gone. Anything else, like a ValueError from a bad response, is tried again.
+    """
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code') in PERMANENT_ERROR_CODES
+    return isinstance(e, (PermanentFailure, zipfile.BadZipfile))
+
+
+def get_retry_delay(message):
+    """Return the seconds until a message whose job failed for a transient reason is delivered again."""
+    receive_count = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+    return min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** min(receive_count - 1, 16))
+
+
+def process_message(clients, message, work_dir, threads):
+    """Render all scenes in a message. Return 'done', 'failed' (deliver again later), 'deferred' (leave it to a larger
+    task for a while) or 'rejected' (move it to the dead-letter queue, with the reason under 'error').
+    """
+    s3 = clients['s3']
+    jobs = parse_message(message)
+    if not jobs:
+        log('ERROR: Could not extract S3 bucket and key from SQS message.')
+        message['error'] = 'Could not extract S3 bucket and key from SQS message.'
+        return 'rejected'
+    if is_for_larger_task(jobs[0], message):
+        log('Leaving ' + jobs[0]['key'] + ' to a task of size class ' + jobs[0]['size_class']['name'] + '.')
+        return 'deferred'
+
+    queue_wait = get_queue_wait(message)
+    slot_wait = time.time() - message.get('received', time.time())
+    errors = []  # Of the jobs that can't succeed. The others in the message are still rendered.
+    for job in jobs:
+        try:
+            if is_job_done(s3, job):
+                log('Scene ' + job['key'] + ' has been rendered before, skipping it.')
+                continue
+
+            counters = StageCounters()
+            started = time.time()
+            status = 'failed'
+            try:
+                render_scene(clients, job, work_dir, threads, counters)
+                status = 'done'
+            except Exception as e:
+                if is_permanent_failure(e):
+                    status = 'rejected'
+                raise
+            finally:
+                stage_totals.merge(counters)
+                log_job_metrics(job, status, counters, queue_wait, slot_wait, time.time() - started)
+                if counters.cpu_seconds or counters.peak_memory:
+                    record_profile(s3, job, counters, threads)
+            mark_job_done(s3, job)
+        except Exception as e:
+            if not is_permanent_failure(e):
+                log('ERROR: Rendering ' + job['key'] + ' failed, releasing the message for redelivery: ' + repr(e))
+                return 'failed'
+            log('ERROR: Rendering ' + job['key'] + ' failed, and would fail again: ' + str(e))
+            errors.append(job['key'] + ': ' + (str(e) or repr(e)))
+
+    if errors:
+        message['error'] = ' '.join(errors)
+        return 'rejected'
+    return 'done'
+
+
+def group_by_queue(messages):
+    """Return lists of at most RECEIVE_MAX_MESSAGES messages from the same queue, for the batch calls of SQS."""
+    queues = {}
+    for m in messages:
+        queues.setdefault(m['queue'], []).append(m)
+    return [
+        (queue, batch[i:i + RECEIVE_MAX_MESSAGES])
+        for queue, batch in sorted(queues.items()) for i in range(0, len(batch), RECEIVE_MAX_MESSAGES)
+    ]
+
+
+def dead_letter(sqs, message):
+    """Send a message whose jobs can't succeed to the dead-letter queue of its lane, with the error as a message
+    attribute, before it is deleted. Return False if that failed. Without a dead-letter queue, the message is only
+    deleted.
+    """
+    if not message.get('dead_letter_queue'):
+        log('No dead-letter queue, deleting message ' + message['MessageId'] + ' of jobs that can\'t succeed.')
+        return True
+
+    log('Moving message ' + message['MessageId'] + ' to the dead-letter queue...')
+    try:
+        sqs.send_message(
+            QueueUrl=message['dead_letter_queue'],
+            MessageBody=message['Body'],
+            MessageAttributes={'Error': {
+                'DataType': 'String',
+                'StringValue': (message.get('error') or 'Unknown error.')[:DEAD_LETTER_ERROR_LENGTH]
+            }}
+        )
+        return True
+    except ClientError as e:
+        log('ERROR: Could not move message ' + message['MessageId'] + ' to the dead-letter queue: ' + repr(e))
+        return False
+
+
+def delete_messages(sqs, messages):
+    if not messages:
+        return
+
+    log('Deleting ' + str(len(messages)) + ' message(s)...')
+    started = time.time()
+    for queue, batch in group_by_queue(messages):
+        result = sqs.delete_message_batch(
+            QueueUrl=queue,
+            Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(batch)]
+        )
+        for f in result.get('Failed', []):
+            log('ERROR: Could not delete message ' + batch[int(f['Id'])]['MessageId'] + ': ' + f.get('Message', ''))
+    log_metrics({'DeleteSeconds': (time.time() - started, 'Seconds'), 'Messages': (len(messages), 'Count')}, {
+        'Event': 'delete'
+    })
+
+
+class Leases(object):
+    """Keeps received messages invisible to other workers until they are deleted or released.
+
+    A heartbeat thread extends the visibility timeout of all leased messages, 10 per call. If the worker dies, the
+    heartbeats stop and the messages become visible again after at most LEASE_TIMEOUT seconds.
+    """
+
+    def __init__(self, sqs, visibility_timeout):
+        self.sqs = sqs
+        self.messages = {}  # MessageId -> message
+        self.lock = threading.Lock()
+        # Held while a heartbeat extends leases, so that it can't undo a release made in the meantime.
+        self.extending = threading.Lock()
+        self.interval = max(1, min(LEASE_HEARTBEAT, visibility_timeout // 3, LEASE_TIMEOUT // 3))
+        heartbeat = threading.Thread(target=self.run, name='heartbeat')
+        heartbeat.daemon = True
+        heartbeat.start()
+
+    def acquire(self, messages):
+        with self.lock:
+            for m in messages:
+                self.messages[m['MessageId']] = m
+
+    def drop(self, messages):
+        """Stop extending the leases of the given messages, e.g. because they were deleted."""
+        with self.lock:
+            for m in messages:
+                self.messages.pop(m['MessageId'], None)
+
+    def release(self, message, delay=0):
+        """Make a message visible to all workers again, right away or after delay seconds."""
+        with self.extending:
+            self.drop([message])
+            try:
+                self.sqs.change_message_visibility(
+                    QueueUrl=message['queue'],
+                    ReceiptHandle=message['ReceiptHandle'],
+                    VisibilityTimeout=delay
+                )
+            except ClientError as e:
+                log('ERROR: Could not release message ' + message['MessageId'] + ': ' + repr(e))
+
+    def extend(self):
+        with self.extending:
+            with self.lock:
+                messages = list(self.messages.values())
+
+            for queue, batch in group_by_queue(messages):
+                try:
+                    result = self.sqs.change_message_visibility_batch(
+                        QueueUrl=queue,
+                        Entries=[
+                            {'Id': str(j), 'ReceiptHandle': m['ReceiptHandle'], 'VisibilityTimeout': LEASE_TIMEOUT}
+                            for j, m in enumerate(batch)
+                        ]
+                    )
+                    for f in result.get('Failed', []):
+                        log('ERROR: Could not extend lease of message ' + batch[int(f['Id'])]['MessageId'] + '.')
+                except ClientError as e:
+                    log('ERROR: Could not extend leases: ' + repr(e))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.extend()
+
+
+class Lanes(object):
+    """The queues the worker polls, highest priority first, with weighted-fair selection between them.
+
+    Each lane has a pass value that grows by 1 / weight whenever the lane is polled, and the lane with the lowest pass
+    value is polled first (stride scheduling). Lanes with messages are polled in proportion to their weights, so next
+    to lanes of weights 6 and 3, a lane of weight 1 still gets one of every 10 polls, however busy the others are.
+    Without QUEUE_LANES, there is one lane, SQS_QUEUE_URL.
+    """
+
+    def __init__(self, sqs):
+        self.sqs = sqs
+        self.lanes = QUEUE_LANES or [
+            {'name': '', 'url': QUEUE_URL, 'dead_letter_url': DEAD_LETTER_QUEUE_URL, 'weight': 1}
+        ]
+        self.passes = [0.0] * len(self.lanes)
+
+    def poll(self, rank, wait, count):
+        lane = self.lanes[rank]
+        self.passes[rank] += 1.0 / max(lane['weight'], 1)
+        started = time.time()
+        messages = self.sqs.receive_message(
+            QueueUrl=lane['url'],
+            MaxNumberOfMessages=min(RECEIVE_MAX_MESSAGES, count),
+            WaitTimeSeconds=wait,
+            AttributeNames=['SentTimestamp', 'ApproximateReceiveCount']
+        ).get('Messages', [])
+        received = time.time()
+        log_metrics({'PollSeconds': (received - started, 'Seconds'), 'Messages': (len(messages), 'Count')}, {
+            'Event': 'poll',
+            'Lane': lane['name']
+        })
+        for m in messages:
+            m['queue'] = lane['url']
+            m['dead_letter_queue'] = lane.get('dead_letter_url')
+            m['lane'] = rank
+            m['received'] = received  # For the time it waits for a render slot.
+        return messages
+
+    def receive(self, idle, count):
+        """Return up to count messages of the first lane with any, in weighted-fair order, or [] if all are empty.
+
+        If idle, and no lane has messages right away, long poll each lane in turn, RECEIVE_WAIT_TIME seconds in all.
+        """
+        waits = [0]
+        if idle:
+            waits = [0, max(1, RECEIVE_WAIT_TIME // len(self.lanes))] if len(self.lanes) > 1 else [RECEIVE_WAIT_TIME]
+        for wait in waits:
+            for rank in sorted(range(len(self.lanes)), key=lambda r: (self.passes[r], r)):
+                messages = self.poll(rank, wait, count)
+                if messages:
+                    return messages
+        return []
+
+
+def run_slot(clients, jobs, results, work_dir, threads):
+    """Render the messages from jobs, one at a time, and put (message, status) into results."""
+    while True:
+        _, _, message = jobs.get()
+        status = 'failed'
+        try:
+            log('Message: ' + message['Body'] + '.')
+            status = process_message(clients, message, work_dir, threads)
+        except Exception as e:
+            log('ERROR: Unexpected error, releasing the message for redelivery: ' + repr(e))
+        finally:
+            results.put((message, status))
+
+
+def main(work_dir=WORK_DIR):
+    """Render messages from the queues until they are drained. The slots' scratch directories go under work_dir."""
+    global asset_cache, povray_version
+
+    session = boto3.session.Session(region_name=REGION)
+    sqs = session.client('sqs')
+    slots, threads = get_slot_configuration()
+    s3 = session.client('s3', config=Config(max_pool_connections=slots * (TRANSFER_CONCURRENCY + 1)))
+    add_conditional_put(s3)
+    clients = {'s3': s3, 'sqs': sqs, 'lambda': session.client('lambda')}
+    leases = Leases(sqs, get_visibility_timeout(sqs))
+    lanes = Lanes(sqs)
+    if ASSET_CACHE_DIR:
+        asset_cache = AssetCache(ASSET_CACHE_DIR, ASSET_CACHE_SIZE * 1024 * 1024)
+        log('Using asset cache ' + ASSET_CACHE_DIR + ' of up to ' + str(ASSET_CACHE_SIZE) + ' MB.')
+    povray_version = get_povray_version()
+    if not povray_version:
+        log('ERROR: Could not determine the POV-Ray version, not using the result cache.')
+
+    log('Starting ' + str(slots) + ' render slot(s) with ' + str(threads) + ' POV-Ray thread(s) each' +
+        (', size class ' + SIZE_CLASS if SIZE_CLASS else '') + '.')
+    jobs = PriorityQueue()  # Received messages, waiting for a free slot, by lane and in the order received.
+    order = itertools.count()
+    results = Queue()
+    for i in range(slots):
+        t = threading.Thread(
+            target=run_slot,
+            name='slot-' + str(i),
+            args=(clients, jobs, results, os.path.join(work_dir, 'slot-' + str(i)), threads)
+        )
+        t.daemon = True
+        t.start()
+
+    outstanding = 0  # Messages given to the slots that haven't come back yet.
+    finished = []  # Messages of finished jobs, waiting to be deleted.
+    finished_since = None
+
+    # Fetch messages and render them until the queues are drained.
+    while True:
+        messages = []
+        if outstanding < slots:
+            leases.drop(finished)
+            delete_messages(sqs, finished)
+            finished = []
+
+            log('Fetching messages from ' + str(len(lanes.lanes)) + ' SQS queue(s)...')
+            # Only as many as there are free slots: leased messages are hidden from other tasks until they are done.
+            messages = lanes.receive(outstanding == 0, slots - outstanding)
+
+            if not messages and outstanding == 0:
+                log('Stages of all jobs: ' + stage_totals.summary() + '.')
+                if asset_cache:
+                    log('Asset cache: ' + asset_cache.summary() + '.')
+                log('Result cache: %(hit)d hit(s), %(miss)d miss(es).' % result_cache_statistics)
+                log('No messages left in the queues. Exiting.')
+                return 0
+
+            leases.acquire(messages)
+            for m in messages:
+                jobs.put((m['lane'], next(order), m))
+            outstanding += len(messages)
+
+        # Collect finished jobs. Block for one if all slots are busy, or if there was nothing new to receive.
+        block = outstanding >= slots or not messages
+        while outstanding > 0:
+            try:
+                message, status = results.get(block)
+            except Empty:
+                break
+            block = False
+            outstanding -= 1
+            if status == 'done' or (status == 'rejected' and dead_letter(sqs, message)):
+                if not finished:
+                    finished_since = time.time()
+                finished.append(message)
+            elif status == 'deferred':
+                leases.release(message, SIZE_CLASS_DEFER_SECONDS)
+            else:
+                leases.release(message, get_retry_delay(message))
+
+        if len(finished) >= RECEIVE_MAX_MESSAGES or (finished and time.time() - finished_since > DELETE_MAX_DELAY):
+            leases.drop(finished)
+            delete_messages(sqs, finished)
+            finished = []
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['--print-jobs']:
+        sys.exit(print_jobs(sys.stdin.read()))
+    if sys.argv[1:] == ['--print-lanes']:
+        sys.exit(print_lanes())
+    sys.exit(main())
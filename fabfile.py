@@ -22,17 +22,28 @@
 #
 
 # Imports
-from fabric.api import local, quiet, env, run, put, cd
-from ConfigParser import ConfigParser
-import boto
-import boto.s3
-from boto.exception import BotoServerError
-from zipfile import ZipFile, ZIP_DEFLATED
+from fabric.api import local, quiet, env, abort
+import boto3
+import boto3.session
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+from multiprocessing.pool import ThreadPool
 import os
+import copy
+import shutil
+import sys
+import tempfile
 import json
 import time
-from urllib2 import unquote
-from cStringIO import StringIO
+import base64
+import hashlib
+import math
+import random
+import atexit
+import functools
+import threading
+from Queue import Queue
 
 # Constants (User configurable), imported from config.py
 
@@ -42,31 +53,74 @@ from config import *
 BUCKET_POSTFIX = '-pov-ray-bucket'  # Gets put after the unix user ID to create the bucket name.
 SSH_KEY_DIR = os.environ['HOME'] + '/.ssh'
 SQS_QUEUE_NAME = APP_NAME + 'Queue'
+SQS_DEAD_LETTER_QUEUE_SUFFIX = '-DeadLetter'  # Gets put after a queue's name to create its dead-letter queue's name.
 LAMBDA_FUNCTION_NAME = 'ecs-worker-launcher'
 LAMBDA_FUNCTION_DEPENDENCIES = 'async'
+LAMBDA_FUNCTION_ALIAS = 'live'  # S3 notifications invoke this alias, which points at the latest published version.
 ECS_TASK_NAME = APP_NAME + 'Task'
 
 # Constants (OS specific)
 USER = os.environ['HOME'].split('/')[-1]
 AWS_BUCKET = USER + BUCKET_POSTFIX
-AWS_CONFIG_FILE_NAME = os.environ['HOME'] + '/.aws/config'
-AWS_CREDENTIAL_FILE_NAME = os.environ['HOME'] + '/.aws/credentials'
 
 # Constants
-AWS_CLI_STANDARD_OPTIONS = (
-    '    --region ' + AWS_REGION +
-    '    --profile ' + AWS_PROFILE +
-    '    --output json'
-)
+AWS_CLIENT_CONFIG = Config(max_pool_connections=10)  # HTTPS connections kept open per AWS client.
 
 SSH_USER = 'ec2-user'
 CPU_SHARES = 512  # POV-Ray needs at least half a CPU to work nicely.
 MEMORY = 512
 ZIPFILE_NAME = LAMBDA_FUNCTION_NAME + '.zip'
+WORKER_TASKS_MIN = 0  # The Lambda function starts worker tasks until at least this many are running...
+WORKER_TASKS_MAX = 10  # ...but never more than this many...
+MESSAGES_PER_WORKER_TASK = 1  # ...aiming for one task per this many messages in the queue, as the cluster has room.
+JOBS_PER_MESSAGE = 10  # Jobs of one S3 event the Lambda function may pack into one message, up to 256 KB. A task
+# renders the jobs of a message one after another, so lower this if jobs render for long.
+TASK_SIZE_CLASSES = [
+    # (name, CPU shares, MB of memory), smallest first. Each class gets a task definition of its own, whose tasks render
+    # one scene at a time, with one POV-Ray thread per reserved CPU. Empty: One task definition for all scenes, with
+    # CPU_SHARES, MEMORY, WORKER_SLOTS and POVRAY_THREADS.
+    ('small', 256, 384),
+    ('medium', CPU_SHARES, MEMORY),
+    ('large', 1024, 1536),
+    ('xlarge', 2048, 3072)
+]
+TASK_SIZE_DEFAULT = 'medium'  # Size class of scenes whose family has no render profile yet.
+PROFILE_PREFIX = '.ecs-worker/profiles/'  # Key prefix of the render profiles of scene families, in the job's bucket.
+PROFILE_MEMORY_HEADROOM = 1.25  # A size class needs this times the peak memory of POV-Ray in the profile...
+PROFILE_MEMORY_OVERHEAD = 128  # ...plus this many MB for the worker itself.
+PROFILE_TARGET_SECONDS = 300  # Scenes that need more CPU seconds than this per reserved CPU get a larger size class.
+QUEUE_LANES = [
+    # (name, weight, key prefixes, MB up to which archives go to the lane by size), highest priority first. Each lane is
+    # a queue of its own, and workers poll a lane weight times as often as a lane of weight 1 while both have messages.
+    # Uploads go to the lane named in their S3 metadata, else to the first lane with a prefix of their key, else to the
+    # first lane they are small enough for, else to QUEUE_LANE_DEFAULT. Empty: One queue for all jobs.
+    ('interactive', 6, ['previews/'], 1),
+    ('standard', 3, [], 0),
+    ('bulk', 1, ['bulk/'], 0)
+]
+QUEUE_LANE_DEFAULT = 'standard'  # Its queue is SQS_QUEUE_NAME, the others get the lane's name appended.
+QUEUE_LANE_METADATA = 'lane'  # Upload with "--metadata lane=bulk" to pick the lane. Empty: The metadata is not read.
+SQS_MAX_RECEIVE_COUNT = 5  # Deliveries of a job after which SQS moves it to the dead-letter queue. 0: No such queue.
+SQS_DEAD_LETTER_RETENTION_DAYS = 14  # The longest SQS keeps messages. Replay them with "fab replay_dead_letters".
+SQS_REPLAY_WAIT_TIME = 1  # Seconds to long poll a dead-letter queue, so that an empty receive means it is drained.
+SQS_REPLAY_VISIBILITY_TIMEOUT = 60  # Seconds a dead-lettered message being replayed stays hidden from other replays.
+METRICS_NAMESPACE = APP_NAME  # CloudWatch namespace of the stage timings the worker and the Lambda function log.
+METRICS_PERCENTILES = [50, 90, 95, 99]  # Columns of the table "fab show_stage_percentiles" prints.
+WORKER_LOG_GROUP = '/ecs/' + APP_NAME  # CloudWatch Logs group the worker tasks log to.
+WORKER_LOG_RETENTION_DAYS = 14
 
 BUCKET_PERMISSION_SID = APP_NAME + 'Permission'
-WAIT_TIME = 5  # seconds to allow for eventual consistency to kick in.
-RETRIES = 5  # Number of retries before we give up on something.
+WAIT_INITIAL_DELAY = 0.05  # Seconds before checking again on a resource that is not ready yet. Doubles every time.
+WAIT_MAX_DELAY = 5  # Longest pause in seconds between two checks.
+WAIT_DEADLINE = 120  # Seconds to allow for eventual consistency to kick in before we give up on something.
+TASK_GRAPH_WORKERS = 4  # Number of independent setup steps that may run at the same time.
+ARTIFACT_CACHE_DIR = '.artifact-cache'  # Built ZIP files, named after a hash of their contents.
+ARTIFACT_CACHE_ENTRIES = 20  # Number of most recently used ZIP files to keep in the artifact cache.
+ARTIFACT_READ_WORKERS = 4  # Number of files to read at the same time.
+ARTIFACT_STORED_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif', '.exr', '.zip', '.gz', '.bz2']  # Already compressed.
+ARTIFACT_DATE_TIME = (1980, 1, 1, 0, 0, 0)  # Timestamp of all ZIP entries, so that builds are reproducible.
+ECS_DESCRIBE_BATCH_SIZE = 100  # Most container instances one DescribeContainerInstances call accepts.
+RESOLUTION_CACHE_TTL = 300  # Seconds a looked up ARN, URL, role or instance ID is reused within one fab run.
 
 # Templates and embedded scripts
 
@@ -80,13 +134,24 @@ LAMBDA_EXECUTION_ROLE_POLICY = {
             "Action": [
                 "logs:*",
                 "sqs:SendMessage",
-                "ecs:RunTask"
+                "sqs:GetQueueAttributes",
+                "ecs:RunTask",
+                "ecs:ListTasks",
+                "ecs:ListContainerInstances",
+                "ecs:DescribeContainerInstances"
             ],
             "Resource": [
                 "arn:aws:logs:*:*:*",
                 "arn:aws:sqs:*:*:*",
                 "arn:aws:ecs:*:*:*"
             ]
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "s3:GetObject"
+            ],
+            "Resource": "arn:aws:s3:::" + AWS_BUCKET + "/*"
         }
     ]
 }
@@ -108,10 +173,34 @@ LAMBDA_EXECUTION_ROLE_TRUST_POLICY = {
 LAMBDA_FUNCTION_CONFIG = {
     "s3_key_suffix_whitelist": ['.zip'],  # Only S3 keys with this URL will be accepted.
     "queue": '',  # To be filled in with the queue ARN.
-    "task": ECS_TASK_NAME
+    "task": ECS_TASK_NAME,
+    "cluster": ECS_CLUSTER,
+    "metrics_namespace": METRICS_NAMESPACE,
+    "jobs_per_message": JOBS_PER_MESSAGE,
+    "size_classes": [],  # To be filled in with the task definition, CPU shares and memory of each size class.
+    "lanes": [],  # To be filled in with the queue URL, weight, key prefixes and size limit of each lane.
+    "default_lane": QUEUE_LANE_DEFAULT,
+    "lane_metadata": QUEUE_LANE_METADATA,
+    "default_size_class": TASK_SIZE_DEFAULT,
+    "profiles": {
+        "prefix": PROFILE_PREFIX,
+        "memory_headroom": PROFILE_MEMORY_HEADROOM,
+        "memory_overhead": PROFILE_MEMORY_OVERHEAD,
+        "target_seconds": PROFILE_TARGET_SECONDS
+    },
+    "scaling": {
+        "min_tasks": WORKER_TASKS_MIN,
+        "max_tasks": WORKER_TASKS_MAX,
+        "messages_per_task": MESSAGES_PER_WORKER_TASK,
+        "task_cpu": CPU_SHARES,
+        "task_memory": MEMORY
+    }
 }
 
 LAMBDA_FUNCTION_CONFIG_PATH = './' + LAMBDA_FUNCTION_NAME + '/config.json'
+LAMBDA_FUNCTION_HARNESS = LAMBDA_FUNCTION_NAME + '-harness.js'
+LAMBDA_LOG_GROUP = '/aws/lambda/' + LAMBDA_FUNCTION_NAME
+BENCHMARK_SCRIPT = 'ecs-worker-benchmark.py'
 
 BUCKET_NOTIFICATION_CONFIGURATION = {
     "LambdaFunctionConfigurations": [
@@ -120,7 +209,8 @@ BUCKET_NOTIFICATION_CONFIGURATION = {
             "LambdaFunctionArn": "",
             "Events": [
                 "s3:ObjectCreated:*"
-            ]
+            ],
+            "Filter": {}  # To be filled in with a suffix rule for each S3 key suffix in s3_key_suffix_whitelist.
         }
     ]
 }
@@ -152,21 +242,58 @@ ECS_ROLE_BUCKET_ACCESS_POLICY = {
                 "s3:DeleteObject"
             ],
             "Resource": ""  # To be filled in by a function below.
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "sqs:ReceiveMessage",
+                "sqs:SendMessage",
+                "sqs:DeleteMessage",
+                "sqs:ChangeMessageVisibility",
+                "sqs:GetQueueAttributes"
+            ],
+            "Resource": ""  # To be filled in by a function below.
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "lambda:InvokeFunction"
+            ],
+            "Resource": ""  # To be filled in by a function below.
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "logs:CreateLogStream",
+                "logs:PutLogEvents"
+            ],
+            "Resource": ""  # To be filled in by a function below.
         }
     ]
 }
 
 WORKER_PATH = 'ecs-worker'
 WORKER_FILE = 'ecs-worker.sh'
+WORKER_MODULE = 'ecs_worker.py'
+WORKER_MODE = 'batch'  # 'batch' for the Python worker, 'simple' for the original one message at a time shell loop.
+WORKER_SLOTS = 0  # Scenes a batch mode task renders at the same time. 0: One per CPU reserved through CPU_SHARES.
+POVRAY_THREADS = 0  # POV-Ray work threads per render slot. 0: Share the reserved CPUs between the slots.
+ASSET_CACHE_HOST_PATH = '/var/cache/ecs-worker'  # Directory on each container instance shared by all worker tasks.
+ASSET_CACHE_PATH = '/var/cache/ecs-worker'  # Where the worker container sees it.
+ASSET_CACHE_SIZE = 2048  # MB of scene assets each container instance keeps. 0 disables the cache.
+TILE_MIN_PIXELS = 4 * 1920 * 1080  # Larger frames are split into tiles that several tasks render. 0: Never.
+TILE_PIXELS = 1920 * 1080  # Pixels per tile.
+ANIMATION_CHUNK_FRAMES = 10  # Frames of an animation that one task renders in one go.
+
+DOCKER_IMAGE_REPOSITORY = DOCKERHUB_TAG.split(':')[0]  # Images are tagged with a hash of what went into them.
+POV_RAY_GIT_REF = 'v3.7.0.0'  # POV-Ray release to compile. Pinned, so that image builds are reproducible.
 
 DOCKERFILE = """
 # POV-Ray Amazon ECS Worker
 
-FROM ubuntu:14.04
-
-MAINTAINER %(name)s
+# Build stage: Compiles POV-Ray. Only the installed result is copied into the worker image below.
 
-# Libraries and dependencies
+FROM ubuntu:14.04 AS build
 
 RUN \
   apt-get update && apt-get -y install \
@@ -178,38 +305,57 @@ RUN \
   libopenexr-dev \
   libpng-dev \
   libtiff-dev \
-  python \
-  python-dev \
-  python-distribute \
-  python-pip \
-  unzip \
   zlib1g-dev
 
-# Compile and install POV-Ray
-
 RUN \
   mkdir /src && \
   cd /src && \
   git clone https://github.com/POV-Ray/povray.git && \
   cd povray && \
-  git checkout origin/3.7-stable && \
+  git checkout %(pov_ray_git_ref)s && \
   cd unix && \
   sed 's/automake --w/automake --add-missing --w/g' -i prebuild.sh && \
   sed 's/dist-bzip2/dist-bzip2 subdir-objects/g' -i configure.ac && \
   ./prebuild.sh && \
   cd .. && \
-  ./configure COMPILED_BY="%(name)s" LIBS="-lboost_system -lboost_thread" && \
+  ./configure --prefix=/opt/povray COMPILED_BY="%(name)s" LIBS="-lboost_system -lboost_thread" && \
   make && \
   make install
 
-# Install AWS CLI
+# Worker image: POV-Ray, its runtime libraries, the AWS CLI and the worker script.
+
+FROM ubuntu:14.04
+
+MAINTAINER %(name)s
+
+RUN \
+  apt-get update && apt-get -y install \
+  libboost-system1.54.0 \
+  libboost-thread1.54.0 \
+  libjpeg8 \
+  libopenexr6 \
+  libpng12-0 \
+  libtiff5 \
+  python \
+  python-numpy \
+  python-pip \
+  unzip \
+  zlib1g && \
+  rm -rf /var/lib/apt/lists/*
+
+# Install AWS CLI and the AWS SDK for the batch mode worker. Pinned to the last releases that support Python 2.7,
+# which trusty's pip would otherwise not know to stop at.
 
 RUN \
-  pip install awscli
+  pip install 'awscli<1.20' 'boto3<1.18' 'botocore<1.21'
+
+COPY --from=build /opt/povray /opt/povray
+
+ENV PATH /opt/povray/bin:$PATH
 
 WORKDIR /
 
-COPY %(worker_file)s /
+COPY %(worker_file)s %(worker_module)s /
 
 CMD [ "./%(worker_file)s" ]
 """
@@ -222,14 +368,92 @@ TASK_DEFINITION = {
                 {
                     "name": "AWS_REGION",
                     "value": AWS_REGION
+                },
+                {
+                    "name": "WORKER_MODE",
+                    "value": WORKER_MODE
+                },
+                {
+                    "name": "CPU_SHARES",
+                    "value": str(CPU_SHARES)
+                },
+                {
+                    "name": "MEMORY",
+                    "value": str(MEMORY)
+                },
+                {
+                    "name": "SIZE_CLASS",
+                    "value": ""
+                },
+                {
+                    "name": "WORKER_SLOTS",
+                    "value": str(WORKER_SLOTS)
+                },
+                {
+                    "name": "POVRAY_THREADS",
+                    "value": str(POVRAY_THREADS)
+                },
+                {
+                    "name": "ASSET_CACHE_DIR",
+                    "value": ASSET_CACHE_PATH if ASSET_CACHE_SIZE else ""
+                },
+                {
+                    "name": "ASSET_CACHE_SIZE",
+                    "value": str(ASSET_CACHE_SIZE)
+                },
+                {
+                    "name": "TILE_MIN_PIXELS",
+                    "value": str(TILE_MIN_PIXELS)
+                },
+                {
+                    "name": "TILE_PIXELS",
+                    "value": str(TILE_PIXELS)
+                },
+                {
+                    "name": "ANIMATION_CHUNK_FRAMES",
+                    "value": str(ANIMATION_CHUNK_FRAMES)
+                },
+                {
+                    "name": "LAUNCHER_FUNCTION",
+                    "value": LAMBDA_FUNCTION_NAME + ':' + LAMBDA_FUNCTION_ALIAS
+                },
+                {
+                    "name": "METRICS_NAMESPACE",
+                    "value": METRICS_NAMESPACE
+                },
+                {
+                    "name": "PROFILE_PREFIX",
+                    "value": PROFILE_PREFIX
+                }
+            ],
+            "logConfiguration": {
+                "logDriver": "awslogs",
+                "options": {
+                    "awslogs-group": WORKER_LOG_GROUP,
+                    "awslogs-region": AWS_REGION,
+                    "awslogs-stream-prefix": APP_NAME
+                }
+            },
+            "mountPoints": [
+                {
+                    "sourceVolume": "asset-cache",
+                    "containerPath": ASSET_CACHE_PATH
                 }
             ],
             "name": APP_NAME,
-            "image": DOCKERHUB_TAG,
+            "image": "",  # To be filled in with the tag of the current worker image.
             "cpu": CPU_SHARES,
             "memory": MEMORY,
             "essential": True
         }
+    ],
+    "volumes": [
+        {
+            "name": "asset-cache",
+            "host": {
+                "sourcePath": ASSET_CACHE_HOST_PATH
+            }
+        }
     ]
 }
 
@@ -241,10 +465,28 @@ POV_RAY_SCENE_FILES = [
     'ECSLogo.pov'
 ]
 
+# AWS clients, shared by all functions below. Use get_aws_client() to access them.
+
+aws_session = None
+aws_clients = {}
+aws_clients_lock = threading.Lock()
+
+# Looked up AWS resources, reused for the rest of the fab run. See the resolved() decorator below.
+
+resolution_cache = {}  # (function name, arguments) -> (expiry time, value)
+resolution_cache_statistics = {}  # function name -> [hits, misses]
+resolution_cache_lock = threading.Lock()
+
+# SHA-256 hashes of the files going into build artifacts. See get_file_hash() below.
+
+file_hashes = None  # Absolute path -> [size, modification time, hash]
+file_hashes_lock = threading.Lock()
+artifact_cache_lock = threading.Lock()  # Held while the artifact cache directory is created or pruned.
+
 # Functions
 
 
-# Dependencies and credentials.
+# Dependencies and AWS clients.
 
 
 def update_dependencies():
@@ -252,144 +494,458 @@ def update_dependencies():
     local('cd ' + LAMBDA_FUNCTION_NAME + '; npm install ' + LAMBDA_FUNCTION_DEPENDENCIES)
 
 
-def get_aws_credentials():
-    config = ConfigParser()
-    config.read(AWS_CONFIG_FILE_NAME)
-    config.read(AWS_CREDENTIAL_FILE_NAME)
-    return config.get(AWS_PROFILE, 'aws_access_key_id'), config.get(AWS_PROFILE, 'aws_secret_access_key')
+def get_aws_session():
+    global aws_session
+    if aws_session is None:
+        aws_session = boto3.session.Session(profile_name=AWS_PROFILE)
+    return aws_session
 
-# AWS IAM
 
+def get_aws_client(service, region=AWS_REGION):
+    """Return the long-lived client for the given AWS service and region, creating it on first use.
+
+    Clients keep their HTTPS connections alive between calls and are safe to share between the threads of a task
+    graph. Creating them is not, which is why that happens under a lock.
+    """
+    with aws_clients_lock:
+        client = aws_clients.get((service, region))
+        count_resolution('get_aws_client', client is not None)
+        if client is None:
+            client = get_aws_session().client(service, region_name=region, config=AWS_CLIENT_CONFIG)
+            aws_clients[(service, region)] = client
+        return client
+
+
+def get_aws_error_code(e):
+    return e.response.get('Error', {}).get('Code', '')
+
+
+def list_all(service, operation, result_key, **kwargs):
+    """Return the items under result_key from every page of a list operation, not just the first one."""
+    result = []
+    for page in get_aws_client(service).get_paginator(operation).paginate(**kwargs):
+        result.extend(page.get(result_key, []))
+    return result
+
+
+def wait_until(ready, description, deadline=WAIT_DEADLINE):
+    """Call ready() until it returns a true value, then return that value.
+
+    The pauses between calls start at WAIT_INITIAL_DELAY and double up to WAIT_MAX_DELAY, each one randomized so that
+    parallel steps don't poll in lockstep. Aborts if the resource isn't ready after deadline seconds.
+    """
+    start = time.time()
+    delay = WAIT_INITIAL_DELAY
+    while True:
+        result = ready()
+        if result:
+            return result
+
+        remaining = start + deadline - time.time()
+        if remaining <= 0:
+            abort('Gave up after %g seconds waiting for %s.' % (deadline, description))
+
+        time.sleep(min(remaining, random.uniform(delay / 2, delay)))
+        delay = min(delay * 2, WAIT_MAX_DELAY)
+
+
+def map_in_threads(function, items, workers=None):
+    """Return [function(item) for item in items], with the calls spread over a pool of threads.
+
+    If a call fails, its exception is raised again here once all calls are done. That includes the SystemExit of
+    fabric's abort(), which would hang ThreadPool.map(), as the pool's threads only catch Exception.
+    """
+    def call(item):
+        try:
+            return None, function(item)
+        except BaseException:
+            return sys.exc_info(), None
+
+    pool = ThreadPool(workers or max(1, len(items)))
+    try:
+        results = pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+
+    for error, _ in results:
+        if error:
+            raise error[0], error[1], error[2]
+    return [result for _, result in results]
+
+
+# Resolution cache.
+
+
+def count_resolution(name, hit):
+    with resolution_cache_lock:
+        statistics = resolution_cache_statistics.setdefault(name, [0, 0])
+        statistics[0 if hit else 1] += 1
+
+
+def resolved(f):
+    """Cache what the decorated lookup function returns for RESOLUTION_CACHE_TTL seconds, per set of arguments.
+
+    None results are not cached, so waiting for a resource to appear keeps asking AWS. Functions that create, update
+    or delete a resource call invalidate_resolutions() with the names of the lookups they affect.
+    """
+    @functools.wraps(f)
+    def wrapper(*args):
+        key = (f.__name__,) + args
+        with resolution_cache_lock:
+            expiry, value = resolution_cache.get(key, (0, None))
+        hit = expiry > time.time()
+        count_resolution(f.__name__, hit)
+        if hit:
+            return value
+
+        value = f(*args)
+        if value is not None:
+            with resolution_cache_lock:
+                resolution_cache[key] = (time.time() + RESOLUTION_CACHE_TTL, value)
+        return value
+
+    return wrapper
+
+
+def invalidate_resolutions(*names):
+    with resolution_cache_lock:
+        for key in resolution_cache.keys():
+            if key[0] in names:
+                del resolution_cache[key]
+
+
+def show_resolution_cache_statistics():
+    if not resolution_cache_statistics:
+        return
+
+    print('')
+    print('%-32s %8s %8s' % ('Lookup', 'Hits', 'Misses'))
+    for name, (hits, misses) in sorted(resolution_cache_statistics.items()):
+        print('%-32s %8d %8d' % (name, hits, misses))
+    total_hits = sum(h for h, _ in resolution_cache_statistics.values())
+    print('Remote lookups saved by the resolution cache: %d.' % total_hits)
+
+
+atexit.register(show_resolution_cache_statistics)
+
+
+# Build artifacts. ZIP files are reproducible and cached by the hash of their contents.
+
+
+def list_files(directory):
+    result = []
+    for root, dirs, files in os.walk(directory):
+        if '__pycache__' in dirs:
+            dirs.remove('__pycache__')
+        for basename in files:
+            if not basename.endswith('.pyc'):
+                result.append(os.path.relpath(os.path.join(root, basename), directory))
+    return sorted(result)
+
+
+def load_file_hashes():
+    global file_hashes
+    if file_hashes is None:
+        file_hashes = {}
+        try:
+            with open(os.path.join(ARTIFACT_CACHE_DIR, 'file-hashes.json'), 'r') as fp:
+                file_hashes = json.load(fp)
+        except (IOError, ValueError):
+            pass
+    return file_hashes
+
+
+def make_artifact_cache_dir():
+    with artifact_cache_lock:
+        if not os.path.isdir(ARTIFACT_CACHE_DIR):
+            os.makedirs(ARTIFACT_CACHE_DIR)
+
+
+def save_file_hashes():
+    make_artifact_cache_dir()
+    path = os.path.join(ARTIFACT_CACHE_DIR, 'file-hashes.json')
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(load_file_hashes(), fp)
+    os.rename(path + '.tmp', path)
+
+
+def get_file_hash(filename):
+    """Return the SHA-256 hash of a file. Files are only read again if their size or modification time changed."""
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    with file_hashes_lock:
+        known = load_file_hashes().get(path)
+    if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime:
+        return known[2]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), ''):
+            h.update(chunk)
+
+    with file_hashes_lock:
+        file_hashes[path] = [stat.st_size, stat.st_mtime, h.hexdigest()]
+    return h.hexdigest()
+
+
+def is_executable(filename):
+    return os.stat(filename).st_mode & 0111 != 0
+
+
+def get_artifact_hash(directory, files):
+    """Return a SHA-256 hash over the names, permissions and contents of the given files in directory."""
+    h = hashlib.sha256()
+    for f in sorted(files):
+        filename = os.path.join(directory, f)
+        h.update('%s\0%d\0%s\0' % (f, is_executable(filename), get_file_hash(filename)))
+    return h.hexdigest()
+
+
+def read_zip_entry(filename):
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+
+    if os.path.splitext(filename)[1].lower() in ARTIFACT_STORED_EXTENSIONS:
+        return data, ZIP_STORED
+    return data, ZIP_DEFLATED
+
+
+def build_zip_artifact(zip_name, directory, files):
+    """Create zip_name from the given files in directory, or copy it from the artifact cache if they didn't change.
+
+    Entries are sorted and carry a fixed timestamp, so the same inputs always give the same bytes. Files are read in
+    parallel and compressed, except for ARTIFACT_STORED_EXTENSIONS, which are already compressed and stored as they are.
+    """
+    files = sorted(files)
+    make_artifact_cache_dir()
+    cached = os.path.join(ARTIFACT_CACHE_DIR, get_artifact_hash(directory, files) + '.zip')
+
+    if os.path.exists(cached):
+        print('Using cached ZIP file for: ' + zip_name + '.')
+        os.utime(cached, None)
+    else:
+        print('Creating ZIP file: ' + zip_name + '...')
+        entries = map_in_threads(read_zip_entry, [os.path.join(directory, f) for f in files], ARTIFACT_READ_WORKERS)
+
+        with ZipFile(cached + '.tmp', 'w') as z:
+            for f, (data, compress_type) in zip(files, entries):
+                print('Adding: ' + f + '...')
+                info = ZipInfo(f, date_time=ARTIFACT_DATE_TIME)
+                info.compress_type = compress_type
+                info.create_system = 3
+                info.external_attr = (0755 if is_executable(os.path.join(directory, f)) else 0644) << 16
+                z.writestr(info, data)
+        os.rename(cached + '.tmp', cached)
+        prune_artifact_cache()
+
+    with file_hashes_lock:
+        save_file_hashes()
+    shutil.copyfile(cached, zip_name)
+
+
+def prune_artifact_cache():
+    with artifact_cache_lock:
+        archives = [os.path.join(ARTIFACT_CACHE_DIR, f) for f in os.listdir(ARTIFACT_CACHE_DIR) if f.endswith('.zip')]
+        archives.sort(key=os.path.getmtime, reverse=True)
+        for f in archives[ARTIFACT_CACHE_ENTRIES:]:
+            os.remove(f)
 
-def get_iam_connection():
-    aws_access_key_id, aws_secret_access_key = get_aws_credentials()
-    return boto.connect_iam(aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key)
 
 # AWS Lambda
 
 
 def dump_lambda_function_configuration():
-    print('Writing config for Lambda function...')
     lambda_function_config = LAMBDA_FUNCTION_CONFIG.copy()
     lambda_function_config['queue'] = get_queue_url()
+    lambda_function_config['size_classes'] = [
+        {'name': name, 'task': get_size_class_task_name(name), 'cpu': cpu, 'memory': memory}
+        for name, cpu, memory in TASK_SIZE_CLASSES
+    ]
+    lambda_function_config['lanes'] = [
+        {
+            'name': name,
+            'queue': get_queue_url(get_lane_queue_name(name)),
+            'weight': weight,
+            'prefixes': prefixes,
+            'max_size': max_mb * 1024 * 1024
+        }
+        for name, weight, prefixes, max_mb in QUEUE_LANES
+    ]
+    config_string = json.dumps(lambda_function_config, sort_keys=True)
+
+    if os.path.exists(LAMBDA_FUNCTION_CONFIG_PATH):
+        with open(LAMBDA_FUNCTION_CONFIG_PATH, 'r') as fp:
+            if fp.read() == config_string:
+                print('Config for Lambda function is up to date.')
+                return
+
+    print('Writing config for Lambda function...')
     with open(LAMBDA_FUNCTION_CONFIG_PATH, 'w') as fp:
-        fp.write(json.dumps(lambda_function_config))
+        fp.write(config_string)
+
+
+def get_lambda_package_files():
+    return list_files(LAMBDA_FUNCTION_NAME)
+
+
+def get_lambda_package_hash():
+    return get_artifact_hash(LAMBDA_FUNCTION_NAME, get_lambda_package_files())
 
 
 def create_lambda_deployment_package():
-    print('Creating ZIP file: ' + ZIPFILE_NAME + '...')
-    with ZipFile(ZIPFILE_NAME, 'w', ZIP_DEFLATED) as z:
-        saved_dir = os.getcwd()
-        os.chdir(LAMBDA_FUNCTION_NAME)
-        for root, dirs, files in os.walk('.'):
-            for basename in files:
-                filename = os.path.join(root, basename)
-                print('Adding: ' + filename + '...')
-                z.write(filename)
-        os.chdir(saved_dir)
-        z.close()
+    build_zip_artifact(ZIPFILE_NAME, LAMBDA_FUNCTION_NAME, get_lambda_package_files())
 
 
 def get_or_create_lambda_execution_role():
-    iam = get_iam_connection()
+    iam = get_aws_client('iam')
     target_policy = json.dumps(LAMBDA_EXECUTION_ROLE_TRUST_POLICY, sort_keys=True)
 
     try:
-        result = iam.get_role(LAMBDA_EXECUTION_ROLE_NAME)
+        role = iam.get_role(RoleName=LAMBDA_EXECUTION_ROLE_NAME)['Role']
         print('Found role: ' + LAMBDA_EXECUTION_ROLE_NAME + '.')
 
-        policy = result['get_role_response']['get_role_result']['role']['assume_role_policy_document']
-        if (
-            policy is not None and
-            json.dumps(json.loads(unquote(policy)), sort_keys=True) == target_policy
-        ):
+        policy = role.get('AssumeRolePolicyDocument')
+        if policy is not None and json.dumps(policy, sort_keys=True) == target_policy:
             print('Assume role policy for: ' + LAMBDA_EXECUTION_ROLE_NAME + ' verified.')
         else:
             print('Updating assume role policy for: ' + LAMBDA_EXECUTION_ROLE_NAME + '.')
-            iam.update_assume_role_policy(LAMBDA_EXECUTION_ROLE_NAME, target_policy)
-            time.sleep(WAIT_TIME)
-    except BotoServerError:
+            iam.update_assume_role_policy(RoleName=LAMBDA_EXECUTION_ROLE_NAME, PolicyDocument=target_policy)
+    except iam.exceptions.NoSuchEntityException:
         print('Creating role: ' + LAMBDA_EXECUTION_ROLE_NAME + '...')
-        iam.create_role(
-            LAMBDA_EXECUTION_ROLE_NAME,
-            assume_role_policy_document=target_policy
-        )
-        result = iam.get_role(LAMBDA_EXECUTION_ROLE_NAME)
-
-    role_arn = result['get_role_response']['get_role_result']['role']['arn']
+        role = iam.create_role(
+            RoleName=LAMBDA_EXECUTION_ROLE_NAME,
+            AssumeRolePolicyDocument=target_policy
+        )['Role']
 
-    return role_arn
+    return role['Arn']
 
 
 def check_lambda_execution_role_policies():
-    iam = get_iam_connection()
-
-    response = iam.list_role_policies(LAMBDA_EXECUTION_ROLE_NAME)
-    policy_names = response['list_role_policies_response']['list_role_policies_result']['policy_names']
+    iam = get_aws_client('iam')
+    target_policy = json.dumps(LAMBDA_EXECUTION_ROLE_POLICY, sort_keys=True)
 
-    found = False
-    for p in policy_names:
-        found = (p == LAMBDA_EXECUTION_ROLE_POLICY_NAME)
-        if found:
+    try:
+        response = iam.get_role_policy(
+            RoleName=LAMBDA_EXECUTION_ROLE_NAME,
+            PolicyName=LAMBDA_EXECUTION_ROLE_POLICY_NAME
+        )
+        if json.dumps(response['PolicyDocument'], sort_keys=True) == target_policy:
             print('Found policy: ' + LAMBDA_EXECUTION_ROLE_POLICY_NAME + '.')
-            break
-
-    if not found:
+            return
+        print('Updating policy: ' + LAMBDA_EXECUTION_ROLE_POLICY_NAME + '.')
+    except iam.exceptions.NoSuchEntityException:
         print('Attaching policy: ' + LAMBDA_EXECUTION_ROLE_POLICY_NAME + '.')
-        iam.put_role_policy(
-            LAMBDA_EXECUTION_ROLE_NAME,
-            'AWSLambdaExecute',
-            json.dumps(LAMBDA_EXECUTION_ROLE_POLICY)
-        )
 
-    return
+    iam.put_role_policy(
+        RoleName=LAMBDA_EXECUTION_ROLE_NAME,
+        PolicyName=LAMBDA_EXECUTION_ROLE_POLICY_NAME,
+        PolicyDocument=target_policy
+    )
 
 
+@resolved
 def get_lambda_function_arn():
-    result = json.loads(
-        local(
-            'aws lambda list-functions' +
-            AWS_CLI_STANDARD_OPTIONS,
-            capture=True
-        )
-    )
-    if result is not None and isinstance(result, dict):
-        for f in result.get('Functions', []):
-            if f['FunctionName'] == LAMBDA_FUNCTION_NAME:
-                return f['FunctionArn']
-
-    return None
+    aws_lambda = get_aws_client('lambda')
+    try:
+        return aws_lambda.get_function_configuration(FunctionName=LAMBDA_FUNCTION_NAME)['FunctionArn']
+    except aws_lambda.exceptions.ResourceNotFoundException:
+        return None
 
 
 def delete_lambda_function():
-    local(
-        'aws lambda delete-function' +
-        '    --function-name ' + LAMBDA_FUNCTION_NAME +
-        AWS_CLI_STANDARD_OPTIONS,
-        capture=True
-    )
+    get_aws_client('lambda').delete_function(FunctionName=LAMBDA_FUNCTION_NAME)
+    invalidate_resolutions('get_lambda_function_arn')
+
+
+def get_deployed_lambda_function():
+    """Return the configuration of the version the alias points to, or None if there is no alias yet."""
+    aws_lambda = get_aws_client('lambda')
+    try:
+        return aws_lambda.get_function_configuration(FunctionName=LAMBDA_FUNCTION_NAME, Qualifier=LAMBDA_FUNCTION_ALIAS)
+    except aws_lambda.exceptions.ResourceNotFoundException:
+        return None
+
+
+def lambda_function_update_finished():
+    result = get_aws_client('lambda').get_function_configuration(FunctionName=LAMBDA_FUNCTION_NAME)
+    return result.get('LastUpdateStatus', 'Successful') != 'InProgress'
 
 
 def update_lambda_function():
+    """Deploy the Lambda function if its package or configuration changed since the last deployment.
+
+    Code and configuration are updated in place and published as a new version. Moving the alias to the new version
+    switches all invocations over at once, and the S3 invoke permission of the alias stays in place.
+    """
     dump_lambda_function_configuration()
-    create_lambda_deployment_package()
+    description = 'Package SHA-256: ' + get_lambda_package_hash()
     role_arn = get_or_create_lambda_execution_role()
     check_lambda_execution_role_policies()
 
-    if get_lambda_function_arn() is not None:
-        print('Deleting existing Lambda function ' + LAMBDA_FUNCTION_NAME + '.')
-        delete_lambda_function()
+    function_configuration = {
+        'Role': role_arn,
+        'Handler': LAMBDA_FUNCTION_NAME + '.handler',
+        'Runtime': 'nodejs',
+        'Description': description
+    }
 
-    local(
-        'aws lambda create-function' +
-        '    --function-name ' + LAMBDA_FUNCTION_NAME +
-        '    --zip-file fileb://./' + ZIPFILE_NAME +
-        '    --role ' + role_arn +
-        '    --handler ' + LAMBDA_FUNCTION_NAME + '.handler' +
-        '    --runtime nodejs' +
-        AWS_CLI_STANDARD_OPTIONS,
-        capture=True
-    )
+    deployed = get_deployed_lambda_function()
+    if deployed is not None and all(deployed.get(k) == v for k, v in function_configuration.items()):
+        print('Lambda function ' + LAMBDA_FUNCTION_NAME + ' is up to date (version ' + deployed['Version'] + ').')
+        return
+
+    create_lambda_deployment_package()
+    with open(ZIPFILE_NAME, 'rb') as fp:
+        code = fp.read()
+
+    aws_lambda = get_aws_client('lambda')
+
+    if get_lambda_function_arn() is None:
+        def create_function():
+            try:
+                return aws_lambda.create_function(
+                    FunctionName=LAMBDA_FUNCTION_NAME,
+                    Code={'ZipFile': code},
+                    Publish=True,
+                    **function_configuration
+                )
+            except aws_lambda.exceptions.InvalidParameterValueException as e:
+                if 'cannot be assumed by Lambda' in str(e):
+                    return None  # The new or updated execution role can't be assumed by AWS Lambda yet.
+                raise
+
+        print('Creating Lambda function ' + LAMBDA_FUNCTION_NAME + '...')
+        version = wait_until(
+            create_function,
+            'role ' + LAMBDA_EXECUTION_ROLE_NAME + ' to become usable by AWS Lambda'
+        )['Version']
+        invalidate_resolutions('get_lambda_function_arn')
+    else:
+        print('Updating Lambda function ' + LAMBDA_FUNCTION_NAME + ' in place...')
+        code_sha256 = aws_lambda.update_function_code(FunctionName=LAMBDA_FUNCTION_NAME, ZipFile=code)['CodeSha256']
+        wait_until(lambda_function_update_finished, 'code update of ' + LAMBDA_FUNCTION_NAME)
+        aws_lambda.update_function_configuration(FunctionName=LAMBDA_FUNCTION_NAME, **function_configuration)
+        wait_until(lambda_function_update_finished, 'configuration update of ' + LAMBDA_FUNCTION_NAME)
+        version = aws_lambda.publish_version(
+            FunctionName=LAMBDA_FUNCTION_NAME,
+            CodeSha256=code_sha256,
+            Description=description
+        )['Version']
+
+    if deployed is None:
+        aws_lambda.create_alias(FunctionName=LAMBDA_FUNCTION_NAME, Name=LAMBDA_FUNCTION_ALIAS, FunctionVersion=version)
+    else:
+        aws_lambda.update_alias(FunctionName=LAMBDA_FUNCTION_NAME, Name=LAMBDA_FUNCTION_ALIAS, FunctionVersion=version)
+    print('Alias ' + LAMBDA_FUNCTION_ALIAS + ' now points to version ' + version + '.')
+
+
+def get_lambda_alias_arn():
+    return get_lambda_function_arn() + ':' + LAMBDA_FUNCTION_ALIAS
+
+
+def test_lambda_function():
+    local('node ' + LAMBDA_FUNCTION_HARNESS)
 
 
 def show_lambda_execution_role_policy():
@@ -399,45 +955,32 @@ def show_lambda_execution_role_policy():
 # Amazon S3
 
 
-def get_s3_connection():
-    aws_access_key_id, aws_secret_access_key = get_aws_credentials()
-    return boto.s3.connect_to_region(
-        AWS_REGION,
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key
-    )
-
-
 def get_or_create_bucket():
-    s3 = get_s3_connection()
-    b = s3.lookup(AWS_BUCKET)
-    if b is None:
-        print('Creating bucket: ' + AWS_BUCKET + ' in region: ' + AWS_REGION + '...')
-        LOCATION = AWS_REGION if AWS_REGION != 'us-east-1' else ''
-        b = s3.create_bucket(AWS_BUCKET, location=LOCATION)
-    else:
+    s3 = get_aws_client('s3')
+    try:
+        s3.head_bucket(Bucket=AWS_BUCKET)
         print('Found bucket: ' + AWS_BUCKET + '.')
+    except ClientError as e:
+        if get_aws_error_code(e) != '404':
+            raise
 
-    return b
-
+        print('Creating bucket: ' + AWS_BUCKET + ' in region: ' + AWS_REGION + '...')
+        if AWS_REGION == 'us-east-1':
+            s3.create_bucket(Bucket=AWS_BUCKET)
+        else:
+            s3.create_bucket(Bucket=AWS_BUCKET, CreateBucketConfiguration={'LocationConstraint': AWS_REGION})
 
-def check_bucket_permissions():
-    with quiet():
-        result = local(
-            'aws lambda get-policy' +
-            '    --function-name ' + LAMBDA_FUNCTION_NAME +
-            AWS_CLI_STANDARD_OPTIONS,
-            capture=True
-        )
+    return AWS_BUCKET
 
-    if result.failed or result == '':
-        return False
 
-    result_decoded = json.loads(result)
-    if not isinstance(result_decoded, dict):
+def check_bucket_permissions():
+    aws_lambda = get_aws_client('lambda')
+    try:
+        result = aws_lambda.get_policy(FunctionName=LAMBDA_FUNCTION_NAME, Qualifier=LAMBDA_FUNCTION_ALIAS)
+    except aws_lambda.exceptions.ResourceNotFoundException:
         return False
 
-    policy = json.loads(result_decoded.get('Policy', '{}'))
+    policy = json.loads(result.get('Policy', '{}'))
     if not isinstance(policy, dict):
         return False
 
@@ -455,53 +998,60 @@ def update_bucket_permissions():
         print('Lambda invocation permission for bucket: ' + AWS_BUCKET + ' is set.')
     else:
         print('Setting Lambda invocation permission for bucket: ' + AWS_BUCKET + '.')
-        local(
-            'aws lambda add-permission' +
-            '    --function-name ' + LAMBDA_FUNCTION_NAME +
-            '    --region ' + AWS_REGION +
-            '    --statement-id ' + BUCKET_PERMISSION_SID +
-            '    --action "lambda:InvokeFunction"' +
-            '    --principal s3.amazonaws.com' +
-            '    --source-arn arn:aws:s3:::' + AWS_BUCKET +
-            '    --profile ' + AWS_PROFILE,
-            capture=True
+        get_aws_client('lambda').add_permission(
+            FunctionName=LAMBDA_FUNCTION_NAME,
+            Qualifier=LAMBDA_FUNCTION_ALIAS,
+            StatementId=BUCKET_PERMISSION_SID,
+            Action='lambda:InvokeFunction',
+            Principal='s3.amazonaws.com',
+            SourceArn='arn:aws:s3:::' + AWS_BUCKET
         )
 
 
-def check_bucket_notifications():
-    result = local(
-        'aws s3api get-bucket-notification-configuration' +
-        '    --bucket ' + AWS_BUCKET +
-        AWS_CLI_STANDARD_OPTIONS,
-        capture=True
-    )
+def get_bucket_notification_configuration(lambda_function_arn):
+    # Only whitelisted keys invoke the function, not the worker's own objects under .ecs-worker/ (tiles, results,
+    # markers). S3 takes one suffix rule per configuration, so there is one configuration for each suffix.
+    template = BUCKET_NOTIFICATION_CONFIGURATION['LambdaFunctionConfigurations'][0]
+    configurations = []
 
-    if result.failed or result == '':
-        return False
+    for i, suffix in enumerate(LAMBDA_FUNCTION_CONFIG['s3_key_suffix_whitelist']):
+        c = copy.deepcopy(template)
+        if i > 0:
+            c['Id'] = APP_NAME + '-' + str(i)
+        c['LambdaFunctionArn'] = lambda_function_arn
+        c['Filter'] = {'Key': {'FilterRules': [{'Name': 'suffix', 'Value': suffix}]}}
+        configurations.append(c)
 
-    result_decoded = json.loads(result)
-    if not isinstance(result_decoded, dict):
-        return False
+    return {'LambdaFunctionConfigurations': configurations}
 
 
-def setup_bucket_notifications():
-    update_lambda_function()
-    update_bucket_permissions()
+def check_bucket_notifications(notification_configuration):
+    def suffix(c):
+        return c['Filter']['Key']['FilterRules'][0]['Value']
+
+    result = get_aws_client('s3').get_bucket_notification_configuration(Bucket=AWS_BUCKET)
+    current = dict((c.get('Id'), c) for c in result.get('LambdaFunctionConfigurations', []))
+
+    for c in notification_configuration['LambdaFunctionConfigurations']:
+        found = current.get(c['Id'], {})
+        rules = [(r.get('Name', '').lower(), r.get('Value'))
+                 for r in found.get('Filter', {}).get('Key', {}).get('FilterRules', [])]
+        if found.get('LambdaFunctionArn') != c['LambdaFunctionArn'] or rules != [('suffix', suffix(c))]:
+            return False
+
+    return True
+
 
-    notification_configuration = BUCKET_NOTIFICATION_CONFIGURATION.copy()
-    lambda_function_arn = get_lambda_function_arn()
-    notification_configuration['LambdaFunctionConfigurations'][0]['LambdaFunctionArn'] = lambda_function_arn
+def setup_bucket_notifications():
+    notification_configuration = get_bucket_notification_configuration(get_lambda_alias_arn())
 
-    if check_bucket_notifications():
+    if check_bucket_notifications(notification_configuration):
         print('Bucket notification configuration for bucket: ' + AWS_BUCKET + ' is set.')
     else:
         print('Setting bucket notification configuration for bucket: ' + AWS_BUCKET + '.')
-        local(
-            'aws s3api put-bucket-notification-configuration' +
-            '    --bucket ' + AWS_BUCKET +
-            '    --notification-configuration \'' + json.dumps(notification_configuration, sort_keys=True) + '\'' +
-            AWS_CLI_STANDARD_OPTIONS,
-            capture=True
+        get_aws_client('s3').put_bucket_notification_configuration(
+            Bucket=AWS_BUCKET,
+            NotificationConfiguration=notification_configuration
         )
 
 
@@ -509,149 +1059,307 @@ def show_bucket_name():
     print("Your bucket name is: " + AWS_BUCKET)
 
 
-# Amazon EC2
+# Amazon ECS cluster inventory
 
-def get_instance_ip_from_id(instance_id):
-    result = json.loads(local(
-        'aws ec2 describe-instances' +
-        '    --instance ' + instance_id +
-        '    --query Reservations[0].Instances[0].PublicIpAddress' +
-        AWS_CLI_STANDARD_OPTIONS,
-        capture=True
-    ))
-    print ('IP address for instance ' + instance_id + ' is: ' + result)
-    return result
 
+def get_resource(resources, name):
+    for r in resources or []:
+        if r.get('name') == name:
+            return r.get('integerValue', 0)
+    return 0
 
-def get_instance_profile_name(instance_id):
-    result = json.loads(local(
-        'aws ec2 describe-instances' +
-        '    --instance ' + instance_id +
-        '    --query Reservations[0].Instances[0].IamInstanceProfile.Arn' +
-        AWS_CLI_STANDARD_OPTIONS,
-        capture=True
-    )).split('/')[-1]
-    print('IAM instance profile for instance ' + instance_id + ' is: ' + result)
-    return result
 
+@resolved
+def get_cluster_inventory():
+    """Return a snapshot of all container instances in the cluster, indexed by container instance ARN and EC2 ID.
 
-def get_instance_role(instance_id):
-    profile = get_instance_profile_name(instance_id)
-    result = json.loads(local(
-        'aws iam get-instance-profile' +
-        '    --instance-profile-name ' + profile +
-        '    --query InstanceProfile.Roles[0].RoleName' +
-        AWS_CLI_STANDARD_OPTIONS,
-        capture=True
-    ))
-    print('Role for instance ' + instance_id + ' is: ' + result)
+    Each instance is a dict with its registered and remaining CPU and memory, its task count, IP addresses, instance
+    profile and IAM role. Container instances are described ECS_DESCRIBE_BATCH_SIZE at a time, their EC2 instances
+    with one call and each instance profile once, instead of a chain of lookups per instance.
+    """
+    arns = list_all('ecs', 'list_container_instances', 'containerInstanceArns', cluster=ECS_CLUSTER)
+    instances = []
+    for i in range(0, len(arns), ECS_DESCRIBE_BATCH_SIZE):
+        result = get_aws_client('ecs').describe_container_instances(
+            cluster=ECS_CLUSTER,
+            containerInstances=arns[i:i + ECS_DESCRIBE_BATCH_SIZE]
+        )
+        for c in result['containerInstances']:
+            instances.append({
+                'arn': c['containerInstanceArn'],
+                'instance_id': c['ec2InstanceId'],
+                'active': c.get('status') == 'ACTIVE' and c.get('agentConnected', False),
+                'registered_cpu': get_resource(c.get('registeredResources'), 'CPU'),
+                'registered_memory': get_resource(c.get('registeredResources'), 'MEMORY'),
+                'remaining_cpu': get_resource(c.get('remainingResources'), 'CPU'),
+                'remaining_memory': get_resource(c.get('remainingResources'), 'MEMORY'),
+                'tasks': c.get('runningTasksCount', 0) + c.get('pendingTasksCount', 0)
+            })
+
+    ec2_instances = {}
+    if instances:
+        result = get_aws_client('ec2').describe_instances(InstanceIds=[i['instance_id'] for i in instances])
+        for reservation in result['Reservations']:
+            for e in reservation['Instances']:
+                ec2_instances[e['InstanceId']] = e
+
+    roles = {}  # Instance profile name -> role name
+    for i in instances:
+        e = ec2_instances.get(i['instance_id'], {})
+        i['public_ip'] = e.get('PublicIpAddress')
+        i['private_ip'] = e.get('PrivateIpAddress')
+        i['profile'] = e.get('IamInstanceProfile', {}).get('Arn', '').split('/')[-1] or None
+        if i['profile'] and i['profile'] not in roles:
+            roles[i['profile']] = get_aws_client('iam').get_instance_profile(
+                InstanceProfileName=i['profile']
+            )['InstanceProfile']['Roles'][0]['RoleName']
+        i['role'] = roles.get(i['profile'])
+
+    print('Container instances in cluster ' + ECS_CLUSTER + ': ' + str(len(instances)) + '.')
+    return {
+        'instances': instances,
+        'by_arn': dict((i['arn'], i) for i in instances),
+        'by_instance_id': dict((i['instance_id'], i) for i in instances)
+    }
+
+
+def get_inventory_instance(instance_id):
+    result = get_cluster_inventory()['by_instance_id'].get(instance_id)
+    if result is None:
+        abort('Instance ' + instance_id + ' is not a container instance of cluster ' + ECS_CLUSTER + '.')
     return result
 
 
-# Amazon ECS
+def get_instance_load(instance):
+    """Return the fraction of an instance's CPU or memory that is reserved, whichever is higher."""
+    load = 0.0
+    for resource in ('cpu', 'memory'):
+        registered = instance['registered_' + resource]
+        load = max(load, 1 - float(instance['remaining_' + resource]) / registered if registered else 1.0)
+    return load
 
 
-def get_container_instances():
-    result = json.loads(local(
-        'aws ecs list-container-instances' +
-        '    --query containerInstanceArns' +
-        '    --cluster ' + ECS_CLUSTER + 
-        AWS_CLI_STANDARD_OPTIONS,
-        capture=True
+def get_least_loaded_instance():
+    """Return the inventory entry of the active container instance with the most room left."""
+    active = [i for i in get_cluster_inventory()['instances'] if i['active']]
+    if not active:
+        abort('No active container instances in cluster ' + ECS_CLUSTER + '.')
+
+    result = min(active, key=lambda i: (get_instance_load(i), i['tasks'], i['instance_id']))
+    print('Least loaded container instance: %s (%d%% reserved, %d task(s)).' % (
+        result['instance_id'], get_instance_load(result) * 100, result['tasks']
     ))
-    print('Container instances: ' + ','.join(result))
     return result
 
 
-def get_first_ecs_instance():
-    container_instances = get_container_instances()
+def get_instance_ip_from_id(instance_id):
+    instance = get_inventory_instance(instance_id)
+    result = instance['public_ip'] or instance['private_ip']
+    print('IP address for instance ' + instance_id + ' is: ' + result)
+    return result
 
-    result = json.loads(local(
-        'aws ecs describe-container-instances' +
-        '    --cluster ' + ECS_CLUSTER +
-        '    --container-instances ' + container_instances[0] +
-        '    --query containerInstances[0].ec2InstanceId' +
-        AWS_CLI_STANDARD_OPTIONS,
-        capture=True
-    ))
-    print('First container instance: ' + result)
+
+def get_instance_role(instance_id):
+    result = get_inventory_instance(instance_id)['role']
+    if result is None:
+        abort('Instance ' + instance_id + ' has no IAM role.')
+    print('Role for instance ' + instance_id + ' is: ' + result)
     return result
 
 
-def get_first_ecs_instance_ip():
-    i = get_first_ecs_instance()
-    return get_instance_ip_from_id(i)
+def get_cluster_roles():
+    """Return the IAM roles of all container instances in the cluster. Usually, they all have the same one."""
+    return sorted(set(i['role'] for i in get_cluster_inventory()['instances'] if i['role']))
+
+
+def show_cluster_inventory():
+    instances = get_cluster_inventory()['instances']
+    print('')
+    print('%-20s %-8s %6s %12s %14s %6s %-16s %s' % (
+        'Instance', 'Status', 'Tasks', 'CPU left', 'Memory left', 'Load', 'IP address', 'Role'
+    ))
+    for i in sorted(instances, key=get_instance_load):
+        print('%-20s %-8s %6d %12s %14s %5d%% %-16s %s' % (
+            i['instance_id'],
+            'active' if i['active'] else 'inactive',
+            i['tasks'],
+            '%d/%d' % (i['remaining_cpu'], i['registered_cpu']),
+            '%d/%d' % (i['remaining_memory'], i['registered_memory']),
+            get_instance_load(i) * 100,
+            i['public_ip'] or i['private_ip'] or '-',
+            i['role'] or '-'
+        ))
 
 
 def prepare_env():
-    env.host_string = get_first_ecs_instance_ip()
+    env.host_string = get_instance_ip_from_id(get_least_loaded_instance()['instance_id'])
     env.user = SSH_USER
     env.key_filename = SSH_KEY_DIR + '/' + SSH_KEY_NAME
 
 
+# Amazon ECS
+
+
 def generate_dockerfile():
-    return DOCKERFILE % {'name': FULL_NAME_AND_EMAIL, 'worker_file': WORKER_FILE}
+    return DOCKERFILE % {
+        'name': FULL_NAME_AND_EMAIL,
+        'worker_file': WORKER_FILE,
+        'worker_module': WORKER_MODULE,
+        'pov_ray_git_ref': POV_RAY_GIT_REF
+    }
 
 
 def show_dockerfile():
     print generate_dockerfile()
 
 
+def get_worker_image_tag():
+    """Return the image tag for the current Dockerfile and worker files. It changes whenever one of them does."""
+    h = hashlib.sha256(generate_dockerfile())
+    h.update(get_artifact_hash(WORKER_PATH, list_files(WORKER_PATH)))
+    return DOCKER_IMAGE_REPOSITORY + ':' + APP_NAME + '-' + h.hexdigest()[:16]
+
+
+def show_worker_image_tag():
+    print get_worker_image_tag()
+
+
+def is_ecr_repository():
+    return '.dkr.ecr.' in DOCKER_IMAGE_REPOSITORY
+
+
+def check_worker_image(tag):
+    if is_ecr_repository():
+        ecr = get_aws_client('ecr')
+        try:
+            ecr.describe_images(
+                repositoryName=DOCKER_IMAGE_REPOSITORY.split('/', 1)[1],
+                imageIds=[{'imageTag': tag.split(':')[-1]}]
+            )
+            return True
+        except ecr.exceptions.ImageNotFoundException:
+            return False
+
+    with quiet():
+        return local('docker manifest inspect ' + tag, capture=True).succeeded
+
+
+def get_docker_login_command():
+    authorization = get_aws_client('ecr').get_authorization_token()['authorizationData'][0]
+    user, password = base64.b64decode(authorization['authorizationToken']).split(':', 1)
+    return 'docker login -u ' + user + ' -p ' + password + ' ' + authorization['proxyEndpoint']
+
+
 def update_ecs_image():
-    prepare_env()
-    run('mkdir -p ' + APP_NAME)
+    """Build the worker image locally and push it, unless an image with the same tag has been pushed before."""
+    tag = get_worker_image_tag()
+    if check_worker_image(tag):
+        print('Worker image ' + tag + ' is up to date.')
+        return
+
+    build_dir = tempfile.mkdtemp()
+    try:
+        context_dir = os.path.join(build_dir, APP_NAME)
+        shutil.copytree(WORKER_PATH, context_dir)
+        os.chmod(os.path.join(context_dir, WORKER_FILE), 0755)
+        with open(os.path.join(context_dir, 'Dockerfile'), 'w') as fp:
+            fp.write(generate_dockerfile())
 
-    dockerfile_string = generate_dockerfile()
-    dockerfile = StringIO(dockerfile_string)
-    put(dockerfile, remote_path='~/' + APP_NAME + '/Dockerfile', mode=0644)
+        print('Building worker image ' + tag + '...')
+        local('docker build -t ' + tag + ' ' + context_dir)
+    finally:
+        shutil.rmtree(build_dir)
 
-    with open(os.path.join(WORKER_PATH, WORKER_FILE), "r") as fp:
-        put(fp, remote_path='~/' + APP_NAME + '/' + WORKER_FILE, mode=0755)
+    # Docker Hub repositories need a prior "docker login" on this machine.
+    if is_ecr_repository():
+        with quiet():
+            local(get_docker_login_command())
+    local('docker push ' + tag)
 
-    # Build the docker image and upload it to Dockerhub. This will prompt the user for their password.
-    with cd('~/' + APP_NAME):
-        run('docker build -t ' + DOCKERHUB_TAG + ' .')
-        #run('docker login -u ' + DOCKERHUB_USER + ' -e ' + DOCKERHUB_EMAIL)
-        login_str = local('aws ecr get-login', capture=True)
-        print(login_str)
-        run('%s' % login_str)
-        run('docker push ' + DOCKERHUB_TAG)
 
-    # Cleanup.
-    run('/bin/rm -rf ' + APP_NAME)
+def get_size_class_task_name(name):
+    return ECS_TASK_NAME + '-' + name
 
 
-def generate_task_definition():
-    task_definition = TASK_DEFINITION.copy()
-    task_definition['containerDefinitions'][0]['environment'].append(
+def get_size_class(name):
+    for size_class in TASK_SIZE_CLASSES:
+        if size_class[0] == name:
+            return size_class
+    abort('Unknown size class: ' + name + '. Size classes: ' + ', '.join(c[0] for c in TASK_SIZE_CLASSES) + '.')
+
+
+def generate_task_definition(size_class=None):
+    """Return the task definition of the worker, or of the worker tasks of a size class from TASK_SIZE_CLASSES."""
+    task_definition = copy.deepcopy(TASK_DEFINITION)
+    container = task_definition['containerDefinitions'][0]
+    container['image'] = get_worker_image_tag()
+    container['environment'].append(
         {
             'name': 'SQS_QUEUE_URL',
             'value': get_queue_url()
         }
     )
+    container['environment'].append(
+        {
+            'name': 'QUEUE_LANES',
+            'value': json.dumps([
+                {
+                    'name': name,
+                    'url': get_queue_url(get_lane_queue_name(name)),
+                    'dead_letter_url': get_dead_letter_queue_url(get_lane_queue_name(name)) or '',
+                    'weight': weight
+                }
+                for name, weight, _, _ in QUEUE_LANES
+            ])
+        }
+    )
+    container['environment'].append(
+        {
+            'name': 'SQS_DEAD_LETTER_QUEUE_URL',
+            'value': get_dead_letter_queue_url() or ''
+        }
+    )
+    if size_class:
+        name, cpu, memory = size_class
+        container['cpu'] = cpu
+        container['memory'] = memory
+        settings = {
+            'CPU_SHARES': str(cpu),
+            'MEMORY': str(memory),
+            'SIZE_CLASS': name,
+            'WORKER_SLOTS': '1',
+            'POVRAY_THREADS': str(max(1, cpu // 1024))
+        }
+        for variable in container['environment']:
+            variable['value'] = settings.get(variable['name'], variable['value'])
     return task_definition
 
 
-def show_task_definition():
-    print json.dumps(generate_task_definition(), indent=4)
+def show_task_definition(size_class=None):
+    print json.dumps(generate_task_definition(get_size_class(size_class) if size_class else None), indent=4)
 
 
 def update_ecs_task_definition():
-    task_definition_string = json.dumps(generate_task_definition())
+    ecs = get_aws_client('ecs')
+    task_definition = generate_task_definition()
+    task_definition['family'] = ECS_TASK_NAME
+    ecs.register_task_definition(**task_definition)
 
-    local(
-        'aws ecs register-task-definition' +
-        '    --family ' + ECS_TASK_NAME +
-        '    --cli-input-json \'' + task_definition_string + '\'' +
-        AWS_CLI_STANDARD_OPTIONS,
-        capture=True
-    )
+    for size_class in TASK_SIZE_CLASSES:
+        task_definition = generate_task_definition(size_class)
+        task_definition['family'] = get_size_class_task_name(size_class[0])
+        print('Registering task definition ' + task_definition['family'] + ' with ' + str(size_class[1]) +
+              ' CPU shares and ' + str(size_class[2]) + ' MB of memory...')
+        ecs.register_task_definition(**task_definition)
 
 
 def generate_ecs_role_policy():
     result = ECS_ROLE_BUCKET_ACCESS_POLICY.copy()
     result['Statement'][1]['Resource'] = 'arn:aws:s3:::' + AWS_BUCKET
     result['Statement'][2]['Resource'] = 'arn:aws:s3:::' + AWS_BUCKET + '/*'
+    result['Statement'][3]['Resource'] = 'arn:aws:sqs:' + AWS_REGION + ':*:' + SQS_QUEUE_NAME + '*'  # All lanes.
+    result['Statement'][4]['Resource'] = 'arn:aws:lambda:' + AWS_REGION + ':*:function:' + LAMBDA_FUNCTION_NAME + ':*'
+    result['Statement'][5]['Resource'] = 'arn:aws:logs:' + AWS_REGION + ':*:log-group:' + WORKER_LOG_GROUP + ':*'
     return result
 
 
@@ -660,17 +1368,14 @@ def show_ecs_role_policy():
     print json.dumps(policy, indent=4, sort_keys=True)
 
 
-def check_ecs_role_policy():
-    role = get_instance_role(get_first_ecs_instance())
-    iam = get_iam_connection()
+def check_ecs_role_policy(role):
+    iam = get_aws_client('iam')
 
     policy = None
-    # noinspection PyBroadException
     try:
-        response = iam.get_role_policy(role, ECS_ROLE_BUCKET_ACCESS_POLICY_NAME)
-        policy_raw = response['get_role_policy_response']['get_role_policy_result']['policy_document']
-        policy = json.dumps(json.loads(unquote(policy_raw)), sort_keys=True)
-    except Exception:
+        response = iam.get_role_policy(RoleName=role, PolicyName=ECS_ROLE_BUCKET_ACCESS_POLICY_NAME)
+        policy = json.dumps(response['PolicyDocument'], sort_keys=True)
+    except iam.exceptions.NoSuchEntityException:
         pass
 
     if policy is None:
@@ -687,77 +1392,387 @@ def check_ecs_role_policy():
 
 
 def update_ecs_role_policy():
-    if check_ecs_role_policy():
-        return True
-    else:
-        role = get_instance_role(get_first_ecs_instance())
-        policy = json.dumps(generate_ecs_role_policy())
-        iam = get_iam_connection()
+    """Put the worker's policy into the role of every container instance in the cluster that doesn't have it yet."""
+    roles = get_cluster_roles()
+    if not roles:
+        print('No container instances with an IAM role in cluster ' + ECS_CLUSTER + ', no ECS role policy to update.')
+        return
+
+    policy = json.dumps(generate_ecs_role_policy())
+    iam = get_aws_client('iam')
+    for role in roles:
+        if check_ecs_role_policy(role):
+            continue
         print('Putting policy: ' + ECS_ROLE_BUCKET_ACCESS_POLICY_NAME + ' into role: ' + role)
         iam.put_role_policy(
-            role,
-            ECS_ROLE_BUCKET_ACCESS_POLICY_NAME,
-            policy
+            RoleName=role,
+            PolicyName=ECS_ROLE_BUCKET_ACCESS_POLICY_NAME,
+            PolicyDocument=policy
         )
 
 
 # Amazon SQS
 
 
-def get_queue_url():
-    result = local(
-        'aws sqs list-queues' +
-        AWS_CLI_STANDARD_OPTIONS,
-        capture=True
-    )
+def get_lane_queue_name(lane):
+    return SQS_QUEUE_NAME if lane == QUEUE_LANE_DEFAULT else SQS_QUEUE_NAME + '-' + lane
+
+
+def get_lane_queue_names():
+    """Return the queue names of the lanes, highest priority first. Without lanes, there is one, SQS_QUEUE_NAME."""
+    return [get_lane_queue_name(lane[0]) for lane in QUEUE_LANES] or [SQS_QUEUE_NAME]
+
+
+@resolved
+def get_queue_url(queue_name=SQS_QUEUE_NAME):
+    sqs = get_aws_client('sqs')
+    try:
+        return sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
+    except sqs.exceptions.QueueDoesNotExist:
+        return None
 
-    if result is not None and result != '':
-        result_struct = json.loads(result)
-        if isinstance(result_struct, dict) and 'QueueUrls' in result_struct:
-            for u in result_struct['QueueUrls']:
-                if u.split('/')[-1] == SQS_QUEUE_NAME:
-                    return u
 
-    return None
+def get_dead_letter_queue_name(queue_name):
+    return queue_name + SQS_DEAD_LETTER_QUEUE_SUFFIX
 
 
-def get_or_create_queue():
-    u = get_queue_url()
+def get_dead_letter_queue_url(queue_name=SQS_QUEUE_NAME):
+    return get_queue_url(get_dead_letter_queue_name(queue_name)) if SQS_MAX_RECEIVE_COUNT else None
+
+
+@resolved
+def get_queue_arn(queue_url):
+    result = get_aws_client('sqs').get_queue_attributes(QueueUrl=queue_url, AttributeNames=['QueueArn'])
+    return result['Attributes']['QueueArn']
+
+
+def is_same_queue_attribute(name, current, value):
+    if name == 'RedrivePolicy' and current:
+        # SQS hands back the policy with a different layout, and maxReceiveCount as a number or a string.
+        current = json.loads(current)
+        value = json.loads(value)
+        return (current['deadLetterTargetArn'] == value['deadLetterTargetArn'] and
+                int(current['maxReceiveCount']) == int(value['maxReceiveCount']))
+    return current == value
+
+
+def put_queue(queue_name, attributes):
+    """Return the URL of a queue. Create it with the given attributes, or set those of them that differ."""
+    sqs = get_aws_client('sqs')
+    u = get_queue_url(queue_name)
     if u is None:
-        local(
-            'aws sqs create-queue' +
-            '    --queue-name ' + SQS_QUEUE_NAME +
-            AWS_CLI_STANDARD_OPTIONS,
-            capture=True
+        print('Creating queue ' + queue_name + '...')
+        sqs.create_queue(QueueName=queue_name, Attributes=attributes)
+        invalidate_resolutions('get_queue_url')
+        return wait_until(lambda: get_queue_url(queue_name), 'queue ' + queue_name + ' to appear')
+
+    if attributes:
+        current = sqs.get_queue_attributes(QueueUrl=u, AttributeNames=sorted(attributes))['Attributes']
+        changed = dict(
+            (name, value) for name, value in attributes.items()
+            if not is_same_queue_attribute(name, current.get(name), value)
         )
+        if changed:
+            print('Setting ' + ', '.join(sorted(changed)) + ' of queue ' + queue_name + '...')
+            sqs.set_queue_attributes(QueueUrl=u, Attributes=changed)
+    return u
+
+
+def get_or_create_queue(queue_name=SQS_QUEUE_NAME, max_receive_count=SQS_MAX_RECEIVE_COUNT):
+    """Return the URL of a queue, creating it if needed, with a dead-letter queue that SQS moves its messages to once
+    they have been received max_receive_count times without being deleted. 0: Don't attach a dead-letter queue.
+    """
+    max_receive_count = int(max_receive_count)
+    if not max_receive_count:
+        return put_queue(queue_name, {})
+
+    dead_letter_url = put_queue(get_dead_letter_queue_name(queue_name), {
+        'MessageRetentionPeriod': str(SQS_DEAD_LETTER_RETENTION_DAYS * 24 * 3600)
+    })
+    return put_queue(queue_name, {
+        'RedrivePolicy': json.dumps({
+            'deadLetterTargetArn': get_queue_arn(dead_letter_url),
+            'maxReceiveCount': str(max_receive_count)
+        })
+    })
+
+
+def replay_queue_dead_letters(queue_name, limit=0):
+    """Move the messages in the dead-letter queue of a queue back into it, up to limit of them (0: all).
+
+    Return the number of messages moved. Each is sent to the queue before it is deleted from the dead-letter queue, so
+    a failed replay may send a job twice, but never loses one. The worker skips jobs that have been rendered before.
+    """
+    dead_letter_url = get_dead_letter_queue_url(queue_name)
+    if not dead_letter_url:
+        print('Queue ' + queue_name + ' has no dead-letter queue.')
+        return 0
+
+    sqs = get_aws_client('sqs')
+    queue_url = get_queue_url(queue_name)
+    replayed = 0
+    while not limit or replayed < limit:
+        messages = sqs.receive_message(
+            QueueUrl=dead_letter_url,
+            MaxNumberOfMessages=min(10, limit - replayed) if limit else 10,
+            WaitTimeSeconds=SQS_REPLAY_WAIT_TIME,
+            VisibilityTimeout=SQS_REPLAY_VISIBILITY_TIMEOUT,
+            MessageAttributeNames=['Error']
+        ).get('Messages', [])
+        if not messages:
+            break
+
+        for m in messages:
+            error = m.get('MessageAttributes', {}).get('Error', {}).get('StringValue')
+            print('Replaying message ' + m['MessageId'] + (' (' + error + ')' if error else '') + '...')
+        result = sqs.send_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': str(i), 'MessageBody': m['Body']} for i, m in enumerate(messages)]
+        )
+        sent = [messages[int(r['Id'])] for r in result.get('Successful', [])]
+        if sent:
+            sqs.delete_message_batch(
+                QueueUrl=dead_letter_url,
+                Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(sent)]
+            )
+        replayed += len(sent)
+        for f in result.get('Failed', []):
+            print('ERROR: Could not replay message ' + messages[int(f['Id'])]['MessageId'] + ': ' +
+                  f.get('Message', ''))
+        if result.get('Failed'):
+            break
 
-        tries = 0
-        while True:
-            time.sleep(WAIT_TIME)
-            u = get_queue_url()
+    print('Replayed ' + str(replayed) + ' message(s) from ' + get_dead_letter_queue_name(queue_name) + '.')
+    return replayed
 
-            if u is not None and tries < RETRIES:
-                return u
 
-            tries += 1
+def replay_dead_letters(lane=None, limit=0):
+    """Move dead-lettered jobs back into the queues of all lanes, or of one, up to limit per lane (0: all), and have
+    the Lambda function start tasks for them.
+    """
+    queue_names = get_lane_queue_names()
+    if lane:
+        if lane not in [l[0] for l in QUEUE_LANES]:
+            abort('Unknown lane: ' + lane + '. Lanes: ' + ', '.join(l[0] for l in QUEUE_LANES) + '.')
+        queue_names = [get_lane_queue_name(lane)]
+
+    replayed = sum(map_in_threads(lambda queue_name: replay_queue_dead_letters(queue_name, int(limit)), queue_names))
+
+    if replayed:
+        print('Asking ' + LAMBDA_FUNCTION_NAME + ' to start tasks for ' + str(replayed) + ' replayed message(s)...')
+        get_aws_client('lambda').invoke(
+            FunctionName=get_lambda_alias_arn(),
+            InvocationType='Event',
+            Payload=json.dumps({'ScaleWorkers': True})
+        )
+
+
+# Amazon CloudWatch Logs
+
+
+def get_or_create_log_group():
+    logs = get_aws_client('logs')
+    groups = list_all('logs', 'describe_log_groups', 'logGroups', logGroupNamePrefix=WORKER_LOG_GROUP)
+    if any(g['logGroupName'] == WORKER_LOG_GROUP for g in groups):
+        print('Found log group: ' + WORKER_LOG_GROUP + '.')
+        return WORKER_LOG_GROUP
+
+    print('Creating log group: ' + WORKER_LOG_GROUP + '...')
+    try:
+        logs.create_log_group(logGroupName=WORKER_LOG_GROUP)
+    except logs.exceptions.ResourceAlreadyExistsException:
+        pass
+    logs.put_retention_policy(logGroupName=WORKER_LOG_GROUP, retentionInDays=WORKER_LOG_RETENTION_DAYS)
+    return WORKER_LOG_GROUP
+
+
+def parse_metric_record(line):
+    """Return the embedded metric format record in a log line, or None if there is none."""
+    start = line.find('{')
+    if start < 0 or '"_aws"' not in line:
+        return None
+    try:
+        record = json.loads(line[start:])
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) and '_aws' in record else None
+
+
+def read_metric_records(minutes):
+    """Return the embedded metric format records the workers and the Lambda function logged in the last minutes."""
+    logs = get_aws_client('logs')
+    records = []
+    for group in [WORKER_LOG_GROUP, LAMBDA_LOG_GROUP]:
+        try:
+            events = list_all(
+                'logs', 'filter_log_events', 'events',
+                logGroupName=group,
+                startTime=int((time.time() - float(minutes) * 60) * 1000),
+                filterPattern='"CloudWatchMetrics"'
+            )
+        except logs.exceptions.ResourceNotFoundException:
+            print('Log group ' + group + ' does not exist yet.')
+            continue
+        records.extend(r for r in (parse_metric_record(e['message']) for e in events) if r is not None)
+    return records
+
+
+def get_percentile(values, p):
+    """Return the nearest-rank percentile p of a non-empty list of values."""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def print_metric_percentiles(records):
+    """Print percentiles of every metric in seconds, in the order a job goes through the stages."""
+    values = {}
+    for r in records:
+        for m in r['_aws']['CloudWatchMetrics'][0]['Metrics']:
+            if m.get('Unit') == 'Seconds' and isinstance(r.get(m['Name']), (int, float)):
+                values.setdefault(m['Name'], []).append(r[m['Name']])
+
+    order = [
+        'LaunchSeconds', 'QueueWaitSeconds', 'PollSeconds', 'SlotWaitSeconds', 'FetchSeconds', 'ExtractSeconds',
+        'RenderSeconds', 'StitchSeconds', 'UploadSeconds', 'JobSeconds', 'DeleteSeconds'
+    ]
+    names = [n for n in order if n in values] + sorted(n for n in values if n not in order)
+
+    print('')
+    print('%-20s %8s' % ('Metric', 'Count') + ''.join('%10s' % ('p%d (s)' % p) for p in METRICS_PERCENTILES) +
+          '%10s' % 'Max (s)')
+    for name in names:
+        print('%-20s %8d' % (name, len(values[name])) +
+              ''.join('%10.3f' % get_percentile(values[name], p) for p in METRICS_PERCENTILES) +
+              '%10.3f' % max(values[name]))
+    print('Fetching and extracting overlap. Jobs that were split up count once for splitting and once per part.')
+    print('')
+
+
+def show_stage_percentiles(minutes=60, path=None):
+    """Print percentiles per stage from the metrics the workers and the Lambda function logged in the last minutes.
+
+    With path, the metrics are read from a local log file instead, e.g. one written by ecs-worker-benchmark.py --log.
+    """
+    if path:
+        with open(path, 'r') as fp:
+            records = [r for r in (parse_metric_record(l) for l in fp) if r is not None]
+    else:
+        records = read_metric_records(minutes)
+
+    if not records:
+        print('No metrics found.')
+        return
+    print_metric_percentiles(records)
 
 
 # Putting together the demo POV-Ray file.
 
 def create_pov_ray_zip():
-    if os.path.exists(POV_RAY_SCENE_FILE):
-        print('Deleting old ZIP file: ' + POV_RAY_SCENE_FILE)
-        os.remove(POV_RAY_SCENE_FILE)
-
-    print('Creating ZIP file: ' + POV_RAY_SCENE_FILE + '...')
-    with ZipFile(POV_RAY_SCENE_FILE, 'w', ZIP_DEFLATED) as z:
-        saved_dir = os.getcwd()
-        os.chdir(POV_RAY_SCENE_NAME)
-        for f in POV_RAY_SCENE_FILES:
-            print('Adding: ' + f + '...')
-            z.write(f)
-        os.chdir(saved_dir)
-        z.close()
+    build_zip_artifact(POV_RAY_SCENE_FILE, POV_RAY_SCENE_NAME, POV_RAY_SCENE_FILES)
+
+
+# Benchmark. Runs offline, against local stand-ins for the AWS services.
+
+
+def benchmark(scenes=20, scene_mb=1, render_seconds=0.5):
+    """Measure throughput and latency of the pipeline with this deployment's scaling, then time the main fab tasks."""
+    local(
+        'python %s pipeline --scenes %s --scene-mb %s --render-seconds %s '
+        '--max-tasks %d --messages-per-task %d --task-cpu %d --task-memory %d' % (
+            BENCHMARK_SCRIPT, scenes, scene_mb, render_seconds,
+            WORKER_TASKS_MAX, MESSAGES_PER_WORKER_TASK, CPU_SHARES, MEMORY
+        )
+    )
+    local('python ' + BENCHMARK_SCRIPT + ' fab')
+
+
+# Task graph. Runs the steps of a high level function in dependency order, independent steps in parallel.
+
+
+def check_task_graph(steps):
+    names = [name for name, _, _ in steps]
+    if len(set(names)) != len(names):
+        abort('Duplicate step names in task graph: ' + ', '.join(names))
+
+    for name, _, dependencies in steps:
+        for d in dependencies:
+            if d not in names:
+                abort('Step ' + name + ' depends on unknown step: ' + d)
+
+
+def run_task_graph(steps, workers=TASK_GRAPH_WORKERS):
+    """Run (name, function, dependencies) steps on a pool of threads and print a timing breakdown.
+
+    A step starts as soon as all steps it depends on have finished. After the first failure no new steps are
+    started, steps that are already running are allowed to finish, and the run is aborted. Every step is
+    idempotent, so running the task graph again picks up where the failed run stopped.
+    """
+    check_task_graph(steps)
+
+    functions = dict((name, function) for name, function, _ in steps)
+    waiting_for = dict((name, set(dependencies)) for name, _, dependencies in steps)
+    order = [name for name, _, _ in steps]
+    results = Queue()
+    running = set()
+    finished = {}  # Step name -> (status, start offset, duration).
+    errors = []
+    graph_start = time.time()
+
+    def run_step(name, start):
+        try:
+            functions[name]()
+            results.put((name, start, None))
+        except BaseException as e:  # fabric's abort() raises SystemExit.
+            results.put((name, start, e))
+
+    while True:
+        if not errors:
+            ready = [n for n in order if n not in finished and n not in running and not waiting_for[n]]
+            for name in ready[:max(0, workers - len(running))]:
+                print('Starting step: ' + name + '...')
+                running.add(name)
+                t = threading.Thread(target=run_step, args=(name, time.time()))
+                t.daemon = True
+                t.start()
+
+        if not running:
+            break
+
+        name, start, error = results.get()
+        running.remove(name)
+        finished[name] = ('failed' if error is not None else 'ok', start - graph_start, time.time() - start)
+
+        if error is not None:
+            print('Step ' + name + ' failed: ' + repr(error))
+            errors.append((name, error))
+        else:
+            for dependencies in waiting_for.values():
+                dependencies.discard(name)
+
+    print_task_graph_timings(order, finished, time.time() - graph_start)
+
+    if errors:
+        abort('Step(s) failed: ' + ', '.join(name for name, _ in errors) + '. Skipped steps were not started.')
+
+    unfinished = [n for n in order if n not in finished]
+    if unfinished:
+        abort('Circular dependencies between steps: ' + ', '.join(unfinished))
+
+
+def print_task_graph_timings(order, finished, total):
+    print('')
+    print('%-24s %-8s %10s %10s' % ('Step', 'Status', 'Start (s)', 'Time (s)'))
+    serial = 0.0
+    for name in order:
+        if name in finished:
+            status, start, duration = finished[name]
+            serial += duration
+            print('%-24s %-8s %10.1f %10.1f' % (name, status, start, duration))
+        else:
+            print('%-24s %-8s %10s %10s' % (name, 'skipped', '-', '-'))
+    print('Total: %.1fs (%.1fs if run one after another).' % (total, serial))
+    print('')
+
 
 # High level functions. Call these as "fab <function>"
 
@@ -778,15 +1793,27 @@ def update_ecs():
 
 
 def update_queue():
-    get_or_create_queue()
+    map_in_threads(get_or_create_queue, get_lane_queue_names())
+
+
+def update_log_group():
+    get_or_create_log_group()
+
+
+SETUP_TASK_GRAPH = [
+    # (step, function, steps it depends on)
+    ('dependencies', update_dependencies, []),
+    ('bucket', update_bucket, []),
+    ('queue', update_queue, []),
+    ('lambda', update_lambda, ['dependencies', 'bucket', 'queue']),
+    ('ecs_image', update_ecs_image, []),
+    ('log_group', update_log_group, []),
+    ('ecs_task_definition', update_ecs_task_definition, ['queue', 'ecs_image', 'log_group']),
+    ('ecs_role_policy', update_ecs_role_policy, ['bucket']),
+    ('pov_ray_zip', create_pov_ray_zip, [])
+]
 
 
 def setup():
-    update_dependencies()
-    update_bucket()
-    update_queue()
-    update_lambda()
-    update_ecs()
-    update_ecs_role_policy()
-    create_pov_ray_zip()
+    run_task_graph(SETUP_TASK_GRAPH)
     show_bucket_name()